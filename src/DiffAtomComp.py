@@ -5,6 +5,10 @@ from datetime import datetime
 import numpy as np
 import torch
 from typing import Tuple, List
+from collections import OrderedDict
+import hashlib
+import json
+import functools
 import torch.nn.functional as F
 
 from Bio.PDB import MMCIFParser, PDBParser
@@ -14,9 +18,18 @@ import operator
 import warnings
 from Bio.PDB.PDBExceptions import PDBConstructionWarning
 
-from scipy.ndimage import label, center_of_mass
+from scipy.ndimage import label, center_of_mass, find_objects
+from scipy.fft import next_fast_len
 
-from .common import generate_random_quaternions
+from .common import generate_random_quaternions, generate_super_fibonacci_quaternions, \
+    num_quaternions_for_resolution
+from .target_cache import TargetCache, target_cache_key
+from .lazy_volume import LazyVolume
+from .coords_reader import read_coordinates, read_atoms, atomic_numbers, SELECTION as COORDS_SELECTION
+from .file_loader import load_files, format_load_errors
+from .dataset_bundle import DatasetBundle, write_dataset_bundle
+from .fit_log import log_epochs_array, logged_rows
+from .molmap import molmap_batch, molmap_at_points, molmap_label, read_molmap_label, save_molmap
 
 from scipy.spatial.transform import Rotation as R
 
@@ -45,7 +58,7 @@ def q2_unit_coord(Q):
 
 
 def cluster_and_sort_sqd_fast(e_sqd_log, mol_centers, shift_tolerance: float = 3.0, angle_tolerance: float = 6.0,
-                              sort_column_idx: int = 7):
+                              sort_column_idx: int = 7, log_epochs=None):
     """
     Cluster the fitting results in sqd table by thresholding on shift and quaternion
     Return the sorted cluster representatives
@@ -66,6 +79,7 @@ def cluster_and_sort_sqd_fast(e_sqd_log, mol_centers, shift_tolerance: float = 3
     @param shift_tolerance: shift tolerance in Angstrom
     @param angle_tolerance: angle tolerance in degrees
     @param sort_column_idx: the column to sort, 9-th column is the correlation
+    @param log_epochs: the epoch of each record saved with the log, see fit_log.logged_rows()
     @return: cluster representative table sorted in descending order
     """
 
@@ -74,8 +88,10 @@ def cluster_and_sort_sqd_fast(e_sqd_log, mol_centers, shift_tolerance: float = 3
 
     N_mol, N_record, N_iter, N_metric = e_sqd_log.shape
 
-    sort_column_metric = e_sqd_log[:, :, 1:22, sort_column_idx]  # remove the 0 iteration, which is before optimization
-    max_sort_column_metric_idx = np.argmax(sort_column_metric, axis=-1) + 1  # add back 0 iteration
+    # the logged epochs, without the 0 iteration, which is before optimization
+    rows = logged_rows(N_iter, log_epochs)
+    sort_column_metric = e_sqd_log[:, :, rows, sort_column_idx]
+    max_sort_column_metric_idx = rows[np.argmax(sort_column_metric, axis=-1)]
 
     # Generate meshgrid for the dimensions you're not indexing through
     dims_0, dims_1 = np.meshgrid(
@@ -168,6 +184,23 @@ def generate_3d_gaussian_filter(size, std, device='cpu'):
     return gauss
 
 
+def generate_1d_gaussian_filter(size, std, device='cpu'):
+    """Generate a normalized 1D Gaussian filter, the outer product of three of them is the 3D Gaussian filter.
+
+    Args:
+        size (int): The size of the filter.
+        std (float): The standard deviation of the Gaussian distribution.
+        device (str): The device to store the tensor ('cpu' or 'cuda').
+
+    Returns:
+        torch.Tensor: A 1D Gaussian filter tensor.
+    """
+    axis = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2.0
+    gauss = torch.exp(-axis ** 2 / (2 * std ** 2))
+
+    return gauss / gauss.sum()
+
+
 def generate_3d_laplacian_filter(size, device='cpu'):
     """Generate a 3D Laplacian filter using PyTorch.
 
@@ -240,7 +273,8 @@ def loss_between_volumes(volume1, volume2):
 
 
 def numpy2tensor(np_array, device):
-    target = torch.tensor(np_array, device=device).float()
+    # np.asarray reads a LazyVolume
+    target = torch.tensor(np.asarray(np_array), device=device).float()
     target = target.to(device)
     target_dim = target.shape
     target = target.unsqueeze(dim=0).unsqueeze(dim=0)
@@ -275,25 +309,139 @@ def linear_norm_tensor(tensor, norm_sep: float = 0.0):
     return tensor
 
 
-def mrc_to_npy(mrc_filename):
+def mrc_to_npy(mrc_filename, lazy=False):
+    """
+    @param lazy: return the data as a LazyVolume, only the header is read here,
+                 the data of compressed files are read here all the same since they can not be memory mapped
+    @return: data as [z, y, x], steps, origin
+    """
+    if lazy:
+        volume = LazyVolume(mrc_filename)
+        if not volume.compressed:
+            return volume, volume.steps, volume.origin
+
     with mrcfile.open(mrc_filename, mode='r') as mrc:
-        data = mrc.data
+        # the data read by mrcfile, not a copy of it, it is read-only
+        data = np.asarray(mrc.data)
         steps = mrc.voxel_size.tolist()
         origin = mrc.header.origin.tolist()
     return data, steps, origin
 
 
-def mrc_folder_to_npy_list(mrc_folder):
-    sim_map_list = []
+def resample_factor(steps, resolution, voxels_per_resolution=3.0):
+    """Downsampling factor that brings the voxel size up to resolution / voxels_per_resolution,
+    e.g., 4 / 3 / 0.8 = 1.67 for a 4 angstrom map with 0.8 angstrom voxels
+
+    @param steps: voxel size
+    @param resolution: stated resolution of the map in angstrom, no resampling if None or 0
+    @return: the factor, not necessarily an integer, 1 if the map is not over-sampled
+    """
+    if not resolution:
+        return 1
 
-    for file_name in os.listdir(mrc_folder):
-        full_path = os.path.join(mrc_folder, file_name)
-        # Check if the current path is a file and not a directory
-        if os.path.isfile(full_path):
-            data, steps, origin = mrc_to_npy(full_path)
-            sim_map_list.append((data, steps, origin))
+    factor = resolution / voxels_per_resolution / max(steps)
+    if factor <= 1:
+        return 1
+    # an integer factor takes the exact block average in downsample_volume()
+    if np.isclose(factor, round(factor)):
+        return int(round(factor))
+    return float(factor)
 
-    return sim_map_list
+
+def area_weights(size, factor):
+    """Weights that average the voxels of one axis over windows of factor voxels
+
+    @param size: number of voxels along the axis
+    @param factor: window size in voxels, not necessarily an integer
+    @return: [size // factor, size] array, row i holds the overlap of each voxel with [i * factor, (i + 1) * factor)
+    """
+    new_size = int(size // factor)
+    starts = np.arange(new_size)[:, None] * factor
+    voxels = np.arange(size)[None, :]
+    overlap = np.minimum(voxels + 1, starts + factor) - np.maximum(voxels, starts)
+    return np.clip(overlap, 0, None) / factor
+
+
+def downsample_volume(volume_np, steps, origin, factor):
+    """Average a volume over windows of factor^3 voxels, the trailing voxels that do not fill a window are dropped
+
+    An integer factor average pools blocks of voxels, a non-integer factor averages over the area each new voxel
+    covers, i.e., the voxels on the window borders count with the fraction of them inside the window.
+
+    @param volume_np: [z, y, x] array
+    @param steps: voxel size in [z, y, x]
+    @param origin: origin in [x, y, z]
+    @param factor: downsampling factor, e.g., from resample_factor()
+    @return: volume, steps and origin of the downsampled volume, the origin moves to the center of the first window
+    """
+    if factor == 1:
+        return volume_np, steps, origin
+    if factor < 1:
+        raise ValueError(f"Downsampling factor {factor} is less than 1")
+
+    dim = [int(size // factor) for size in volume_np.shape]
+    if min(dim) == 0:
+        raise ValueError(f"Volume of shape {volume_np.shape} is too small to downsample by {factor}")
+
+    if float(factor).is_integer():
+        factor = int(factor)
+        blocks = np.asarray(volume_np[:dim[0] * factor, :dim[1] * factor, :dim[2] * factor]).reshape(
+            dim[0], factor, dim[1], factor, dim[2], factor)
+        volume = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    else:
+        volume = np.asarray(volume_np, dtype=np.float32)
+        # one axis at a time, the weights are separable
+        for axis, size in enumerate(volume.shape):
+            weights = area_weights(size, factor).astype(np.float32)
+            volume = np.moveaxis(np.tensordot(weights, volume, axes=([1], [axis])), 0, axis)
+        volume = np.ascontiguousarray(volume)
+
+    origin = [o + (factor - 1) / 2 * step for o, step in zip(origin, steps[::-1])]
+    steps = [step * factor for step in steps]
+
+    return volume, steps, origin
+
+
+def read_sim_map(mrc_filename, resolution=None, lazy=True):
+    data, steps, origin = mrc_to_npy(mrc_filename, lazy)
+    return downsample_volume(data, steps, origin, resample_factor(steps, resolution))
+
+
+def folder_file_paths(folder):
+    # the files of a folder in os.listdir() order, which the viewer pairs with the molecule indices
+    return [os.path.join(folder, file_name) for file_name in os.listdir(folder)
+            if os.path.isfile(os.path.join(folder, file_name))]
+
+
+def load_folder_files(load_file, folder, num_workers=None, use_processes=False, errors=None):
+    """Load all files of a folder with file_loader.load_files()
+
+    @param errors: list to add the (file path, error message) of the files that cannot be loaded to,
+                   these files are then None in the results, if None, a ValueError reporting all of them is raised
+    @return: list of the loaded files in folder_file_paths() order, one per file so the indices stay the ones
+             of folder_file_paths()
+    """
+    file_paths = folder_file_paths(folder)
+    results, load_errors = load_files(load_file, file_paths, num_workers, use_processes)
+
+    if load_errors:
+        if errors is None:
+            raise ValueError(f"Failed to load {len(load_errors)} file(s) in {folder}:\n"
+                             f"{format_load_errors(load_errors)}")
+        errors.extend(load_errors)
+
+    return results
+
+
+def mrc_folder_to_npy_list(mrc_folder, resolution=None, lazy=True, num_workers=None, errors=None):
+    """
+    @param resolution: if given, over-sampled maps are downsampled with resample_factor() and downsample_volume()
+    @param lazy: keep the data as LazyVolume, so that they are only read when a fit samples them
+    @param num_workers: number of threads reading the maps, see file_loader.load_files()
+    @param errors: see load_folder_files()
+    """
+    return load_folder_files(functools.partial(read_sim_map, resolution=resolution, lazy=lazy), mrc_folder,
+                             num_workers, errors=errors)
 
 
 def normalize_coordinates_to_map_origin(coordinates, box_size, box_origin=(0.0, 0.0, 0.0)):
@@ -332,8 +480,8 @@ def sample_sim_map(atom_coords_list, sim_map_list, num_molecules, device):
         sim_map_size_x_y_z_tensor = torch.tensor(sim_map_size_x_y_z, device=device).float()
         sim_map_origin_tensor = torch.tensor(sim_map_list[mol_idx][2], device=device).float()
 
-        atom_coords = torch.tensor(atom_coords_list[mol_idx], device=device).float().unsqueeze(0).unsqueeze(
-            0).unsqueeze(0)
+        atom_coords = torch.as_tensor(atom_coords_list[mol_idx], dtype=torch.float32,
+                                      device=device).unsqueeze(0).unsqueeze(0).unsqueeze(0)
         grid = normalize_coordinates_to_map_origin_torch(atom_coords,
                                                          sim_map_size_x_y_z_tensor,
                                                          sim_map_origin_tensor)
@@ -345,6 +493,23 @@ def sample_sim_map(atom_coords_list, sim_map_list, num_molecules, device):
     return elements_sim_density_list
 
 
+def atoms_reference_density(atom_coords_list, points_list, resolution, device, weights_list=None):
+    """The reference density at the given points of each molecule, like sample_sim_map(),
+    but evaluated from the molecule's atoms with molmap.molmap_at_points() instead of from its simulated map
+
+    The density is exact at the points, while sample_sim_map() interpolates the voxels with the engine's sampling
+    convention, so the quality metrics of the two are not interchangeable.
+
+    @param points_list: [N_points, 3] in [x, y, z] of each molecule, e.g., the atoms themselves or their beads
+    @param weights_list: weight of each atom of each molecule, e.g., coords_reader.atomic_numbers() like the
+                         simulated maps, the atoms weigh the same if None
+    """
+    if weights_list is None:
+        weights_list = [None] * len(atom_coords_list)
+    return [torch.as_tensor(molmap_at_points(atom_coords, points, resolution, weights), device=device)
+            for atom_coords, points, weights in zip(atom_coords_list, points_list, weights_list)]
+
+
 def transform_to_angstrom_space(ndc_shift, box_size, box_origin, atom_center_in_angstrom):
     # coordinates is in [x, y, z]
     # box_size is in [z, y, x]
@@ -353,7 +518,81 @@ def transform_to_angstrom_space(ndc_shift, box_size, box_origin, atom_center_in_
     return angstrom_space_shift
 
 
-def read_file_and_get_coordinates(file_path):
+def structure_npy_path(file_path, npy_dir):
+    # named like the outputs of convert2mrc_npy.py
+    return os.path.join(npy_dir, f"{os.path.basename(file_path).split('.')[0]}.npy")
+
+
+def structure_npy_meta_path(npy_path):
+    # the source and the atom selection of a .npy sidecar
+    return f"{os.path.splitext(npy_path)[0]}.json"
+
+
+def structure_npy_meta(file_path, selection=COORDS_SELECTION):
+    """What a .npy sidecar of file_path records to be loaded instead of the file
+
+    @param selection: the atoms the coords are of, e.g., coords_reader.SELECTION
+    @return: dict of the source size, the source modification time in ns and the selection
+    """
+    stat = os.stat(file_path)
+    return dict(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns, selection=selection)
+
+
+def read_structure_npy_meta(npy_path):
+    # None if the sidecar has no readable record, e.g., of an older convert2mrc_npy.py
+    try:
+        with open(structure_npy_meta_path(npy_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_structure_npy(npy_path, coordinates_array, meta):
+    # the record is written last, a sidecar whose record is missing or stale is not loaded
+    os.makedirs(os.path.dirname(npy_path) or ".", exist_ok=True)
+    tmp_path = f"{npy_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.save(f, coordinates_array)
+    os.replace(tmp_path, npy_path)
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, structure_npy_meta_path(npy_path))
+
+
+def read_file_and_get_coordinates(file_path, npy_dir=None):
+    """Read the atom coords of a .pdb or .cif file with the coordinate-only reader of coords_reader.py,
+    or with Bio.PDB if the file is too unusual for it
+
+    @param npy_dir: folder of .npy sidecars, a sidecar is loaded instead of the file if its .json record has the
+                    size and modification time of the file and the atom selection of the reader,
+                    otherwise the coords are saved to it, but not over a sidecar of another or an unknown selection,
+                    e.g., the chain residues of convert2mrc_npy.py
+    @return: atom coords as [N_atoms, 3] in [x, y, z]
+    """
+    if npy_dir is not None:
+        npy_path = structure_npy_path(file_path, npy_dir)
+        meta = structure_npy_meta(file_path)
+        saved_meta = read_structure_npy_meta(npy_path)
+        if saved_meta == meta and os.path.isfile(npy_path):
+            return np.load(npy_path)
+
+    try:
+        coordinates_array = read_coordinates(file_path)
+    except (ValueError, KeyError, IndexError):
+        coordinates_array = read_file_and_get_coordinates_biopython(file_path)
+
+    if npy_dir is not None and (not os.path.isfile(npy_path) or
+                                (saved_meta is not None and saved_meta.get("selection") == COORDS_SELECTION)):
+        try:
+            save_structure_npy(npy_path, coordinates_array, meta)
+        except OSError:
+            # e.g., a read-only dataset, the coords are just not cached
+            pass
+
+    return coordinates_array
+
+
+def read_file_and_get_coordinates_biopython(file_path):
     # Determine file extension
     file_extension = os.path.splitext(file_path)[1].lower()
 
@@ -388,10 +627,17 @@ def read_file_and_get_coordinates(file_path):
 
 
 def pad_and_convert_to_tensor(atom_coords_list, device):
+    """Pad the atom coords of all molecules to the same length and stack them into one tensor
+
+    @param atom_coords_list: list of [N_atoms, 3] arrays, one per molecule
+    @param device: the device to store the tensors
+    @return: atom coords as [N_mol, max_N_atoms, 3] and the per-atom validity mask as [N_mol, max_N_atoms]
+    """
     # Find the maximum length among all arrays
     max_length = max(len(coords) for coords in atom_coords_list)
 
     padded_list = []
+    mask_list = []
     for coords in atom_coords_list:
         # Calculate how much padding is needed
         padding_size = max_length - len(coords)
@@ -403,10 +649,185 @@ def pad_and_convert_to_tensor(atom_coords_list, device):
         # Convert the padded array to a torch tensor and add to the list
         padded_list.append(torch.tensor(padded_coords, device=device).float())
 
+        mask = torch.zeros(max_length, device=device)
+        mask[:len(coords)] = 1.0
+        mask_list.append(mask)
+
     # Stack all tensors into a higher-dimensional tensor
     atom_coords_tensor = torch.stack(padded_list)
+    atom_mask = torch.stack(mask_list)
+
+    return atom_coords_tensor, atom_mask
+
+
+def group_atoms_into_cells(atom_coords, cell_size):
+    """Group the atoms by the occupied cells of a cubic grid
+
+    @param atom_coords: [N_atoms, 3] array
+    @param cell_size: grid cell size in angstrom
+    @return: cell index of each atom as [N_atoms], number of atoms in each cell as [N_cells]
+             and the mean of the atoms in each cell as [N_cells, 3]
+    """
+    atom_coords = np.asarray(atom_coords, dtype=np.float64)
+    cells = np.floor(atom_coords / cell_size).astype(np.int64)
+    _, cell_idx = np.unique(cells, axis=0, return_inverse=True)
+    cell_idx = cell_idx.ravel()
+
+    num_cells = cell_idx.max() + 1
+    cell_counts = np.bincount(cell_idx, minlength=num_cells)
+    cell_means = np.stack([np.bincount(cell_idx, weights=atom_coords[:, axis], minlength=num_cells)
+                           for axis in range(3)], axis=-1) / cell_counts[:, None]
+
+    return cell_idx, cell_counts, cell_means
+
+
+def decimate_atoms(atom_coords, cell_size):
+    """Pick one representative atom per occupied cell of a cubic grid
+
+    @param atom_coords: [N_atoms, 3] array
+    @param cell_size: grid cell size in angstrom
+    @return: sorted indices of the atoms closest to the mean of the atoms in their cell
+    """
+    atom_coords = np.asarray(atom_coords, dtype=np.float64)
+    cell_idx, _, cell_means = group_atoms_into_cells(atom_coords, cell_size)
+    dist = np.linalg.norm(atom_coords - cell_means[cell_idx], axis=-1)
+
+    # order by cell, then by the distance to the cell mean, and take the first atom of each cell
+    order = np.lexsort((dist, cell_idx))
+    first_in_cell = np.ones(len(order), dtype=bool)
+    first_in_cell[1:] = cell_idx[order][1:] != cell_idx[order][:-1]
+
+    return np.sort(order[first_in_cell])
+
+
+def atoms_to_beads(atom_coords, bead_size):
+    """Coarse-grain the atoms into one bead per occupied cell of a cubic grid
+
+    A bead sits at the mean of the atoms in its cell and is weighted by their number,
+    so the weighted mean of the beads is the mean of the atoms.
+
+    @param atom_coords: [N_atoms, 3] array
+    @param bead_size: grid cell size in angstrom
+    @return: bead coords as [N_beads, 3] and bead weights as [N_beads], both float32
+    """
+    _, cell_counts, cell_means = group_atoms_into_cells(atom_coords, bead_size)
+
+    return cell_means.astype(np.float32), cell_counts.astype(np.float32)
+
+
+def bead_cache_dir(structures_dir):
+    # a folder next to the structures, like subunits_npy next to subunits_cif
+    return os.path.join(os.path.dirname(os.path.abspath(structures_dir)), "subunits_beads")
+
+
+def bead_cache_paths(structures_dir, bead_size, names=None):
+    """Bead cache file of each structure in the order of read_all_files_to_atom_coords_list()
+
+    @param names: the molecule names instead of the files in structures_dir, e.g., of a dataset bundle,
+                  whose path then takes the place of structures_dir
+    """
+    cache_dir = bead_cache_dir(structures_dir)
+    if names is None:
+        names = [os.path.splitext(file_name)[0] for file_name in os.listdir(structures_dir)
+                 if os.path.isfile(os.path.join(structures_dir, file_name))]
+    return [os.path.join(cache_dir, f"{name}_beads_{bead_size:g}.npz") for name in names]
+
+
+def load_or_compute_beads(atom_coords, bead_size, cache_path=None):
+    """Return the beads of atoms_to_beads(), loaded from cache_path if it holds the beads of these atoms
+
+    The cache file records the hash of the atom coords, so the beads are recomputed when the structure changes.
+
+    @param cache_path: .npz file to load the beads from and save them to, no caching if None
+    @return: bead coords as [N_beads, 3] and bead weights as [N_beads]
+    """
+    if cache_path is None:
+        return atoms_to_beads(atom_coords, bead_size)
+
+    coords_sha1 = AtomCoordsCache.coords_key(atom_coords)[0]
+    try:
+        with np.load(cache_path) as cached:
+            if str(cached["coords_sha1"]) == coords_sha1 and float(cached["bead_size"]) == float(bead_size):
+                return cached["coords"], cached["weights"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    bead_coords, bead_weights = atoms_to_beads(atom_coords, bead_size)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        np.savez(cache_path, coords=bead_coords, weights=bead_weights, bead_size=float(bead_size),
+                 coords_sha1=coords_sha1)
+    except OSError:
+        # e.g., a read-only dataset, the beads are just not cached
+        pass
+
+    return bead_coords, bead_weights
 
-    return atom_coords_tensor
+
+class AtomCoordsCache:
+    """Device-resident float32 copies of molecule atom coords
+
+    The coords are converted and uploaded once and keyed by their content and the device,
+    so that later epochs, repeated fits and the single fit tab reuse the same tensors
+    without a host-to-device copy or a dtype conversion.
+
+    The cache is bounded by the bytes of its tensors rather than by a number of entries, so that a fit of many
+    molecules, each with the coords of several atom levels and their padded batches, stays resident
+    instead of being evicted and uploaded again every epoch.
+    """
+
+    def __init__(self, max_bytes: int = 2 ** 31, max_entries: int = None):
+        """
+        @param max_bytes: the least recently used tensors are dropped beyond this many bytes,
+                          the last one is kept whatever its size
+        @param max_entries: also drop them beyond this many entries, no limit if None
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.num_bytes = 0
+        self._tensors = OrderedDict()
+
+    @staticmethod
+    def coords_key(atom_coords):
+        atom_coords = np.ascontiguousarray(atom_coords)
+        return hashlib.sha1(atom_coords.view(np.uint8)).hexdigest(), atom_coords.shape, atom_coords.dtype.str
+
+    @staticmethod
+    def tensor_bytes(value):
+        # a tensor or a tuple of tensors, e.g., the padded coords and their mask
+        tensors = value if isinstance(value, tuple) else (value,)
+        return sum(tensor.element_size() * tensor.nelement() for tensor in tensors)
+
+    def _lookup(self, key, create):
+        if key in self._tensors:
+            self._tensors.move_to_end(key)
+            return self._tensors[key]
+
+        value = create()
+        self._tensors[key] = value
+        self.num_bytes += self.tensor_bytes(value)
+        while len(self._tensors) > 1 and (self.num_bytes > self.max_bytes or
+                                          (self.max_entries is not None and len(self._tensors) > self.max_entries)):
+            _, evicted = self._tensors.popitem(last=False)
+            self.num_bytes -= self.tensor_bytes(evicted)
+        return value
+
+    def get(self, atom_coords, device):
+        """Return the atom coords as a float32 tensor on the device"""
+        if torch.is_tensor(atom_coords):
+            return atom_coords.to(device=device, dtype=torch.float32)
+
+        key = ("coords", self.coords_key(atom_coords), str(device))
+        return self._lookup(key, lambda: torch.tensor(atom_coords, device=device).float())
+
+    def get_padded(self, atom_coords_list, device):
+        """Return the result of pad_and_convert_to_tensor for the list of atom coords"""
+        key = ("padded", tuple(self.coords_key(coords) for coords in atom_coords_list), str(device))
+        return self._lookup(key, lambda: pad_and_convert_to_tensor(atom_coords_list, device))
+
+    def clear(self):
+        self._tensors.clear()
+        self.num_bytes = 0
 
 
 def quaternion_to_matrix_batch(quaternions):
@@ -435,7 +856,15 @@ def quaternion_to_matrix_batch(quaternions):
     return rotation_matrices
 
 
-def filter_volume(volume_np, threshold, min_island_size):
+def filter_volume(volume_np, threshold, min_island_size, in_place=False, return_stats=False):
+    """Keep only the islands above the threshold that are larger than min_island_size
+
+    @param in_place: zero the voxels outside the islands in volume_np itself instead of in a copy
+    @param return_stats: also return a dict of the island statistics, with labels, sizes, centers (in voxel
+                         indices), bboxes (tuples of slices) and voxels (the flat indices of the voxels of each
+                         island in its bbox), which take less memory than the labeled volume
+    @return: filtered_volume, eligible_volume, cluster_center_indices[, island_stats]
+    """
     # Step 1: Threshold the volume
     binary_volume = volume_np > threshold
 
@@ -452,36 +881,212 @@ def filter_volume(volume_np, threshold, min_island_size):
     eligible_volume = eligible_components[labeled_volume]
     eligible_labels = np.where(eligible_components)[0]
 
-    # Calculate the center of mass for eligible components
-    cluster_center_indices = []
-    for i in eligible_labels:
-        center = center_of_mass(labeled_volume == i, labels=labeled_volume, index=i)
-        cluster_center_indices.append(center)
+    # Calculate the center of mass for all eligible components in one pass
+    if len(eligible_labels) > 0:
+        cluster_center_indices = center_of_mass(binary_volume, labels=labeled_volume, index=eligible_labels)
+    else:
+        cluster_center_indices = []
 
     # Filter the original volume to retain only the voxels in eligible clusters
-    filtered_volume = np.zeros_like(volume_np)
-    filtered_volume[eligible_volume] = volume_np[eligible_volume]
+    if in_place:
+        filtered_volume = volume_np
+        filtered_volume[~eligible_volume] = 0
+    else:
+        filtered_volume = np.where(eligible_volume, volume_np, volume_np.dtype.type(0))
 
-    return filtered_volume, eligible_volume, cluster_center_indices
+    if not return_stats:
+        return filtered_volume, eligible_volume, cluster_center_indices
 
+    # bounding boxes of all components in one pass
+    bboxes = find_objects(labeled_volume)
+    bboxes = [bboxes[i - 1] for i in eligible_labels]
+    island_stats = dict(labels=eligible_labels,
+                        sizes=component_sizes[eligible_labels],
+                        centers=np.array(cluster_center_indices).reshape(-1, 3),
+                        bboxes=bboxes,
+                        voxels=[np.flatnonzero(labeled_volume[bbox] == island_label).astype(np.uint32)
+                                for bbox, island_label in zip(bboxes, eligible_labels)])
 
-def random_sample_indices(binary_volume, sample_size):
-    # Find indices of eligible voxels
-    eligible_indices = np.where(binary_volume)
-    eligible_indices_list = list(zip(*eligible_indices))
+    return filtered_volume, eligible_volume, cluster_center_indices, island_stats
 
-    # Step 4: Sample from eligible voxels
-    if len(eligible_indices_list) > sample_size:
-        sampled_indices = np.random.choice(len(eligible_indices_list), size=sample_size, replace=False)
-        sampled_indices = [eligible_indices_list[i] for i in sampled_indices]
-    else:
-        sampled_indices = eligible_indices_list  # If less than desired sample size, take all
 
-    return sampled_indices
+def eligible_bounding_box(eligible_volume, margin):
+    """Bounding box of the eligible voxels, grown by margin voxels on each side and clipped to the volume
+
+    @return: tuple of slices in [z, y, x], the full volume if no voxel is eligible
+    """
+    if not eligible_volume.any():
+        return tuple(slice(0, dim) for dim in eligible_volume.shape)
+
+    crop = []
+    for axis, dim in enumerate(eligible_volume.shape):
+        other_axes = tuple(other for other in range(eligible_volume.ndim) if other != axis)
+        occupied = np.flatnonzero(eligible_volume.any(axis=other_axes))
+        crop.append(slice(max(0, occupied[0] - margin), min(dim, occupied[-1] + 1 + margin)))
+
+    return tuple(crop)
+
+
+def crop_island_stats(island_stats, crop):
+    """Island statistics from filter_volume() in the voxel indices of volume[crop]"""
+    crop_start = np.array([axis_slice.start for axis_slice in crop])
+
+    return dict(labels=island_stats["labels"],
+                sizes=island_stats["sizes"],
+                centers=island_stats["centers"] - crop_start,
+                bboxes=[tuple(slice(axis_slice.start - start, axis_slice.stop - start)
+                              for axis_slice, start in zip(bbox, crop_start))
+                        for bbox in island_stats["bboxes"]],
+                voxels=island_stats["voxels"])
+
+
+def eligible_ranks_to_indices(binary_volume, ranks):
+    # [z, y, x] indices of the eligible voxels with the given ranks in C order,
+    # looked up one z slice at a time so the full list of eligible voxels is never built
+    ranks = np.asarray(ranks, dtype=np.int64)
+    slice_ends = np.cumsum(binary_volume.reshape(binary_volume.shape[0], -1).sum(axis=1))
+    slice_idx = np.searchsorted(slice_ends, ranks, side='right')
+
+    indices = np.empty((len(ranks), 3), dtype=np.int64)
+    for z in np.unique(slice_idx):
+        in_slice = slice_idx == z
+        slice_start = slice_ends[z - 1] if z > 0 else 0
+        flat_in_slice = np.flatnonzero(binary_volume[z])[ranks[in_slice] - slice_start]
+        indices[in_slice, 0] = z
+        indices[in_slice, 1:] = np.stack(np.unravel_index(flat_in_slice, binary_volume.shape[1:]), axis=-1)
+
+    return indices
+
+
+def allocate_samples(weights, sample_size):
+    # split sample_size in proportion to the weights, by the largest remainder
+    weights = np.asarray(weights, dtype=np.float64)
+    share = sample_size * weights / weights.sum()
+    samples = np.floor(share).astype(np.int64)
+    leftover = sample_size - samples.sum()
+    samples[np.argsort(-(share - samples), kind='stable')[:leftover]] += 1
+
+    return samples
+
+
+def sample_island_voxels(island_stats, island_idx, sample_size):
+    # [z, y, x] indices of random voxels of one island, only its bounding box is searched
+    bbox = island_stats["bboxes"][island_idx]
+    flat_in_bbox = island_stats["voxels"][island_idx]
+    picked = np.random.choice(len(flat_in_bbox), size=sample_size, replace=sample_size > len(flat_in_bbox))
+    bbox_indices = np.stack(np.unravel_index(flat_in_bbox[picked], [b.stop - b.start for b in bbox]), axis=-1)
+
+    return bbox_indices + [b.start for b in bbox]
+
+
+def island_seed_indices(island_stats, num_atoms, voxel_volume, sample_size, atom_volume=16.0, min_fill=0.5):
+    """Seed shifts in the islands that can hold the molecule
+
+    Islands get seeds in proportion to their volume times how well they match the molecule size.
+    Islands smaller than min_fill of the estimated molecule volume get none.
+    The first seed of an island is its center, the others are random voxels of it.
+
+    @param num_atoms: number of atoms of the molecule
+    @param voxel_volume: volume of a voxel in cubic angstrom
+    @param atom_volume: estimated molecule volume per atom in cubic angstrom
+    @return: [sample_size, 3] float array of [z, y, x] indices
+    """
+    sizes = np.asarray(island_stats["sizes"], dtype=np.float64)
+    mol_voxels = num_atoms * atom_volume / voxel_volume
+
+    size_match = np.minimum(sizes / mol_voxels, 1.0)
+    weights = np.where(size_match >= min_fill, sizes * size_match, 0.0)
+    if weights.sum() == 0:
+        # no island can hold the molecule, most likely the size estimate is off
+        weights = sizes
+
+    island_samples = allocate_samples(weights, sample_size)
+
+    sampled_indices = []
+    for island_idx in np.flatnonzero(island_samples):
+        sampled_indices.append(np.asarray(island_stats["centers"][island_idx]).reshape(1, 3))
+        if island_samples[island_idx] > 1:
+            sampled_indices.append(sample_island_voxels(island_stats, island_idx, island_samples[island_idx] - 1))
+
+    return np.concatenate(sampled_indices).astype(np.float64)
+
+
+def random_sample_indices(binary_volume, sample_size, mode="uniform", density=None, island_stats=None):
+    """Sample voxels of the eligible volume as shift seeds
+
+    @param mode: "uniform" over all eligible voxels, "density" weighted by the density,
+                 or "stratified" to spread the seeds over all islands
+    @param density: [z, y, x] array of the weights for the "density" mode
+    @param island_stats: island statistics from filter_volume() for the "stratified" mode
+    @return: [N, 3] int array of [z, y, x] indices, all eligible voxels if there are less than sample_size
+    """
+    num_eligible = int(np.count_nonzero(binary_volume))
+    if num_eligible <= sample_size:
+        # If less than desired sample size, take all
+        return eligible_ranks_to_indices(binary_volume, np.arange(num_eligible))
+
+    if mode == "uniform":
+        sampled_ranks = np.random.choice(num_eligible, size=sample_size, replace=False)
+        return eligible_ranks_to_indices(binary_volume, sampled_ranks)
+
+    elif mode == "density":
+        if density is None:
+            raise ValueError("density is needed for the 'density' mode")
+
+        # weighted sampling without replacement (Efraimidis-Spirakis), keep the sample_size largest keys
+        best_keys = np.empty(0)
+        best_indices = np.empty((0, 3), dtype=np.int64)
+        for z in range(binary_volume.shape[0]):
+            flat_in_slice = np.flatnonzero(binary_volume[z])
+            if len(flat_in_slice) == 0:
+                continue
+            weights = np.clip(np.asarray(density[z]).ravel()[flat_in_slice], 0.0, None)
+            with np.errstate(divide='ignore'):
+                keys = np.log(np.random.random(len(flat_in_slice))) / weights
+            slice_indices = np.column_stack([np.full(len(flat_in_slice), z),
+                                             *np.unravel_index(flat_in_slice, binary_volume.shape[1:])])
+
+            best_keys = np.concatenate([best_keys, keys])
+            best_indices = np.concatenate([best_indices, slice_indices])
+            if len(best_keys) > sample_size:
+                keep = np.argpartition(-best_keys, sample_size)[:sample_size]
+                best_keys, best_indices = best_keys[keep], best_indices[keep]
+
+        return best_indices[np.argsort(-best_keys, kind='stable')]
+
+    elif mode == "stratified":
+        if island_stats is None:
+            raise ValueError("island_stats is needed for the 'stratified' mode")
+
+        sizes = np.asarray(island_stats["sizes"])
+        island_order = np.argsort(-sizes, kind='stable')
+        num_islands = len(sizes)
+
+        # one seed for each island, the largest islands first, the rest in proportion to the island sizes
+        island_samples = np.zeros(num_islands, dtype=np.int64)
+        island_samples[island_order[:min(sample_size, num_islands)]] = 1
+        remaining = sample_size - island_samples.sum()
+        if remaining > 0:
+            island_samples += allocate_samples(sizes, remaining)
+        island_samples = np.minimum(island_samples, sizes)
+
+        # the seeds that tiny islands cannot take go to the islands with voxels to spare
+        shortfall = sample_size - island_samples.sum()
+        spare = sizes - island_samples
+        if shortfall > 0 and spare.sum() > 0:
+            island_samples += np.minimum(allocate_samples(spare, min(shortfall, spare.sum())), spare)
+
+        sampled_indices = np.concatenate([sample_island_voxels(island_stats, island_idx, island_samples[island_idx])
+                                          for island_idx in np.flatnonzero(island_samples)])
+        assert len(sampled_indices) == sample_size, (len(sampled_indices), sample_size)
+        return sampled_indices
+
+    raise ValueError(f"Unknown mode: {mode}, should be 'uniform', 'density' or 'stratified'")
 
 
 def transform_coords(atom_coords, e_quaternions, e_shifts, target_size_x_y_z_tensor, target_origin_tensor, device):
-    atom_coords = torch.tensor(atom_coords, device=device).float()
+    # no copy if atom_coords is already a float32 tensor on the device, e.g., from AtomCoordsCache
+    atom_coords = torch.as_tensor(atom_coords, dtype=torch.float32, device=device)
 
     e_rotation_matrices = quaternion_to_matrix_batch(e_quaternions)
 
@@ -498,24 +1103,127 @@ def transform_coords(atom_coords, e_quaternions, e_shifts, target_size_x_y_z_ten
     return atom_coords_normalized_to_target
 
 
+def transform_coords_batch(atom_coords_tensor, e_quaternions, e_shifts, target_size_x_y_z_tensor,
+                           target_origin_tensor):
+    """Transform the padded atom coords of all molecules by all their candidate transformations at once
+
+    @param atom_coords_tensor: padded atom coords as [N_mol, N_atoms, 3]
+    @param e_quaternions: quaternions as [N_mol, N_quat, N_shift, 4]
+    @param e_shifts: shifts as [N_mol, N_quat, N_shift, 3]
+    @return: sampling grid as [1, N_mol, N_quat * N_shift, N_atoms, 3]
+    """
+    num_molecules = e_quaternions.shape[0]
+
+    e_rotation_matrices = quaternion_to_matrix_batch(e_quaternions.reshape(num_molecules, -1, 4))
+
+    transformed_coords = torch.matmul(atom_coords_tensor.unsqueeze(1), e_rotation_matrices)
+
+    transformed_coords = transformed_coords + e_shifts.reshape(num_molecules, -1, 1, 3)
+
+    atom_coords_normalized_to_target = normalize_coordinates_to_map_origin_torch(transformed_coords,
+                                                                                 target_size_x_y_z_tensor,
+                                                                                 target_origin_tensor)
+
+    return atom_coords_normalized_to_target.unsqueeze(0)
+
+
+def sample_volume_batch(volume, grid, candidate_shape):
+    """Sample all the channels of the volume at a grid from transform_coords_batch
+
+    @return: sampled density as [N_channels, N_mol, N_quat, N_shift, N_atoms]
+    """
+    render = torch.nn.functional.grid_sample(volume, grid, 'bilinear', 'border', align_corners=True)
+    return render.view(volume.shape[1], *candidate_shape, -1)
+
+
+def gaussian_blur_separable(volume_pad, filter_1d):
+    # three 1D passes along z, y and x, same as one dense conv3d with the outer product of filter_1d
+    # each pass is a weighted sum of shifted views, which is much faster than conv3d with a thin kernel
+    size = filter_1d.shape[0]
+    weights = filter_1d.tolist()
+    volume_conv = volume_pad
+    for dim in (2, 3, 4):
+        out_len = volume_conv.shape[dim] - size + 1
+        volume_pass = volume_conv.narrow(dim, 0, out_len) * weights[0]
+        for offset in range(1, size):
+            volume_pass.add_(volume_conv.narrow(dim, offset, out_len), alpha=weights[offset])
+        volume_conv = volume_pass
+
+    return volume_conv
+
+
+def gaussian_blur_fft(volume_pad, filter_1d):
+    # circular convolution on the padded volume, the cropped result is the same as the valid conv3d
+    size = filter_1d.shape[0]
+    volume_shape = volume_pad.shape[2:]
+
+    volume_fft = torch.fft.rfftn(volume_pad, s=volume_shape, dim=(2, 3, 4))
+    filter_fft_z = torch.fft.fft(filter_1d, n=volume_shape[0]).view(-1, 1, 1)
+    filter_fft_y = torch.fft.fft(filter_1d, n=volume_shape[1]).view(1, -1, 1)
+    filter_fft_x = torch.fft.rfft(filter_1d, n=volume_shape[2]).view(1, 1, -1)
+    volume_conv = torch.fft.irfftn(volume_fft * (filter_fft_z * filter_fft_y * filter_fft_x),
+                                   s=volume_shape, dim=(2, 3, 4))
+
+    return volume_conv[:, :, size - 1:, size - 1:, size - 1:].contiguous()
+
+
 def conv_volume(volume, device, conv_loops, kernel_sizes,
-                negative_space_value, kernel_type="Gaussian"):
+                negative_space_value, kernel_type="Gaussian", backend="auto", pyramid="chained",
+                fft_kernel_size=31):
+    """Smooth the volume conv_loops times
+
+    @param volume: volume as [1, 1, z, y, x] tensor
+    @param backend: "dense" conv3d, "separable" 1D passes, "fft", or "auto" to use the separable passes
+                    and switch to FFT for kernels of size fft_kernel_size and up. Laplacian is always dense.
+    @param pyramid: "chained" smooths each level from the previous one,
+                    "direct" smooths each level from the volume with the combined Gaussian of the chain, which only
+                    approximates "chained": the chain clamps the negative voxels to negative_space_value and
+                    truncates the kernels at every level, the combined Gaussian does neither in between
+    @return: list of the volume followed by the conv_loops smoothed copies
+    """
+    if backend not in ("auto", "dense", "separable", "fft"):
+        raise ValueError(f"Unknown backend: {backend}, should be 'auto', 'dense', 'separable' or 'fft'")
+    if pyramid not in ("chained", "direct"):
+        raise ValueError(f"Unknown pyramid: {pyramid}, should be 'chained' or 'direct'")
+
+    std = 1.0
     volume_conv_list = [None] * (conv_loops + 1)
     volume_conv_list[0] = volume
     for conv_idx in range(1, conv_loops + 1):
 
-        if kernel_type == "Gaussian":
-            filter = generate_3d_gaussian_filter(kernel_sizes[conv_idx - 1], 1.0, device)
-        elif kernel_type == "Laplacian":
-            filter = generate_3d_laplacian_filter(kernel_sizes[conv_idx - 1], device)
-
-        filter_padding = compute_padding(filter.shape)
-        filter.unsqueeze_(0).unsqueeze_(0)
-
-        volume_pad = F.pad(volume_conv_list[conv_idx - 1], filter_padding, mode="reflect")
-        volume_conv = F.conv3d(volume_pad, filter)
-
-        eligible_volume_tensor = volume_conv > 0.0
+        if pyramid == "chained" or kernel_type != "Gaussian":
+            volume_in = volume_conv_list[conv_idx - 1]
+            kernel_size = kernel_sizes[conv_idx - 1]
+            kernel_std = std
+        else:
+            # the chain of Gaussians would be a Gaussian with the summed variance and the summed support,
+            # without the clamping and truncation between the levels of the chain, so this is an approximation
+            volume_in = volume
+            kernel_size = sum(kernel_sizes[:conv_idx]) - conv_idx + 1
+            kernel_std = std * math.sqrt(conv_idx)
+
+        filter_padding = compute_padding((kernel_size, kernel_size, kernel_size))
+        volume_pad = F.pad(volume_in, filter_padding, mode="reflect")
+
+        if kernel_type == "Gaussian" and backend != "dense":
+            filter_1d = generate_1d_gaussian_filter(kernel_size, kernel_std, device)
+            if backend == "fft" or (backend == "auto" and kernel_size >= fft_kernel_size):
+                volume_conv = gaussian_blur_fft(volume_pad, filter_1d)
+            else:
+                volume_conv = gaussian_blur_separable(volume_pad, filter_1d)
+        else:
+            if kernel_type == "Gaussian":
+                filter = generate_3d_gaussian_filter(kernel_size, kernel_std, device)
+            elif kernel_type == "Laplacian":
+                filter = generate_3d_laplacian_filter(kernel_size, device)
+
+            filter.unsqueeze_(0).unsqueeze_(0)
+            volume_conv = F.conv3d(volume_pad, filter)
+
+        # the FFT and the separable passes leave round-off where the exact convolution is 0, which must not flip
+        # these voxels to positive, so values within the round-off of the kernel and the volume count as 0
+        tolerance = kernel_size * torch.finfo(volume_conv.dtype).eps * float(volume_in.abs().max())
+        eligible_volume_tensor = volume_conv > tolerance
         volume_conv[~eligible_volume_tensor] = negative_space_value
 
         volume_conv_list[conv_idx] = volume_conv
@@ -523,27 +1231,345 @@ def conv_volume(volume, device, conv_loops, kernel_sizes,
     return volume_conv_list
 
 
-def add_conv_density(conv_loops, conv_list, conv_weights, grid, occupied_density_sum_mol):
-    if conv_loops > 0:
-        for conv_idx in range(1, conv_loops + 1):
-            render_conv = torch.nn.functional.grid_sample(conv_list[conv_idx], grid, 'bilinear',
-                                                          'border',
-                                                          align_corners=True)
-            occupied_density_sum_mol += torch.sum(render_conv * conv_weights[conv_idx - 1], dim=-1).squeeze()
+def stack_volume_channels(target, conv_list, conv_loops):
+    """Stack the target and its smoothed copies into one multi-channel volume as [1, 1 + conv_loops, z, y, x],
+    so that all of them are sampled by a single grid_sample call
+    """
+    return torch.cat([target] + list(conv_list[1:conv_loops + 1]), dim=1)
+
+
+def add_conv_density(render_channels, channel_weights, occupied_density_sum_mol):
+    """Add the weighted density sampled from the smoothed channels (all but channel 0)
+
+    @param render_channels: density sampled from stack_volume_channels as [1, N_channels, ..., N_atoms]
+    @param channel_weights: conv weights as [N_channels], channel 0 is not used here
+    """
+    if render_channels.shape[1] > 1:
+        conv_density_sum = torch.sum(render_channels[:, 1:], dim=-1)
+        conv_weights = channel_weights[1:].view(1, -1, *([1] * (conv_density_sum.dim() - 2)))
+        occupied_density_sum_mol += torch.sum(conv_density_sum * conv_weights, dim=1).view_as(occupied_density_sum_mol)
+
+
+def forward_molecules_batch(target_channels, channel_weights,
+                            atom_coords_tensor, atom_mask, elements_sim_density_tensor,
+                            e_quaternions, e_shifts, target_size_x_y_z_tensor, target_origin_tensor,
+                            compute_metrics: bool = True):
+    """Evaluate every molecule x quaternion x shift candidate in one sampling and reduction pass
+
+    Padded atoms are excluded from all the sums by atom_mask,
+    so the results are the same as evaluating the molecules one by one.
+    A weighted mask, e.g., the bead weights from atoms_to_beads(), makes the occupied density a weighted mean.
+    The quality metrics do not contribute to the loss, they are only computed (without gradients)
+    when compute_metrics is True, otherwise None is returned for them.
+
+    @param target_channels: target and its smoothed copies from stack_volume_channels
+    @param channel_weights: weight of each channel in the occupied density as [N_channels]
+    @param atom_coords_tensor: padded atom coords as [N_mol, N_atoms, 3]
+    @param atom_mask: per-atom validity mask or per-atom weights (0 for padding) as [N_mol, N_atoms]
+    @param elements_sim_density_tensor: padded simulated density at each atom as [N_mol, N_atoms]
+    @return: occupied_density_sum, first_layer_positive_density_sum, each as [N_mol, N_quat, N_shift],
+             and metrics_table as [N_mol, N_quat, N_shift, 4]
+    """
+    candidate_shape = e_shifts.shape[:-1]
+    atom_mask = atom_mask.view(atom_mask.shape[0], *([1] * (len(candidate_shape) - 1)), -1)
+    num_atoms = atom_mask.sum(dim=-1)
 
+    grid = transform_coords_batch(atom_coords_tensor, e_quaternions, e_shifts,
+                                  target_size_x_y_z_tensor, target_origin_tensor)
+    render_channels = sample_volume_batch(target_channels, grid, candidate_shape)
 
-def read_all_files_to_atom_coords_list(structures_dir):
-    atom_coords_list = []
-    # List all files in the given directory
-    for file_name in os.listdir(structures_dir):
-        full_path = os.path.join(structures_dir, file_name)
-        # Check if the current path is a file and not a directory
-        if os.path.isfile(full_path):
-            # Read the atom coordinates from the file
-            atom_coords = read_file_and_get_coordinates(full_path)
-            # Append the coordinates to the list
-            atom_coords_list.append(atom_coords)
-    return atom_coords_list
+    render_channels = render_channels * atom_mask
+
+    # conv_weights applied as a reduction over the channels
+    occupied_density_sum = torch.tensordot(channel_weights, torch.sum(render_channels, dim=-1), dims=1)
+    occupied_density_sum = occupied_density_sum / num_atoms
+
+    if not compute_metrics:
+        return occupied_density_sum, None, None
+
+    with torch.no_grad():
+        render = render_channels[0]
+        metrics_table = calculate_metrics(render, elements_sim_density_tensor.view(atom_mask.shape), atom_mask > 0)
+        first_layer_positive_density_sum = torch.sum(render * (render > 0), dim=-1)
+
+    return occupied_density_sum, first_layer_positive_density_sum, metrics_table
+
+
+def available_memory_bytes(device):
+    """Free memory on the device, or None if it cannot be queried"""
+    if str(device).startswith("cuda"):
+        free_memory, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free_memory
+
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    # without psutil, from the OS: MemAvailable on Linux, which counts the reclaimable caches, else the free pages
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# memory budget of the candidate chunks when the free memory cannot be queried
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def plan_candidate_chunks(num_molecules, num_candidates, max_num_atoms, num_channels,
+                          max_memory_mb: float = None, device="cpu"):
+    """Pick how many molecules and candidates forward_backward_batch evaluates at once
+
+    The estimate counts the float32 tensors kept per candidate and atom for the backward pass:
+    the transformed coords and the sampling grid (3 floats each, for a few intermediate steps)
+    and the sampled density of every channel, plus the temporaries of calculate_metrics() on the metric epochs.
+
+    @param max_memory_mb: memory budget, half of the free memory on the device if None,
+                          DEFAULT_MEMORY_BUDGET_MB if that cannot be queried
+    @return: molecule_chunk_size, candidate_chunk_size
+    """
+    if max_memory_mb is None:
+        available_memory = available_memory_bytes(device)
+        if available_memory is None:
+            warnings.warn(f"Cannot query the free memory on {device}, "
+                          f"chunking the candidates for a {DEFAULT_MEMORY_BUDGET_MB} MB budget, "
+                          f"set max_memory_mb to change it")
+            memory_budget = DEFAULT_MEMORY_BUDGET_MB * 1024 ** 2
+        else:
+            memory_budget = available_memory / 2
+    else:
+        memory_budget = max_memory_mb * 1024 ** 2
+
+    # about 10 floats per atom for the masked, centered and normalized densities of calculate_metrics()
+    bytes_per_atom = 4 * (2 * (4 * 3 + 3 * num_channels) + 10)
+    bytes_per_candidate = bytes_per_atom * max_num_atoms
+    candidates_per_chunk = max(1, int(memory_budget // bytes_per_candidate))
+
+    if candidates_per_chunk >= num_candidates:
+        return max(1, min(num_molecules, candidates_per_chunk // num_candidates)), num_candidates
+
+    return 1, candidates_per_chunk
+
+
+def forward_backward_batch(target_channels, channel_weights,
+                           atom_coords_tensor, atom_mask, elements_sim_density_tensor,
+                           e_quaternions, e_shifts, target_size_x_y_z_tensor, target_origin_tensor,
+                           molecule_chunk_size, candidate_chunk_size, compute_metrics: bool = True):
+    """Run forward_molecules_batch chunk by chunk and accumulate the gradients of the loss
+
+    The candidates are independent and the loss is a sum over them,
+    so the gradients accumulated over the chunks are the same as from a single pass.
+
+    @return: occupied_density_sum, first_layer_positive_density_sum, metrics_table (detached, None if not computed)
+             and the loss
+    """
+    num_molecules = e_shifts.shape[0]
+    candidate_shape = e_shifts.shape[:-1]
+    device = e_shifts.device
+
+    e_shifts_flat = e_shifts.view(num_molecules, -1, 1, 3)
+    e_quaternions_flat = e_quaternions.view(num_molecules, -1, 1, 4)
+    num_candidates = e_shifts_flat.shape[1]
+
+    occupied_density_sum = torch.zeros([num_molecules, num_candidates, 1], device=device)
+    if compute_metrics:
+        first_layer_positive_density_sum = torch.zeros([num_molecules, num_candidates, 1], device=device)
+        metrics_table = torch.zeros([num_molecules, num_candidates, 1, 4], device=device)
+    loss = torch.zeros([], device=device)
+
+    for mol_start in range(0, num_molecules, molecule_chunk_size):
+        mol_end = min(mol_start + molecule_chunk_size, num_molecules)
+
+        # the padding only needs to cover the largest molecule in the chunk
+        num_atoms_chunk = int((atom_mask[mol_start:mol_end] > 0).sum(dim=-1).max())
+        atom_coords_chunk = atom_coords_tensor[mol_start:mol_end, :num_atoms_chunk]
+        atom_mask_chunk = atom_mask[mol_start:mol_end, :num_atoms_chunk]
+        elements_sim_density_chunk = elements_sim_density_tensor[mol_start:mol_end, :num_atoms_chunk]
+
+        for candidate_start in range(0, num_candidates, candidate_chunk_size):
+            candidate_end = min(candidate_start + candidate_chunk_size, num_candidates)
+            chunk = (slice(mol_start, mol_end), slice(candidate_start, candidate_end))
+
+            occupied_density_sum_chunk, first_layer_chunk, metrics_chunk = forward_molecules_batch(
+                target_channels, channel_weights,
+                atom_coords_chunk, atom_mask_chunk, elements_sim_density_chunk,
+                e_quaternions_flat[chunk], e_shifts_flat[chunk], target_size_x_y_z_tensor, target_origin_tensor,
+                compute_metrics=compute_metrics)
+
+            loss_chunk = -torch.sum(occupied_density_sum_chunk)
+            loss_chunk.backward()
+
+            loss += loss_chunk.detach()
+            occupied_density_sum[chunk] = occupied_density_sum_chunk.detach()
+            if compute_metrics:
+                first_layer_positive_density_sum[chunk] = first_layer_chunk
+                metrics_table[chunk] = metrics_chunk
+
+    occupied_density_sum = occupied_density_sum.view(candidate_shape)
+    if not compute_metrics:
+        return occupied_density_sum, None, None, loss
+
+    return (occupied_density_sum, first_layer_positive_density_sum.view(candidate_shape),
+            metrics_table.view(*candidate_shape, 4), loss)
+
+
+def read_all_files_to_atom_coords_list(structures_dir, npy_dir=None, num_workers=None, use_processes=False,
+                                       errors=None):
+    """
+    @param npy_dir: folder of .npy sidecars for read_file_and_get_coordinates()
+    @param num_workers, use_processes: the pool reading the files, see file_loader.load_files(),
+                                       the structures are parsed in Python, threads only overlap reading the files
+                                       since the parsing holds the GIL, processes parse them in parallel
+    @param errors: see load_folder_files()
+    """
+    return load_folder_files(functools.partial(read_file_and_get_coordinates, npy_dir=npy_dir), structures_dir,
+                             num_workers, use_processes, errors)
+
+
+def read_atom_weights_list(file_paths, atom_coords_list, num_workers=None, use_processes=False):
+    """Atomic number of each atom of each structure, the reference_weights of FitEngine.fit()
+    that weigh the atoms like the simulated maps
+
+    @param file_paths: structure file of each molecule
+    @param atom_coords_list: atom coords of each molecule the weights are for
+    @param num_workers, use_processes: see read_all_files_to_atom_coords_list()
+    @return: list of [N_atoms] float32 arrays, None for a molecule whose file cannot be read with coords_reader.py
+             or whose atoms are not the ones in atom_coords_list, which then weigh the same, with a warning
+    """
+    atoms_list, _ = load_files(read_atoms, file_paths, num_workers, use_processes)
+    weights_list = [atomic_numbers(atoms[1])
+                    if atoms is not None and atoms[0].shape == np.shape(atom_coords)
+                    and np.allclose(atoms[0], atom_coords, atol=1e-3) else None
+                    for atoms, atom_coords in zip(atoms_list, atom_coords_list)]
+    warn_equal_weights(file_paths, weights_list)
+    return weights_list
+
+
+def warn_equal_weights(names, weights_list):
+    # the reference density of these molecules differs from their simulated maps
+    unweighted = [str(name) for name, weights in zip(names, weights_list) if weights is None]
+    if unweighted:
+        warnings.warn(f"No atomic numbers for {len(unweighted)} molecule(s), their atoms weigh the same in the "
+                      f"reference density: {', '.join(unweighted)}")
+
+
+def molmap_cache_dir(structures_dir):
+    # a folder next to the structures, apart from the subunits_mrc maps of ChimeraX
+    return os.path.join(os.path.dirname(os.path.abspath(structures_dir)), "subunits_molmap")
+
+
+def simulate_sim_maps(structures_dir, resolution, grid_spacing=None, cache_dir=None, num_workers=None,
+                      device="cpu"):
+    """Simulated map of each structure in a folder, computed with molmap.molmap_batch() in one pass
+
+    The maps are saved to cache_dir as <name>.mrc, like convert2mrc_npy.py does,
+    and loaded from there as long as they were computed from the same atoms and parameters.
+
+    @param grid_spacing: voxel size in angstrom, resolution / 3 if None
+    @param cache_dir: folder of the cached maps, molmap_cache_dir() if None
+    @return: list of (data, steps, origin) in the order of read_all_files_to_atom_coords_list()
+    """
+    if grid_spacing is None:
+        grid_spacing = resolution / 3
+    if cache_dir is None:
+        cache_dir = molmap_cache_dir(structures_dir)
+
+    file_paths = folder_file_paths(structures_dir)
+    atoms_list, errors = load_files(read_atoms, file_paths, num_workers)
+    if errors:
+        raise ValueError(f"Failed to load {len(errors)} file(s):\n{format_load_errors(errors)}")
+
+    weights_list = [atomic_numbers(elements) for _, elements in atoms_list]
+    labels = [molmap_label(atom_coords, weights, resolution, grid_spacing)
+              for (atom_coords, _), weights in zip(atoms_list, weights_list)]
+    cache_paths = [os.path.join(cache_dir, f"{os.path.basename(file_path).split('.')[0]}.mrc")
+                   for file_path in file_paths]
+
+    sim_map_list = [mrc_to_npy(cache_path, lazy=True) if read_molmap_label(cache_path) == label else None
+                    for cache_path, label in zip(cache_paths, labels)]
+
+    missing = [mol_idx for mol_idx, sim_map in enumerate(sim_map_list) if sim_map is None]
+    if missing:
+        computed = molmap_batch([atoms_list[mol_idx][0] for mol_idx in missing], resolution, grid_spacing,
+                                [weights_list[mol_idx] for mol_idx in missing], device=device)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for mol_idx, sim_map in zip(missing, computed):
+                save_molmap(cache_paths[mol_idx], sim_map, labels[mol_idx])
+        except OSError:
+            # e.g., a read-only dataset, the maps are just not cached
+            pass
+        for mol_idx, sim_map in zip(missing, computed):
+            sim_map_list[mol_idx] = sim_map
+
+    return sim_map_list
+
+
+def build_dataset_bundle(bundle_path, structures_dir, structures_sim_map_dir, npy_dir=None, num_workers=None,
+                         use_processes=False):
+    """Pack a structures folder and its simulated map folder into a dataset bundle, see dataset_bundle.py
+
+    The structures and the maps are paired by their file names without extensions, like convert2mrc_npy.py names
+    the maps, and the molecules are ordered by name.
+
+    The atomic numbers of the atoms are kept in the bundle as the weights of the reference density,
+    see read_atom_weights_list().
+
+    @param npy_dir: folder of .npy sidecars for read_file_and_get_coordinates()
+    @param num_workers: see file_loader.load_files()
+    @param use_processes: parse the structures on a process pool, see read_all_files_to_atom_coords_list()
+    @return: the molecule names
+    """
+    structure_paths = {os.path.basename(file_path).split('.')[0]: file_path
+                       for file_path in folder_file_paths(structures_dir)}
+    sim_map_paths = {os.path.basename(file_path).split('.')[0]: file_path
+                     for file_path in folder_file_paths(structures_sim_map_dir)}
+
+    unpaired = sorted(set(structure_paths) ^ set(sim_map_paths))
+    if unpaired:
+        raise ValueError(f"No structure or no simulated map for: {', '.join(unpaired)}")
+
+    names = sorted(structure_paths)
+    structure_paths = [structure_paths[name] for name in names]
+
+    atom_coords_list, errors = load_files(functools.partial(read_file_and_get_coordinates, npy_dir=npy_dir),
+                                          structure_paths, num_workers, use_processes)
+    sim_map_list, sim_map_errors = load_files(mrc_to_npy, [sim_map_paths[name] for name in names], num_workers)
+    errors += sim_map_errors
+    if errors:
+        raise ValueError(f"Failed to load {len(errors)} file(s):\n{format_load_errors(errors)}")
+
+    weights_list = read_atom_weights_list(structure_paths, atom_coords_list, num_workers, use_processes)
+    write_dataset_bundle(bundle_path, names, structure_paths, atom_coords_list, sim_map_list, weights_list,
+                         [sim_map_paths[name] for name in names])
+
+    return names
+
+
+def read_dataset_bundle(bundle_path, resolution=None):
+    """
+    @param resolution: if given, over-sampled maps are downsampled like in mrc_folder_to_npy_list()
+    @return: the bundle, its atom_coords_list and sim_map_list, the arrays are views of its memory map
+    """
+    bundle = DatasetBundle(bundle_path)
+    stale_files = bundle.stale_files()
+    if stale_files:
+        # the bundle is not rebuilt here, its arrays are what the user packed, possibly from folders since moved
+        warnings.warn(f"{len(stale_files)} file(s) changed since {bundle_path} was built, "
+                      f"rebuild it with build_dataset_bundle():\n" + "\n".join(f"  {path}" for path in stale_files))
+    sim_map_list = [downsample_volume(data, steps, origin, resample_factor(steps, resolution))
+                    for data, steps, origin in bundle.sim_map_list()]
+
+    return bundle, bundle.atom_coords_list(), sim_map_list
 
 
 def rotate_centers(mol_centers, e_quaternions):
@@ -561,15 +1587,21 @@ def rotate_centers(mol_centers, e_quaternions):
     return rotated_centers_list
 
 
-def calculate_metrics(render, elements_sim_density):
+def calculate_metrics(render, elements_sim_density, atom_mask=None):
     # Mask to filter elements in render that are greater than zero
     mask = render > 0
+    if atom_mask is not None:
+        # Leave out the padded atoms of a batch
+        mask = mask & atom_mask
 
     # Apply the mask to the render and elements_sim_density tensors
     render_filtered = render * mask
     elements_sim_density_filtered = elements_sim_density * mask
     mask_sum = mask.float().sum(dim=-1, keepdim=True)
-    in_contour_percentage = mask.float().mean(dim=-1)
+    if atom_mask is None:
+        in_contour_percentage = mask.float().mean(dim=-1)
+    else:
+        in_contour_percentage = mask.float().sum(dim=-1) / atom_mask.float().sum(dim=-1)
 
     # Calculation of correlation
     # First, normalize the inputs to have zero mean and unit variance, as Pearson's correlation requires
@@ -599,188 +1631,783 @@ def calculate_metrics(render, elements_sim_density):
     return torch.stack((overlap_mean, correlation, cam, in_contour_percentage), dim=-1)
 
 
-def diff_fit(volume_list: list,
-             volume_steps: list,
-             volume_origin: list,
-             min_island_size: int,
-             mol_coords: list,
-             mol_sim_maps: list,
-             N_shifts: int = 10,
-             N_quaternions: int = 100,
-             negative_space_value: float = -0.5,
-             learning_rate: float = 0.01,
-             n_iters: int = 201,
-             save_results: bool = False,
-             out_dir: str = "DiffFit_out",
-             out_dir_exist_ok: bool = False,
-             device: str = "cpu"
-             ):
-    timer_start = datetime.now()
-
-    if save_results:
-        os.makedirs(out_dir, exist_ok=out_dir_exist_ok)
-        with open(f"{out_dir}/log.log", "a") as log_file:
-            log_file.write(f"Wall clock time: {datetime.now()}\n")
-
-    # ======= load target volume to fit into
-    target_no_negative = volume_list[0]
-    target_steps = volume_steps
-    target_origin = volume_origin
-    # target steps is in [z, y, x]
-    # target_origin is in [x, y, z]
-
-    target_no_negative, eligible_volume, cluster_center_indices = filter_volume(target_no_negative, 0, min_island_size)
-
-    sampled_indices = random_sample_indices(eligible_volume, N_shifts)
-    # convert sampled_indices to angstrom space coords
-    sampled_coords = np.array([np.array(idx) * np.array(target_steps) for idx in sampled_indices])
-    sampled_coords = sampled_coords[:, [2, 1, 0]] + target_origin  # convert to [x, y, z] and then shift
-
-    target_no_negative, target_dim = numpy2tensor(target_no_negative, device)
-    # target as [1, 1, z, y, x]
-    # target_dim as [z, y, x]
+def prune_candidates(optimizer, e_shifts, e_quaternions, scores, active_idx, prune_fraction):
+    """Drop the worst prune_fraction of the candidates of each molecule (successive halving)
 
-    target_size = np.array(list(map(operator.mul, target_dim, target_steps)))  # in [z, y, x]
+    The parameter tensors and the optimizer state are compacted to the kept candidates,
+    which are laid out as [N_mol, N_keep, 1, ...] afterwards.
 
-    target_no_negative = linear_norm_tensor(target_no_negative)
-    #  ### np.save(f"{os.path.dirname(target_vol_path)}/target_filtered_normalized.npy",
-    #  ###         target_no_negative.squeeze().detach().cpu().numpy())
-
-    # negative space in target volume
-    eligible_volume_tensor = torch.tensor(eligible_volume, device=device).unsqueeze_(0).unsqueeze_(0)
-    target = target_no_negative.clone()
-    target[~eligible_volume_tensor] = negative_space_value
-    # target[~eligible_volume_tensor] = -target[eligible_volume_tensor].mean()
+    @param scores: score of each current candidate (higher is better) as [N_mol, ...]
+    @param active_idx: index of each current candidate in the flattened N_quat * N_shift as [N_mol, N_active]
+    @return: e_shifts, e_quaternions, optimizer, active_idx for the kept candidates
+    """
+    num_molecules = scores.shape[0]
+    scores = torch.nan_to_num(scores.reshape(num_molecules, -1), nan=-float("inf"))
+    num_keep = max(1, math.ceil(scores.shape[1] * (1.0 - prune_fraction)))
 
-    # ======= create convoluted target volumes
-    conv_loops = len(volume_list) - 1
-    conv_weights = [1.0] * conv_loops
+    keep = torch.topk(scores, num_keep, dim=1).indices.sort(dim=1).values
+    mol_idx = torch.arange(num_molecules, device=keep.device).unsqueeze(1)
 
-    target_gaussian_conv_list = [numpy2tensor(vol_np, device)[0] for vol_np in volume_list]
+    def compact(tensor):
+        return tensor.reshape(num_molecules, -1, 1, tensor.shape[-1])[mol_idx, keep]
 
-    # ======= get atom coords
-    atom_coords_list = mol_coords  # atom coords as [x, y, z]
-    mol_centers = [np.mean(coords, axis=0) for coords in atom_coords_list]
-    num_molecules = len(atom_coords_list)
+    params = [e_shifts, e_quaternions]
+    kept_params = [compact(param.detach()).requires_grad_(True) for param in params]
 
-    # read simulated map
-    sim_map_list = mol_sim_maps
-    elements_sim_density_list = sample_sim_map(atom_coords_list, sim_map_list, num_molecules, device)
+    kept_optimizer = type(optimizer)([dict(group, params=[kept_param])
+                                      for group, kept_param in zip(optimizer.param_groups, kept_params)])
+    for param, kept_param in zip(params, kept_params):
+        kept_optimizer.state[kept_param] = {
+            key: compact(value) if torch.is_tensor(value) and value.shape == param.shape else value
+            for key, value in optimizer.state[param].items()}
 
-    # ======= optimization
+    return kept_params[0], kept_params[1], kept_optimizer, active_idx[mol_idx, keep]
 
-    # Init params
 
-    e_quaternions = generate_random_quaternions(N_quaternions * N_shifts)
+def log_candidates(e_sqd_log, log_idx, active_idx, e_shifts, e_quaternions,
+                   first_layer_positive_density_sum, metrics_table):
+    """Write the record of every active candidate into e_sqd_log at log_idx
 
-    rotated_centers_array = np.array(rotate_centers(mol_centers, e_quaternions))
+    Candidates dropped by prune_candidates keep repeating their last record,
+    so e_sqd_log holds their trajectory up to the point where they were pruned.
+    """
+    num_molecules = e_sqd_log.shape[0]
+    e_sqd_log_flat = e_sqd_log.view(num_molecules, -1, *e_sqd_log.shape[-2:])
+    e_sqd_log_flat[:, :, log_idx] = e_sqd_log_flat[:, :, log_idx - 1]
 
-    e_shifts = sampled_coords - rotated_centers_array.reshape([num_molecules, N_quaternions, N_shifts, 3])
+    record = torch.cat([e_shifts.reshape(num_molecules, -1, 3),
+                        e_quaternions.reshape(num_molecules, -1, 4),
+                        first_layer_positive_density_sum.reshape(num_molecules, -1, 1),
+                        metrics_table.reshape(num_molecules, -1, 4)], dim=-1)
+    mol_idx = torch.arange(num_molecules, device=active_idx.device).unsqueeze(1)
+    e_sqd_log_flat[mol_idx, active_idx, log_idx] = record
 
-    e_quaternions = e_quaternions.reshape([N_quaternions, N_shifts, 4])
-    e_quaternions = np.repeat(e_quaternions[np.newaxis, :, :, :], num_molecules, axis=0)
 
-    e_shifts = torch.tensor(e_shifts, device=device).float().detach().requires_grad_(True)
-    e_quaternions = torch.tensor(e_quaternions, device=device).float().detach().requires_grad_(True)
+class FitEngine:
+    """Fitting engine that keeps a preprocessed target map on the device
 
-    # coordinates is in [x, y, z]
-    # target_size is in [z, y, x]
-    target_size_x_y_z = [target_size[2], target_size[1], target_size[0]]
-    target_size_x_y_z_tensor = torch.tensor(target_size_x_y_z, device=device).float()
-    target_origin_tensor = torch.tensor(target_origin, device=device).float()
+    The target is filtered, normalized, masked and smoothed once when the engine is
+    built. Any number of fits, e.g., with other molecules, seeds or candidate counts,
+    can then be run against it with fit().
+    """
 
-    # Training loop
-    log_every = 10
+    def __init__(self, target_no_negative, eligible_volume, cluster_center_indices, conv_list,
+                 target_steps, target_origin, conv_weights, negative_space_value=-0.5, device="cpu",
+                 island_stats=None, crop_start=None, full_dim=None):
+        """
+        @param target_no_negative: filtered and normalized target as [1, 1, z, y, x] tensor
+        @param eligible_volume: eligible voxels of the target as [z, y, x] bool array
+        @param cluster_center_indices: center indices of the islands in the eligible volume
+        @param conv_list: the target and its smoothed copies as [1, 1, z, y, x] tensors
+        @param target_steps: voxel size in [z, y, x]
+        @param target_origin: origin of the full map in [x, y, z]
+        @param conv_weights: weights of the smoothed copies, one for each of conv_list[1:]
+        @param island_stats: island statistics from filter_volume(), recomputed on demand if None
+        @param crop_start: if the volumes are cropped from the full map, the [z, y, x] index of their first voxel
+        @param full_dim: dim of the full map in [z, y, x], that of the volumes if None
+        """
+        if len(conv_weights) != len(conv_list) - 1:
+            raise ValueError("Length of conv_weights does not match conv_loops! ")
+
+        target_dim = target_no_negative.shape[2:]
+        if crop_start is None:
+            crop_start = (0, 0, 0)
+        if full_dim is None:
+            full_dim = target_dim
+
+        self.device = device
+        self.target_steps = target_steps
+        self.crop_start = tuple(int(start) for start in crop_start)
+        self.full_dim = tuple(int(dim) for dim in full_dim)
+        # origin of the cropped voxel grid, voxel indices of the engine volumes map to angstrom with it
+        self.target_origin = [origin + start * step
+                              for origin, start, step in zip(target_origin, self.crop_start[::-1], target_steps[::-1])]
+        self.eligible_volume = eligible_volume
+        self.cluster_center_indices = cluster_center_indices
+        self._island_stats = island_stats
+        self.negative_space_value = negative_space_value
+        # replace it, e.g., by AtomCoordsCache(max_bytes=...), to bound the device memory it takes
+        self.coords_cache = AtomCoordsCache()
+        # the epoch of each record of the log of the last fit, see fit_log.py
+        self.log_epochs = None
+
+        self.target_size = np.array(list(map(operator.mul, full_dim, target_steps)))  # in [z, y, x]
+
+        sample_size = self.target_size
+        sample_origin = target_origin
+        if self.full_dim != tuple(target_dim):
+            # grid_sample maps the box of the full map onto its voxels 0 to full_dim - 1, the box of the cropped
+            # volumes keeps that mapping, so that the atoms sample the same density as in the full map
+            spacing = self.target_size / np.maximum(np.array(full_dim) - 1, 1)
+            sample_size = spacing * np.maximum(np.array(target_dim) - 1, 1)
+            sample_origin = [origin + start * step
+                             for origin, start, step in zip(target_origin, self.crop_start[::-1], spacing[::-1])]
 
-    e_sqd_log = torch.zeros([num_molecules, N_quaternions, N_shifts, int(n_iters / 10) + 2, 12], device=device)
-    # [x, y, z, w, -x, -y, -z, occupied_density_sum]
+        # coordinates is in [x, y, z]
+        # target_size is in [z, y, x]
+        target_size_x_y_z = [sample_size[2], sample_size[1], sample_size[0]]
+        self.target_size_x_y_z_tensor = torch.tensor(target_size_x_y_z, device=device).float()
+        self.target_origin_tensor = torch.tensor(sample_origin, device=device).float()
+
+        # negative space in target volume
+        eligible_volume_tensor = torch.tensor(eligible_volume, device=device).unsqueeze_(0).unsqueeze_(0)
+        target = target_no_negative.clone()
+        target[~eligible_volume_tensor] = negative_space_value
+        # target[~eligible_volume_tensor] = -target[eligible_volume_tensor].mean()
+
+        # sample the target and all its smoothed copies in one go
+        self.target_channels = stack_volume_channels(target, conv_list, len(conv_list) - 1)
+        self.channel_weights = torch.tensor([1.0] + list(conv_weights), device=device)
+
+    @property
+    def island_stats(self):
+        # e.g., when the target was loaded from a TargetCache, the islands are those of the eligible volume
+        if self._island_stats is None:
+            self._island_stats = filter_volume(self.eligible_volume, 0, 0, return_stats=True)[3]
+        return self._island_stats
+
+    @classmethod
+    def from_volume_list(cls, volume_list, volume_steps, volume_origin, min_island_size,
+                         negative_space_value=-0.5, target_resolution=None, crop=True, device="cpu"):
+        """Build the engine from a target that comes with its smoothed copies, e.g., smoothed in ChimeraX
+
+        @param volume_list: the target followed by its smoothed copies as [z, y, x] arrays
+        @param volume_steps: voxel size in [z, y, x]
+        @param volume_origin: origin in [x, y, z]
+        @param min_island_size: islands smaller than this are removed from the target
+        @param target_resolution: stated resolution of the target, an over-sampled target is downsampled to it
+        @param crop: crop the volumes to the eligible voxels and the voxels above 0 in the smoothed copies,
+                     the voxels of the smoothed copies that are not above 0 have to be negative space
+        """
+        factor = resample_factor(volume_steps, target_resolution)
+        # the volumes of the caller are not changed, but their downsampled copies can be filtered in place
+        in_place = factor > 1
+        if factor > 1:
+            resampled_list = [downsample_volume(volume, volume_steps, volume_origin, factor) for volume in volume_list]
+            volume_list = [volume for volume, _, _ in resampled_list]
+            _, volume_steps, volume_origin = resampled_list[0]
+            # keep the same minimum island size in angstrom^3
+            min_island_size = min_island_size / factor ** 3
+
+        target_no_negative, eligible_volume, cluster_center_indices, island_stats = filter_volume(
+            volume_list[0], 0, min_island_size, in_place, return_stats=True)
+
+        full_dim = eligible_volume.shape
+        crop_start = None
+        if crop:
+            # outside of this box every channel is negative space, one more voxel keeps the interpolation the same
+            occupied = eligible_volume.copy()
+            for vol_np in volume_list[1:]:
+                occupied |= vol_np > 0
+            target_crop = eligible_bounding_box(occupied, 1)
+            crop_start = [axis_slice.start for axis_slice in target_crop]
+
+            target_no_negative = target_no_negative[target_crop]
+            eligible_volume = np.ascontiguousarray(eligible_volume[target_crop])
+            cluster_center_indices = [tuple(np.subtract(center, crop_start)) for center in cluster_center_indices]
+            island_stats = crop_island_stats(island_stats, target_crop)
+            volume_list = [vol_np[target_crop] for vol_np in volume_list]
+
+        target_no_negative, _ = numpy2tensor(target_no_negative, device)
+        target_no_negative = linear_norm_tensor(target_no_negative)
+
+        conv_list = [numpy2tensor(vol_np, device)[0] for vol_np in volume_list]
+        conv_weights = [1.0] * (len(volume_list) - 1)
+
+        return cls(target_no_negative, eligible_volume, cluster_center_indices, conv_list,
+                   volume_steps, volume_origin, conv_weights, negative_space_value, device, island_stats,
+                   crop_start, full_dim)
+
+    @classmethod
+    def from_file(cls, target_vol_path, target_surface_threshold, min_cluster_size,
+                  negative_space_value=-0.5, conv_loops=10, conv_kernel_sizes=(5, 5, 5, 5, 5, 5, 5, 5, 5, 5),
+                  conv_weights=(1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0), conv_backend="auto",
+                  conv_pyramid="chained", target_cache=None, target_resolution=None, crop=True, device="cpu"):
+        """Build the engine from a target map file, the smoothed copies are computed here
+
+        @param target_vol_path: path to the target map
+        @param target_surface_threshold: voxels below this value are not eligible
+        @param min_cluster_size: islands smaller than this are removed from the target
+        @param conv_backend, conv_pyramid: see conv_volume()
+        @param target_cache: TargetCache to load the preprocessed target from and to save it to
+        @param target_resolution: stated resolution of the target, an over-sampled target is downsampled to it
+        @param crop: smooth and keep only the bounding box of the eligible voxels, grown by the reach of the
+                     smoothing, outside of it all the channels are negative space anyway
+        """
+        if len(conv_weights) != conv_loops:
+            raise ValueError("Length of conv_weights does not match conv_loops! ")
+
+        if target_cache is not None:
+            cache_key = target_cache_key(target_vol_path, target_surface_threshold, min_cluster_size, conv_loops,
+                                         conv_kernel_sizes, negative_space_value, conv_pyramid, target_resolution,
+                                         crop, target_cache.strict)
+            entry = target_cache.load(cache_key)
+            if entry is not None:
+                conv_list = [numpy2tensor(volume, device)[0] for volume in entry["conv_list"]]
+                return cls(conv_list[0], np.array(entry["eligible_volume"]), entry["cluster_center_indices"],
+                           conv_list, entry["steps"], entry["origin"], conv_weights, negative_space_value, device,
+                           None, entry["crop_start"], entry["full_dim"])
+
+        target_no_negative, target_steps, target_origin = mrc_to_npy(target_vol_path)
+        # target dim is in [z, y, x]
+        # target_origin is in [x, y, z]
+
+        factor = resample_factor(target_steps, target_resolution)
+        if factor > 1:
+            target_no_negative, target_steps, target_origin = downsample_volume(target_no_negative, target_steps,
+                                                                                target_origin, factor)
+            # keep the same minimum island size in angstrom^3
+            min_cluster_size = min_cluster_size / factor ** 3
+
+        # the data read from the file are read-only, the ones downsampled from them are filtered in place
+        target_no_negative, eligible_volume, cluster_center_indices, island_stats = filter_volume(
+            target_no_negative, target_surface_threshold, min_cluster_size, target_no_negative.flags.writeable,
+            return_stats=True)
+
+        full_dim = eligible_volume.shape
+        crop_start = None
+        if crop:
+            # the smoothing spreads the target by the kernel radii, beyond that and one more voxel
+            # for the interpolation, all the channels are negative space
+            kernel_sizes = conv_kernel_sizes[:conv_loops]
+            target_crop = eligible_bounding_box(eligible_volume, sum(size // 2 for size in kernel_sizes) + 1)
+            crop_start = [axis_slice.start for axis_slice in target_crop]
+
+            target_no_negative = target_no_negative[target_crop]
+            eligible_volume = np.ascontiguousarray(eligible_volume[target_crop])
+            cluster_center_indices = [tuple(np.subtract(center, crop_start)) for center in cluster_center_indices]
+            island_stats = crop_island_stats(island_stats, target_crop)
+
+        target_no_negative, _ = numpy2tensor(target_no_negative, device)
+        target_no_negative = linear_norm_tensor(target_no_negative)
+        # np.save(f"{os.path.dirname(target_vol_path)}/target_filtered_normalized.npy",
+        #         target_no_negative.squeeze().detach().cpu().numpy())
+
+        conv_list = conv_volume(target_no_negative, device, conv_loops, conv_kernel_sizes,
+                                negative_space_value, kernel_type="Gaussian",
+                                backend=conv_backend, pyramid=conv_pyramid)
+
+        if target_cache is not None:
+            target_cache.save(cache_key, target_steps, target_origin, eligible_volume, cluster_center_indices,
+                              [volume[0, 0].detach().cpu().numpy() for volume in conv_list], crop_start, full_dim)
+
+        return cls(target_no_negative, eligible_volume, cluster_center_indices, conv_list,
+                   target_steps, target_origin, conv_weights, negative_space_value, device, island_stats,
+                   crop_start, full_dim)
+
+    def prescan(self, mol_coords, mol_sim_maps, num_candidates, angle_deg=30.0, bin_factor=2, rotation_batch_size=4):
+        """Exhaustive search over a coarse rotation grid, translations are scored at once by FFT cross-correlation
+
+        For every rotation, the simulated map of the molecule is resampled rotated onto the target grid and
+        cross-correlated with the target (negative space included). Each voxel keeps its best rotation,
+        and the num_candidates best local maxima become the poses. If the binned target has fewer voxels than
+        num_candidates, the remaining poses are random like without prescan.
+
+        @param mol_coords: atom coords of each molecule as [N_atoms, 3] in [x, y, z]
+        @param mol_sim_maps: simulated map of each molecule as (data, steps, origin)
+        @param angle_deg: angular resolution of the super-Fibonacci rotation grid
+        @param bin_factor: the scan runs on the target binned by this factor, the poses only need to be
+                           close enough for the gradient descent to take over
+        @return: e_quaternions as [N_mol, num_candidates, 4] and e_shifts as [N_mol, num_candidates, 3]
+        """
+        device = self.device
+        target = self.target_channels[:, 0:1]
+        target_steps = [step * bin_factor for step in self.target_steps]  # in [z, y, x]
+        # a binned voxel sits at the center of the voxels it averages
+        target_origin = [origin + (bin_factor - 1) / 2 * step
+                         for origin, step in zip(self.target_origin, self.target_steps[::-1])]  # in [x, y, z]
+        if bin_factor > 1:
+            target = F.avg_pool3d(target, bin_factor, stride=bin_factor, ceil_mode=True)
+        target_dim = target.shape[2:]
+        steps_x_y_z = torch.tensor(target_steps[::-1], device=device).float()
+        origin_x_y_z = torch.tensor(target_origin, device=device).float()
+
+        quaternions = torch.tensor(generate_super_fibonacci_quaternions(angle_deg=angle_deg), device=device).float()
+        rotation_matrices = quaternion_to_matrix_batch(quaternions.view(-1, 1, 4)).view(-1, 3, 3)
+
+        e_quaternions_list = []
+        e_shifts_list = []
+        for mol_idx in range(len(mol_coords)):
+            atom_coords = torch.as_tensor(mol_coords[mol_idx], dtype=torch.float32, device=device)
+            mol_center = atom_coords.mean(dim=0)
+
+            # a template box that holds the molecule in any rotation, in target voxels
+            radius = torch.linalg.vector_norm(atom_coords - mol_center, dim=-1).max() + 2.0 * steps_x_y_z.max()
+            template_dim = [2 * int(math.ceil(radius.item() / step)) + 1 for step in target_steps]
+            template_center = [dim // 2 for dim in template_dim]
+
+            # template voxel offsets from the molecule center in angstrom, as [z, y, x, 3] in [x, y, z]
+            axes = [(torch.arange(dim, device=device) - center).float() * step
+                    for dim, center, step in zip(template_dim, template_center, target_steps)]
+            offset_z, offset_y, offset_x = torch.meshgrid(*axes, indexing='ij')
+            template_offsets = torch.stack([offset_x, offset_y, offset_z], dim=-1)
+
+            sim_map, sim_map_dim = numpy2tensor(mol_sim_maps[mol_idx][0], device)
+            sim_map_size = np.array(list(map(operator.mul, sim_map_dim, mol_sim_maps[mol_idx][1])))  # in [z, y, x]
+            sim_map_size_x_y_z_tensor = torch.tensor(sim_map_size[::-1].copy(), device=device).float()
+            sim_map_origin_tensor = torch.tensor(mol_sim_maps[mol_idx][2], device=device).float()
+
+            # pad the target so that the circular correlation does not wrap around,
+            # and up to sizes the FFT is fast for
+            pad_high = [next_fast_len(target_dim[axis] + template_dim[axis] - 1, real=True)
+                        - target_dim[axis] - template_center[axis] for axis in range(3)]
+            target_pad = F.pad(target, [template_center[2], pad_high[2],
+                                        template_center[1], pad_high[1],
+                                        template_center[0], pad_high[0]],
+                               value=self.negative_space_value)
+            pad_dim = target_pad.shape[2:]
+            target_fft = torch.fft.rfftn(target_pad, dim=(2, 3, 4))
+
+            best_score = torch.full(target_dim, -torch.inf, device=device)
+            best_rotation = torch.zeros(target_dim, dtype=torch.long, device=device)
+            for batch_start in range(0, len(quaternions), rotation_batch_size):
+                batch_matrices = rotation_matrices[batch_start:batch_start + rotation_batch_size]
+
+                # the molecule is posed as coords @ M + shift, so the template offset u comes from u @ M^T + center
+                sim_coords = torch.matmul(template_offsets.view(1, -1, 3), batch_matrices.transpose(1, 2)) + mol_center
+                grid = normalize_coordinates_to_map_origin_torch(sim_coords, sim_map_size_x_y_z_tensor,
+                                                                 sim_map_origin_tensor)
+                templates = torch.nn.functional.grid_sample(sim_map.expand(len(batch_matrices), -1, -1, -1, -1),
+                                                            grid.view(len(batch_matrices), *template_dim, 3),
+                                                            'bilinear', 'zeros', align_corners=True)
+
+                template_fft = torch.fft.rfftn(templates, s=pad_dim, dim=(2, 3, 4))
+                scores = torch.fft.irfftn(target_fft * template_fft.conj(), s=pad_dim, dim=(2, 3, 4))
+                # scores[d] is the correlation with the template center at target voxel d
+                scores = scores[:, 0, :target_dim[0], :target_dim[1], :target_dim[2]]
+
+                batch_best_score, batch_best_rotation = scores.max(dim=0)
+                better = batch_best_score > best_score
+                best_score = torch.where(better, batch_best_score, best_score)
+                best_rotation = torch.where(better, batch_best_rotation + batch_start, best_rotation)
+
+            # local maxima first, ordered by their score, then the other voxels
+            is_peak = best_score == F.max_pool3d(best_score[None, None], 3, stride=1, padding=1)[0, 0]
+            peak_bonus = (best_score.max() - best_score.min() + 1.0) * is_peak
+            num_top = min(num_candidates, best_score.numel())
+            top_voxels = torch.topk((best_score + peak_bonus).flatten(), num_top).indices
+
+            top_rotations = best_rotation.flatten()[top_voxels]
+            top_indices = torch.stack(torch.unravel_index(top_voxels, target_dim), dim=-1)
+
+            # template center position P in angstrom, then shift = P - center @ M
+            top_positions = top_indices.flip(-1).float() * steps_x_y_z + origin_x_y_z
+            mol_e_shifts = (top_positions - torch.matmul(mol_center, rotation_matrices[top_rotations])).cpu().numpy()
+            mol_e_quaternions = quaternions[top_rotations].cpu().numpy()
+
+            if num_top < num_candidates:
+                # the binned target has fewer voxels than candidates,
+                # the others are seeded at random eligible voxels with random rotations like fit() without prescan
+                num_random = num_candidates - num_top
+                random_quaternions = generate_random_quaternions(num_random)
+                num_eligible = int(np.count_nonzero(self.eligible_volume))
+                random_indices = eligible_ranks_to_indices(self.eligible_volume,
+                                                           np.random.randint(num_eligible, size=num_random))
+                random_coords = (random_indices * np.array(self.target_steps))[:, [2, 1, 0]] + self.target_origin
+                random_shifts = random_coords - rotate_centers([mol_center.cpu().numpy()], random_quaternions)[0]
+                mol_e_shifts = np.concatenate([mol_e_shifts, random_shifts])
+                mol_e_quaternions = np.concatenate([mol_e_quaternions, random_quaternions])
+
+            e_shifts_list.append(mol_e_shifts.astype(np.float32))
+            e_quaternions_list.append(mol_e_quaternions.astype(np.float32))
+
+        return np.stack(e_quaternions_list), np.stack(e_shifts_list)
+
+    def fit(self,
+            mol_coords: list,
+            mol_sim_maps: list,
+            N_shifts: int = 10,
+            N_quaternions: int = 100,
+            learning_rate: float = 0.01,
+            n_iters: int = 201,
+            batch_molecules: bool = True,
+            coords_cache: AtomCoordsCache = None,
+            log_every: int = 10,
+            snapshot_epochs: list = (),
+            prune_epochs: list = (),
+            prune_fraction: float = 0.5,
+            prune_by: str = "loss",
+            max_memory_mb: float = None,
+            shift_sampling: str = "uniform",
+            rotation_sampling: str = "random",
+            rotation_resolution: float = None,
+            prescan_resolution: float = None,
+            atom_schedule: list = (),
+            bead_size: float = None,
+            bead_cache_paths: list = None,
+            reference_resolution: float = None,
+            reference_weights: list = None,
+            log_path: str = None
+            ):
+        """Fit the molecules into the target
+
+        @param mol_coords: atom coords of each molecule as [N_atoms, 3] in [x, y, z]
+        @param mol_sim_maps: simulated map of each molecule as (data, steps, origin)
+        @param coords_cache: cache of the atom coords on the device, the engine's own cache if None
+        @param shift_sampling: mode of random_sample_indices() to seed the shifts,
+                               or "island" to seed them per molecule with island_seed_indices()
+        @param rotation_sampling: "random" rotations for every candidate,
+                                  or the same "super_fibonacci" rotation set at every shift
+        @param rotation_resolution: angular resolution in degrees of the "super_fibonacci" set,
+                                    replaces N_quaternions if given
+        @param prescan_resolution: if given, the candidates start from the best poses of prescan() with this
+                                   angular resolution in degrees, instead of the shift and rotation sampling
+        @param atom_schedule: (start_epoch, cell_size) pairs, from start_epoch on the epochs use the atoms decimated
+                              with decimate_atoms() to cell_size, 0 for all atoms, e.g., ((0, 8.0), (100, 4.0),
+                              (180, 0)); epochs that compute the quality metrics always use all atoms
+        @param bead_size: if given, the optimization uses the beads of each molecule from atoms_to_beads() with
+                          this cell size in angstrom instead of the atoms, the occupied density is then the mean
+                          weighted by the atoms of each bead; the levels of atom_schedule become beads of their cell
+                          size (at least bead_size) and the quality metrics still use all atoms
+        @param bead_cache_paths: cache file of the beads of each molecule for load_or_compute_beads()
+        @param reference_resolution: if given, the reference density of the quality metrics is computed from the
+                                     atoms at this resolution with atoms_reference_density() instead of sampled
+                                     from the simulated maps, which are then only needed by prescan() and can
+                                     be None otherwise
+        @param reference_weights: weight of each atom of each molecule for atoms_reference_density(), e.g., from
+                                  read_atom_weights_list(), the atoms weigh the same if None
+        @param log_path: if given, the loss of the logged epochs is appended to this file
+        @return: mol_centers, e_sqd_log as [N_mol, N_quat, N_shift, N_log, 12] tensor
+        """
+        device = self.device
+        target_channels = self.target_channels
+        channel_weights = self.channel_weights
+        target_size_x_y_z_tensor = self.target_size_x_y_z_tensor
+        target_origin_tensor = self.target_origin_tensor
+
+        if prune_by not in ("loss", "correlation"):
+            raise ValueError(f"Unknown prune_by: {prune_by}, should be 'loss' or 'correlation'")
+        if rotation_sampling not in ("random", "super_fibonacci"):
+            raise ValueError(f"Unknown rotation_sampling: {rotation_sampling}, should be 'random' or 'super_fibonacci'")
+        if rotation_sampling == "super_fibonacci" and rotation_resolution is not None:
+            N_quaternions = num_quaternions_for_resolution(rotation_resolution)
+        if mol_sim_maps is None and (not reference_resolution or prescan_resolution is not None):
+            raise ValueError("mol_sim_maps are needed unless reference_resolution is given and there is no prescan")
+
+        # ======= get atom coords
+        atom_coords_list = mol_coords  # atom coords as [x, y, z]
+        mol_centers = [np.mean(coords, axis=0) for coords in atom_coords_list]
+        num_molecules = len(atom_coords_list)
+
+        if prescan_resolution is None:
+            if shift_sampling == "island":
+                # the seeds depend on the molecule size, sampled_indices as [N_mol, 1, N_shifts, 3]
+                voxel_volume = float(np.prod(self.target_steps))
+                sampled_indices = np.stack([island_seed_indices(self.island_stats, len(coords), voxel_volume, N_shifts)
+                                            for coords in atom_coords_list])[:, np.newaxis]
+            elif shift_sampling == "density":
+                sampled_indices = random_sample_indices(self.eligible_volume, N_shifts, shift_sampling,
+                                                        density=self.target_channels[0, 0].cpu().numpy())
+            elif shift_sampling == "stratified":
+                sampled_indices = random_sample_indices(self.eligible_volume, N_shifts, shift_sampling,
+                                                        island_stats=self.island_stats)
+            else:
+                sampled_indices = random_sample_indices(self.eligible_volume, N_shifts, shift_sampling)
+            # convert sampled_indices to angstrom space coords
+            sampled_coords = sampled_indices * np.array(self.target_steps)
+            sampled_coords = sampled_coords[..., [2, 1, 0]] + self.target_origin  # convert to [x, y, z] and then shift
+
+        # upload the atom coords to the device once, every epoch uses these tensors
+        if coords_cache is None:
+            coords_cache = self.coords_cache
+        atom_coords_tensor_list = [coords_cache.get(coords, device) for coords in atom_coords_list]
+
+        # the reference density at the atoms
+        if reference_resolution:
+            elements_sim_density_list = atoms_reference_density(atom_coords_list, atom_coords_list,
+                                                                reference_resolution, device, reference_weights)
+        else:
+            # read simulated map
+            elements_sim_density_list = sample_sim_map(atom_coords_tensor_list, mol_sim_maps, num_molecules, device)
+
+        # coarse-to-fine atom schedule, each level holds the molecules decimated to one cell size,
+        # or coarse-grained into beads of that size if bead_size is given
+        atom_schedule = sorted(atom_schedule)
+        atom_levels = {0: dict(coords_list=atom_coords_list, weights_list=None,
+                               sim_density_list=elements_sim_density_list)}
+
+        # the finest level of the optimization, level 0 with all atoms is then only used for the quality metrics
+        base_cell_size = bead_size or 0
+        if bead_size:
+            if bead_cache_paths is None:
+                bead_cache_paths = [None] * num_molecules
+            beads_list = [load_or_compute_beads(coords, bead_size, cache_path)
+                          for coords, cache_path in zip(atom_coords_list, bead_cache_paths)]
+            atom_levels[bead_size] = dict(coords_list=[bead_coords for bead_coords, _ in beads_list],
+                                          weights_list=[bead_weights for _, bead_weights in beads_list])
+
+        for _, cell_size in atom_schedule:
+            cell_size = max(cell_size or 0, base_cell_size)
+            if cell_size and cell_size not in atom_levels:
+                if bead_size:
+                    beads_list = [atoms_to_beads(coords, cell_size) for coords in atom_coords_list]
+                    atom_levels[cell_size] = dict(coords_list=[bead_coords for bead_coords, _ in beads_list],
+                                                  weights_list=[bead_weights for _, bead_weights in beads_list])
+                else:
+                    keep_list = [decimate_atoms(coords, cell_size) for coords in atom_coords_list]
+                    atom_levels[cell_size] = dict(
+                        coords_list=[np.asarray(coords)[keep] for coords, keep in zip(atom_coords_list, keep_list)],
+                        weights_list=None,
+                        sim_density_list=[density[torch.as_tensor(keep, device=device)]
+                                          for density, keep in zip(elements_sim_density_list, keep_list)])
+
+        for level in atom_levels.values():
+            level["coords_tensor_list"] = [coords_cache.get(coords, device) for coords in level["coords_list"]]
+            if "sim_density_list" not in level:
+                if reference_resolution:
+                    level["sim_density_list"] = atoms_reference_density(atom_coords_list, level["coords_list"],
+                                                                        reference_resolution, device,
+                                                                        reference_weights)
+                else:
+                    level["sim_density_list"] = sample_sim_map(level["coords_tensor_list"], mol_sim_maps,
+                                                               num_molecules, device)
+            if level["weights_list"] is None:
+                level["weights_tensor_list"] = [None] * num_molecules
+                level["weight_sum_list"] = [len(coords) for coords in level["coords_list"]]
+            else:
+                level["weights_tensor_list"] = [torch.as_tensor(weights, device=device)
+                                                for weights in level["weights_list"]]
+                level["weight_sum_list"] = [float(weights.sum()) for weights in level["weights_list"]]
+            if batch_molecules:
+                # pad all molecules into one tensor to evaluate them in a single pass
+                level["coords_tensor"], level["mask"] = coords_cache.get_padded(level["coords_list"], device)
+                if level["weights_list"] is not None:
+                    # the weights in the mask carry through to the occupied density reduction
+                    level["mask"] = level["mask"] * torch.nn.utils.rnn.pad_sequence(level["weights_tensor_list"],
+                                                                                    batch_first=True)
+                level["sim_density_tensor"] = torch.nn.utils.rnn.pad_sequence(level["sim_density_list"],
+                                                                               batch_first=True)
+
+                # split the candidates into chunks that fit into the memory budget
+                level["chunk_sizes"] = plan_candidate_chunks(num_molecules, N_quaternions * N_shifts,
+                                                             level["coords_tensor"].shape[1],
+                                                             target_channels.shape[1], max_memory_mb, device)
+
+        # ======= optimization
+
+        # Init params
+
+        if prescan_resolution is not None:
+            # gradient work only goes to the best poses of the exhaustive scan
+            e_quaternions, e_shifts = self.prescan(atom_coords_list, mol_sim_maps, N_quaternions * N_shifts,
+                                                   prescan_resolution)
+            e_quaternions = e_quaternions.reshape([num_molecules, N_quaternions, N_shifts, 4])
+            e_shifts = e_shifts.reshape([num_molecules, N_quaternions, N_shifts, 3])
+        else:
+            if rotation_sampling == "super_fibonacci":
+                # the same quasi-uniform rotation set at every shift
+                e_quaternions = generate_super_fibonacci_quaternions(N_quaternions)
+                e_quaternions = np.repeat(e_quaternions, N_shifts, axis=0)
+            else:
+                e_quaternions = generate_random_quaternions(N_quaternions * N_shifts)
 
-    with torch.no_grad():
-        e_sqd_log[:, :, :, 0, 0:3] = e_shifts
-        e_sqd_log[:, :, :, 0, 3:7] = e_quaternions
+            rotated_centers_array = np.array(rotate_centers(mol_centers, e_quaternions))
 
-    log_idx = 0
+            e_shifts = sampled_coords - rotated_centers_array.reshape([num_molecules, N_quaternions, N_shifts, 3])
 
+            e_quaternions = e_quaternions.reshape([N_quaternions, N_shifts, 4])
+            e_quaternions = np.repeat(e_quaternions[np.newaxis, :, :, :], num_molecules, axis=0)
 
-    # Create the optimizer with different learning rates
-    optimizer = torch.optim.Adam([
-        {'params': [e_shifts], 'lr': target_size.mean() * 0.01},
-        {'params': [e_quaternions], 'lr': learning_rate}
-    ])
+        e_shifts = torch.tensor(e_shifts, device=device).float().detach().requires_grad_(True)
+        e_quaternions = torch.tensor(e_quaternions, device=device).float().detach().requires_grad_(True)
 
-    for epoch in range(n_iters):
-        # Forward pass
+        # Training loop
+        # quality metrics are only computed on these epochs
+        log_epochs = set(range(0, n_iters, log_every)) | {epoch for epoch in snapshot_epochs if 0 <= epoch < n_iters}
 
-        first_layer_positive_density_sum = torch.zeros([num_molecules, N_quaternions, N_shifts], device=device)
-        occupied_density_sum = torch.zeros([num_molecules, N_quaternions, N_shifts], device=device)
-        metrics_table = torch.zeros([num_molecules, N_quaternions, N_shifts, 4], device=device)
+        e_sqd_log = torch.zeros([num_molecules, N_quaternions, N_shifts, len(log_epochs) + 1, 12], device=device)
+        # [x, y, z, w, -x, -y, -z, occupied_density_sum]
 
-        for mol_idx in range(num_molecules):
-            grid = transform_coords(atom_coords_list[mol_idx],
-                                    e_quaternions[mol_idx],
-                                    e_shifts[mol_idx],
-                                    target_size_x_y_z_tensor, target_origin_tensor, device)
-            render = torch.nn.functional.grid_sample(target, grid, 'bilinear', 'border', align_corners=True)
+        with torch.no_grad():
+            e_sqd_log[:, :, :, 0, 0:3] = e_shifts
+            e_sqd_log[:, :, :, 0, 3:7] = e_quaternions
 
-            metrics_table[mol_idx] = calculate_metrics(render, elements_sim_density_list[mol_idx])
+        log_idx = 0
+        # saved with the log, so that the records can be told apart without knowing the settings of the fit
+        self.log_epochs = log_epochs_array(log_epochs)
 
-            occupied_density_sum[mol_idx] = torch.sum(render, dim=-1).squeeze()
-            first_layer_positive_density_sum[mol_idx] = torch.sum(render * (render > 0), dim=-1).squeeze()
+        # candidate pruning, active_idx maps the current candidates to their records in e_sqd_log
+        prune_epochs = set(prune_epochs)
+        active_idx = torch.arange(N_quaternions * N_shifts, device=device).repeat(num_molecules, 1)
 
-            add_conv_density(conv_loops, target_gaussian_conv_list, conv_weights, grid, occupied_density_sum[mol_idx])
+        # Create the optimizer with different learning rates
+        optimizer = torch.optim.Adam([
+            {'params': [e_shifts], 'lr': self.target_size.mean() * 0.01},
+            {'params': [e_quaternions], 'lr': learning_rate}
+        ])
 
-            occupied_density_sum[mol_idx] /= len(atom_coords_list[mol_idx])
+        for epoch in range(n_iters):
+            log_epoch = epoch in log_epochs
+            prune_epoch = epoch in prune_epochs
+            compute_metrics = log_epoch or (prune_epoch and prune_by == "correlation")
 
-        # loss
-        loss = -torch.sum(occupied_density_sum)
-        # gradients
-        loss.backward()
+            # the quality metrics always use all atoms
+            cell_size = 0
+            if not compute_metrics:
+                cell_size = base_cell_size
+                for start_epoch, level_cell_size in atom_schedule:
+                    if epoch >= start_epoch:
+                        cell_size = max(level_cell_size or 0, base_cell_size)
+            level = atom_levels[cell_size]
 
-        # update weights
-        optimizer.step()
-        optimizer.zero_grad()
+            # Forward pass
 
-        # log
-        if (epoch - 1) % log_every == (log_every - 1):
-            with torch.no_grad():
-                log_idx += 1
-                e_sqd_log[:, :, :, log_idx, 0:3] = e_shifts
-                e_sqd_log[:, :, :, log_idx, 3:7] = e_quaternions
-                e_sqd_log[:, :, :, log_idx, 7] = first_layer_positive_density_sum
-                e_sqd_log[:, :, :, log_idx, 8:12] = metrics_table
+            if batch_molecules:
+                occupied_density_sum, first_layer_positive_density_sum, metrics_table, loss = forward_backward_batch(
+                    target_channels, channel_weights,
+                    level["coords_tensor"], level["mask"], level["sim_density_tensor"],
+                    e_quaternions, e_shifts, target_size_x_y_z_tensor, target_origin_tensor,
+                    *level["chunk_sizes"], compute_metrics=compute_metrics)
+            else:
+                candidate_shape = e_shifts.shape[:-1]
+                occupied_density_sum = torch.zeros(candidate_shape, device=device)
+                if compute_metrics:
+                    first_layer_positive_density_sum = torch.zeros(candidate_shape, device=device)
+                    metrics_table = torch.zeros([*candidate_shape, 4], device=device)
+
+                for mol_idx in range(num_molecules):
+                    grid = transform_coords(level["coords_tensor_list"][mol_idx],
+                                            e_quaternions[mol_idx],
+                                            e_shifts[mol_idx],
+                                            target_size_x_y_z_tensor, target_origin_tensor, device)
+                    render_channels = torch.nn.functional.grid_sample(target_channels, grid, 'bilinear', 'border',
+                                                                      align_corners=True)
+                    render = render_channels[:, 0:1]
+
+                    if compute_metrics:
+                        with torch.no_grad():
+                            metrics_table[mol_idx] = calculate_metrics(render, elements_sim_density_list[mol_idx])
+                            first_layer_positive_density_sum[mol_idx] = torch.sum(render * (render > 0),
+                                                                                  dim=-1).view(candidate_shape[1:])
+
+                    atom_weights = level["weights_tensor_list"][mol_idx]
+                    if atom_weights is not None:
+                        render_channels = render_channels * atom_weights
+                        render = render_channels[:, 0:1]
+
+                    occupied_density_sum[mol_idx] = torch.sum(render, dim=-1).view(candidate_shape[1:])
+
+                    add_conv_density(render_channels, channel_weights, occupied_density_sum[mol_idx])
+
+                    occupied_density_sum[mol_idx] /= level["weight_sum_list"][mol_idx]
+
+                # loss
+                loss = -torch.sum(occupied_density_sum)
+                # gradients
+                loss.backward()
+
+            # update weights
+            optimizer.step()
+            optimizer.zero_grad()
+
+            # log
+            if log_epoch:
+                with torch.no_grad():
+                    log_idx += 1
+                    log_candidates(e_sqd_log, log_idx, active_idx, e_shifts, e_quaternions,
+                                   first_layer_positive_density_sum, metrics_table)
+
+                    if log_path is not None:
+                        with open(log_path, "a") as log_file:
+                            log_file.write(f"Epoch: {epoch + 1:05d}, "
+                                           f"loss = {loss:.4f}\n")
+
+            # successive halving
+            if prune_epoch:
+                with torch.no_grad():
+                    scores = occupied_density_sum if prune_by == "loss" else metrics_table[..., 1]
+                e_shifts, e_quaternions, optimizer, active_idx = prune_candidates(optimizer, e_shifts, e_quaternions,
+                                                                                  scores, active_idx, prune_fraction)
+
+        # convert quaternion to ChimeraX, Houdini, scipy system and normalize it
+
+        e_sqd_ChimeraX_q = torch.cat([-e_sqd_log[..., 4:7], e_sqd_log[..., 3].unsqueeze(-1)], dim=-1)
+        e_sqd_log[:, :, :, :, 3:7] = e_sqd_ChimeraX_q
+
+        q_norms = torch.linalg.vector_norm(e_sqd_log[:, :, :, :, 3:7], dim=-1, keepdim=True)
+        e_sqd_log[:, :, :, :, 3:7] /= q_norms
+
+        # Each record is in length of 12 as [shift 3, quat 4, first_layer_positive_density_sum 1, quality metric 4]
+        # quality metric: overlap (idx: 8), correlation (idx: 9), cam (idx: 10), in_contour (idx: 11)
+        return mol_centers, e_sqd_log
 
-                if save_results:
-                    with open(f"{out_dir}/log.log", "a") as log_file:
-                        log_file.write(f"Epoch: {epoch + 1:05d}, "
-                                       f"loss = {loss:.4f}\n")
 
-    timer_stop = datetime.now()
+def diff_fit(volume_list: list,
+             volume_steps: list,
+             volume_origin: list,
+             min_island_size: int,
+             mol_coords: list,
+             mol_sim_maps: list,
+             N_shifts: int = 10,
+             N_quaternions: int = 100,
+             negative_space_value: float = -0.5,
+             learning_rate: float = 0.01,
+             n_iters: int = 201,
+             save_results: bool = False,
+             out_dir: str = "DiffFit_out",
+             out_dir_exist_ok: bool = False,
+             batch_molecules: bool = True,
+             coords_cache: AtomCoordsCache = None,
+             log_every: int = 10,
+             snapshot_epochs: list = (),
+             prune_epochs: list = (),
+             prune_fraction: float = 0.5,
+             prune_by: str = "loss",
+             max_memory_mb: float = None,
+             shift_sampling: str = "uniform",
+             rotation_sampling: str = "random",
+             rotation_resolution: float = None,
+             prescan_resolution: float = None,
+             atom_schedule: list = (),
+             bead_size: float = None,
+             bead_cache_paths: list = None,
+             target_resolution: float = None,
+             reference_resolution: float = None,
+             reference_weights: list = None,
+             fit_engine: FitEngine = None,
+             device: str = "cpu"
+             ):
+    """
+    @param reference_weights: weight of each atom of each molecule in the reference density of reference_resolution,
+                              e.g., coords_reader.atomic_numbers() like the simulated maps, the atoms weigh the same
+                              if None
+    """
+    timer_start = datetime.now()
 
     if save_results:
+        os.makedirs(out_dir, exist_ok=out_dir_exist_ok)
         with open(f"{out_dir}/log.log", "a") as log_file:
-            log_file.write(f"Time elapsed: {timer_stop - timer_start}\n\n")
+            log_file.write(f"Wall clock time: {datetime.now()}\n")
+
+    # ======= load target volume to fit into, unless it is already preprocessed
+    if fit_engine is None:
+        fit_engine = FitEngine.from_volume_list(volume_list, volume_steps, volume_origin, min_island_size,
+                                                negative_space_value, target_resolution=target_resolution,
+                                                device=device)
 
-    # convert quaternion to ChimeraX, Houdini, scipy system and normalize it
+    if target_resolution and mol_sim_maps is not None:
+        mol_sim_maps = [downsample_volume(data, steps, origin, resample_factor(steps, target_resolution))
+                        for data, steps, origin in mol_sim_maps]
 
-    e_sqd_ChimeraX_q = torch.cat([-e_sqd_log[..., 4:7], e_sqd_log[..., 3].unsqueeze(-1)], dim=-1)
-    e_sqd_log[:, :, :, :, 3:7] = e_sqd_ChimeraX_q
+    mol_centers, e_sqd_log = fit_engine.fit(mol_coords, mol_sim_maps, N_shifts, N_quaternions, learning_rate,
+                                            n_iters, batch_molecules, coords_cache, log_every, snapshot_epochs,
+                                            prune_epochs, prune_fraction, prune_by, max_memory_mb, shift_sampling,
+                                            rotation_sampling, rotation_resolution, prescan_resolution,
+                                            atom_schedule, bead_size, bead_cache_paths, reference_resolution,
+                                            reference_weights,
+                                            log_path=f"{out_dir}/log.log" if save_results else None)
 
-    q_norms = torch.linalg.vector_norm(e_sqd_log[:, :, :, :, 3:7], dim=-1, keepdim=True)
-    e_sqd_log[:, :, :, :, 3:7] /= q_norms
+    timer_stop = datetime.now()
 
     e_sqd_log_np = e_sqd_log.detach().cpu().numpy()
 
     if save_results:
-        np.savez_compressed(f"{out_dir}/fit_res.npz", mol_centers=mol_centers, opt_res=e_sqd_log_np)
-        # np.save(f"{out_dir}/sampled_coords.npy", sampled_coords)
+        with open(f"{out_dir}/log.log", "a") as log_file:
+            log_file.write(f"Time elapsed: {timer_stop - timer_start}\n\n")
 
-    # e_sqd_log_np = e_sqd_log.detach().cpu().numpy()
-    # N_mol, N_quat, N_shift, N_iter, N_metric = e_sqd_log_np
-    # e_sqd_log_np = e_sqd_log_np.reshape([N_mol, N_quat * N_shift, N_iter, N_metric])
-    # e_sqd_clusters_ordered = cluster_and_sort_sqd_fast(e_sqd_log_np, shift_tolerance=3.0, angle_tolerance=6.0)
+        np.savez_compressed(f"{out_dir}/fit_res.npz", mol_centers=mol_centers, opt_res=e_sqd_log_np,
+                            log_epochs=fit_engine.log_epochs)
 
-    # Each record is in length of 11 as [shift 3, quat 4, quality metric 4]
-    # quality metric: occupied_density_avg (idx: 7), overlap (idx: 8), correlation (idx: 9), cam (idx: 10)
     return mol_centers, e_sqd_log_np
 
 
@@ -799,161 +2426,95 @@ def diff_atom_comp(target_vol_path: str,
                    conv_loops: int = 10,
                    conv_kernel_sizes: list = (5, 5, 5, 5, 5, 5, 5, 5, 5, 5),
                    conv_weights: list = (1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0),
+                   conv_backend: str = "auto",
+                   conv_pyramid: str = "chained",
+                   target_cache: TargetCache = None,
+                   batch_molecules: bool = True,
+                   coords_cache: AtomCoordsCache = None,
+                   log_every: int = 10,
+                   snapshot_epochs: list = (),
+                   prune_epochs: list = (),
+                   prune_fraction: float = 0.5,
+                   prune_by: str = "loss",
+                   max_memory_mb: float = None,
+                   shift_sampling: str = "uniform",
+                   rotation_sampling: str = "random",
+                   rotation_resolution: float = None,
+                   prescan_resolution: float = None,
+                   atom_schedule: list = (),
+                   bead_size: float = None,
+                   target_resolution: float = None,
+                   structures_npy_dir: str = None,
+                   load_workers: int = None,
+                   # threads, which work wherever the fit runs from, only overlap reading the structure files,
+                   # processes also parse them in parallel, the command line uses them
+                   load_processes: bool = False,
+                   dataset_bundle: str = None,
+                   sim_map_resolution: float = None,
+                   sim_map_grid_spacing: float = None,
+                   reference_resolution: float = None,
+                   fit_engine: FitEngine = None,
                    device: str = "cpu"
                    ):
     timer_start = datetime.now()
-    # ======= load target volume to fit into
-
-    target_no_negative, target_steps, target_origin = mrc_to_npy(target_vol_path)
-    # target dim is in [z, y, x]
-    # target_origin is in [x, y, z]
-
-    target_no_negative, eligible_volume, cluster_center_indices = filter_volume(target_no_negative,
-                                                                                target_surface_threshold,
-                                                                                min_cluster_size)
-
-    sampled_indices = random_sample_indices(eligible_volume, N_shifts)
-    # convert sampled_indices to angstrom space coords
-    sampled_coords = np.array([np.array(idx) * np.array(target_steps) for idx in sampled_indices])
-    sampled_coords = sampled_coords[:, [2, 1, 0]] + target_origin  # convert to [x, y, z] and then shift
-
-    target_no_negative, target_dim = numpy2tensor(target_no_negative, device)
-    # target as [1, 1, z, y, x]
-    # target_dim as [z, y, x]
-
-    target_size = np.array(list(map(operator.mul, target_dim, target_steps)))  # in [z, y, x]
-
-    target_no_negative = linear_norm_tensor(target_no_negative)
-    # np.save(f"{os.path.dirname(target_vol_path)}/target_filtered_normalized.npy",
-    #         target_no_negative.squeeze().detach().cpu().numpy())
-
-    # negative space in target volume
-    eligible_volume_tensor = torch.tensor(eligible_volume, device=device).unsqueeze_(0).unsqueeze_(0)
-    target = target_no_negative.clone()
-    target[~eligible_volume_tensor] = negative_space_value
-    # target[~eligible_volume_tensor] = -target[eligible_volume_tensor].mean()
-
-    # ======= create convoluted target volumes
-
-    if len(conv_weights) != conv_loops:
-        raise ValueError("Length of conv_weights does not match conv_loops! ")
-
-    target_gaussian_conv_list = conv_volume(target_no_negative, device, conv_loops, conv_kernel_sizes,
-                                            negative_space_value, kernel_type="Gaussian")
-
-    atom_coords_list = read_all_files_to_atom_coords_list(structures_dir)  # atom coords as [x, y, z]
-    mol_centers = [np.mean(coords, axis=0) for coords in atom_coords_list]
-    num_molecules = len(atom_coords_list)
-
-    # read simulated map
-    sim_map_list = mrc_folder_to_npy_list(structures_sim_map_dir)
-    elements_sim_density_list = sample_sim_map(atom_coords_list, sim_map_list, num_molecules, device)
-
-    # ======= optimization
-
-    # Init params
-
-    e_quaternions = generate_random_quaternions(N_quaternions * N_shifts)
-
-    rotated_centers_array = np.array(rotate_centers(mol_centers, e_quaternions))
-
-    e_shifts = sampled_coords - rotated_centers_array.reshape([num_molecules, N_quaternions, N_shifts, 3])
-
-    e_quaternions = e_quaternions.reshape([N_quaternions, N_shifts, 4])
-    e_quaternions = np.repeat(e_quaternions[np.newaxis, :, :, :], num_molecules, axis=0)
-
-    e_shifts = torch.tensor(e_shifts, device=device).float().detach().requires_grad_(True)
-    e_quaternions = torch.tensor(e_quaternions, device=device).float().detach().requires_grad_(True)
-
-    # coordinates is in [x, y, z]
-    # target_size is in [z, y, x]
-    # make the conversion here
-    target_size_x_y_z = [target_size[2], target_size[1], target_size[0]]
-    target_size_x_y_z_tensor = torch.tensor(target_size_x_y_z, device=device).float()
-    target_origin_tensor = torch.tensor(target_origin, device=device).float()
 
-    # Training loop
-    log_every = 10
-
-    e_sqd_log = torch.zeros([num_molecules, N_quaternions, N_shifts, int(n_iters / 10) + 2, 12], device=device)
-    # [x, y, z, w, -x, -y, -z, occupied_density_sum]
-
-    with torch.no_grad():
-        e_sqd_log[:, :, :, 0, 0:3] = e_shifts
-        e_sqd_log[:, :, :, 0, 3:7] = e_quaternions
+    # ======= load target volume to fit into, unless it is already preprocessed
+    if fit_engine is None:
+        fit_engine = FitEngine.from_file(target_vol_path, target_surface_threshold, min_cluster_size,
+                                         negative_space_value, conv_loops, conv_kernel_sizes, conv_weights,
+                                         conv_backend, conv_pyramid, target_cache,
+                                         target_resolution=target_resolution, device=device)
+
+    if dataset_bundle is not None:
+        # structures and simulated maps from a single file instead of the two folders
+        bundle, atom_coords_list, sim_map_list = read_dataset_bundle(dataset_bundle, target_resolution)
+        bead_paths = bead_cache_paths(dataset_bundle, bead_size, bundle.names) if bead_size else None
+        # the atoms weigh by their atomic number in the reference density, like in the simulated maps
+        reference_weights = bundle.atom_weights_list() if reference_resolution else None
+        if reference_weights is not None:
+            warn_equal_weights(bundle.names, reference_weights)
+    else:
+        # atom coords as [x, y, z]
+        atom_coords_list = read_all_files_to_atom_coords_list(structures_dir, structures_npy_dir, load_workers,
+                                                              load_processes)
+
+        if reference_resolution and not prescan_resolution:
+            # the reference density comes from the atoms, the maps are not needed
+            sim_map_list = None
+        elif sim_map_resolution:
+            # simulate the maps here instead of reading them from structures_sim_map_dir
+            sim_map_list = simulate_sim_maps(structures_dir, sim_map_resolution, sim_map_grid_spacing,
+                                             num_workers=load_workers, device=device)
+            sim_map_list = [downsample_volume(data, steps, origin, resample_factor(steps, target_resolution))
+                            for data, steps, origin in sim_map_list]
+        else:
+            # read simulated map
+            sim_map_list = mrc_folder_to_npy_list(structures_sim_map_dir, target_resolution,
+                                                  num_workers=load_workers)
+        bead_paths = bead_cache_paths(structures_dir, bead_size) if bead_size else None
+        # the atoms weigh by their atomic number in the reference density, like in the simulated maps
+        reference_weights = read_atom_weights_list(folder_file_paths(structures_dir), atom_coords_list,
+                                                   load_workers, load_processes) if reference_resolution else None
 
-    log_idx = 0
     os.makedirs(out_dir, exist_ok=out_dir_exist_ok)
 
     with open(f"{out_dir}/log.log", "a") as log_file:
         log_file.write(f"Wall clock time: {datetime.now()}\n")
 
-    # Create the optimizer with different learning rates
-    optimizer = torch.optim.Adam([
-        {'params': [e_shifts], 'lr': target_size.mean() * 0.01},
-        {'params': [e_quaternions], 'lr': learning_rate}
-    ])
-
-    for epoch in range(n_iters):
-        # Forward pass
-
-        first_layer_positive_density_sum = torch.zeros([num_molecules, N_quaternions, N_shifts], device=device)
-        occupied_density_sum = torch.zeros([num_molecules, N_quaternions, N_shifts], device=device)
-        metrics_table = torch.zeros([num_molecules, N_quaternions, N_shifts, 4], device=device)
-
-        for mol_idx in range(num_molecules):
-            grid = transform_coords(atom_coords_list[mol_idx],
-                                    e_quaternions[mol_idx],
-                                    e_shifts[mol_idx],
-                                    target_size_x_y_z_tensor, target_origin_tensor, device)
-            render = torch.nn.functional.grid_sample(target, grid, 'bilinear', 'border', align_corners=True)
-
-            metrics_table[mol_idx] = calculate_metrics(render, elements_sim_density_list[mol_idx])
-
-            occupied_density_sum[mol_idx] = torch.sum(render, dim=-1).squeeze()
-            first_layer_positive_density_sum[mol_idx] = torch.sum(render * (render > 0), dim=-1).squeeze()
-
-            add_conv_density(conv_loops, target_gaussian_conv_list, conv_weights, grid, occupied_density_sum[mol_idx])
-
-            occupied_density_sum[mol_idx] /= len(atom_coords_list[mol_idx])
-
-        # loss
-        loss = -torch.sum(occupied_density_sum)
-        # gradients
-        loss.backward()
-
-        # update weights
-        optimizer.step()
-        optimizer.zero_grad()
-
-        # log
-        if (epoch - 1) % log_every == (log_every - 1):
-            with torch.no_grad():
-                log_idx += 1
-                e_sqd_log[:, :, :, log_idx, 0:3] = e_shifts
-                e_sqd_log[:, :, :, log_idx, 3:7] = e_quaternions
-                e_sqd_log[:, :, :, log_idx, 7] = first_layer_positive_density_sum
-                e_sqd_log[:, :, :, log_idx, 8:12] = metrics_table
-
-                with open(f"{out_dir}/log.log", "a") as log_file:
-                    log_file.write(f"Epoch: {epoch + 1:05d}, "
-                                   f"loss = {loss:.4f}\n")
-
+    mol_centers, e_sqd_log = fit_engine.fit(atom_coords_list, sim_map_list, N_shifts, N_quaternions, learning_rate,
+                                            n_iters, batch_molecules, coords_cache, log_every, snapshot_epochs,
+                                            prune_epochs, prune_fraction, prune_by, max_memory_mb, shift_sampling,
+                                            rotation_sampling, rotation_resolution, prescan_resolution,
+                                            atom_schedule, bead_size, bead_paths, reference_resolution,
+                                            reference_weights, log_path=f"{out_dir}/log.log")
 
     timer_stop = datetime.now()
 
     with open(f"{out_dir}/log.log", "a") as log_file:
         log_file.write(f"Time elapsed: {timer_stop - timer_start}\n\n")
 
-    # convert quaternion to ChimeraX, Houdini, scipy system and normalize it
-
-    e_sqd_ChimeraX_q = torch.cat([-e_sqd_log[..., 4:7], e_sqd_log[..., 3].unsqueeze(-1)], dim=-1)
-    e_sqd_log[:, :, :, :, 3:7] = e_sqd_ChimeraX_q
-
-    q_norms = torch.linalg.vector_norm(e_sqd_log[:, :, :, :, 3:7], dim=-1, keepdim=True)
-    e_sqd_log[:, :, :, :, 3:7] /= q_norms
-
-    np.savez_compressed(f"{out_dir}/fit_res.npz", mol_centers=mol_centers, opt_res=e_sqd_log.detach().cpu().numpy())
+    np.savez_compressed(f"{out_dir}/fit_res.npz", mol_centers=mol_centers, opt_res=e_sqd_log.detach().cpu().numpy(),
+                        log_epochs=fit_engine.log_epochs)
     # np.save(f"{out_dir}/sampled_coords.npy", sampled_coords)
 
     # e_sqd_log_np = e_sqd_log.detach().cpu().numpy()
@@ -961,8 +2522,6 @@ def diff_atom_comp(target_vol_path: str,
     # e_sqd_log_np = e_sqd_log_np.reshape([N_mol, N_quat * N_shift, N_iter, N_metric])
     # e_sqd_clusters_ordered = cluster_and_sort_sqd_fast(e_sqd_log_np, shift_tolerance=3.0, angle_tolerance=6.0)
 
-    # Each record is in length of 11 as [shift 3, quat 4, quality metric 4]
-    # quality metric: occupied_density_avg (idx: 7), overlap (idx: 8), correlation (idx: 9), cam (idx: 10)
     return mol_centers, e_sqd_log
 
 
@@ -993,6 +2552,16 @@ if __name__ == '__main__':
                         help="directory containing the structures to be fit")
     parser.add_argument('--structures_sim_map_dir', type=str,
                         help="directory containing the simulated map from the structures to be fit")
+    parser.add_argument('--sim_map_resolution', type=float,
+                        help="simulate the maps of the structures at this resolution instead of reading "
+                             "structures_sim_map_dir")
+    parser.add_argument('--reference_resolution', type=float,
+                        help="compute the reference density of the quality metrics from the atoms at this "
+                             "resolution instead of sampling the simulated maps")
+    parser.add_argument('--dataset_bundle', type=str,
+                        help="dataset bundle to fit instead of structures_dir and structures_sim_map_dir")
+    parser.add_argument('--build_dataset_bundle', type=str,
+                        help="pack structures_dir and structures_sim_map_dir into this dataset bundle and exit")
 
     parser.add_argument('--out_dir_exist_ok', type=bool,
                         help="if True, output directory will be overwritten when existing")
@@ -1006,8 +2575,18 @@ if __name__ == '__main__':
     parser.add_argument('--negative_space_value', type=float, default=-0.5,
                         help="The value to set the negative space voxels to")
 
+    parser.add_argument('--load_threads', action='store_true',
+                        help="parse the structure files on threads instead of processes, "
+                             "threads only overlap the reading of the files")
+
     args = parser.parse_args()
 
+    if args.build_dataset_bundle:
+        names = build_dataset_bundle(args.build_dataset_bundle, args.structures_dir, args.structures_sim_map_dir,
+                                     use_processes=not args.load_threads)
+        print(f"Packed {len(names)} molecules into {args.build_dataset_bundle}")
+        sys.exit()
+
     # ======= fitting and time it
     timer_start = datetime.now()
 
@@ -1019,7 +2598,11 @@ if __name__ == '__main__':
                    out_dir_exist_ok=args.out_dir_exist_ok,
                    N_shifts=args.N_shifts,
                    N_quaternions=args.N_quaternions,
-                   negative_space_value=args.negative_space_value)
+                   negative_space_value=args.negative_space_value,
+                   dataset_bundle=args.dataset_bundle,
+                   sim_map_resolution=args.sim_map_resolution,
+                   reference_resolution=args.reference_resolution,
+                   load_processes=not args.load_threads)
 
     timer_stop = datetime.now()
 
@@ -1,6 +1,8 @@
 import torch
 import matplotlib.pyplot as plt
 import numpy as np
+import math
+from functools import lru_cache
 
 def generate_grid_coordinates(start: float=-0.03, end: float=0.03, steps: int=3):
     # Example grid size for each dimension
@@ -78,6 +80,59 @@ def generate_random_quaternions(n):
     return quaternions
 
 
+@lru_cache(maxsize=32)
+def _super_fibonacci_table(n):
+    # Alexa, "Super-Fibonacci Spirals: Fast, Low-Discrepancy Sampling of SO(3)", CVPR 2022
+    phi = math.sqrt(2.0)
+    psi = 1.533751168755204288118041
+
+    s = np.arange(n) + 0.5
+    r = np.sqrt(s / n)
+    big_r = np.sqrt(1.0 - s / n)
+    alpha = 2.0 * np.pi * s / phi
+    beta = 2.0 * np.pi * s / psi
+
+    quaternions = np.stack([r * np.sin(alpha), r * np.cos(alpha),
+                            big_r * np.sin(beta), big_r * np.cos(beta)], axis=-1)
+    quaternions.flags.writeable = False
+
+    return quaternions
+
+
+def num_quaternions_for_resolution(angle_deg):
+    """
+    The number of rotations that covers SO(3) with about the given angular spacing.
+
+    Parameters:
+    - angle_deg: The angular resolution in degrees.
+
+    Returns:
+    - n: ceil(8 * pi^2 / theta^3), the volume of SO(3) over the volume of a cell of size theta.
+    """
+    theta = math.radians(angle_deg)
+    return math.ceil(8 * math.pi ** 2 / theta ** 3)
+
+
+def generate_super_fibonacci_quaternions(n=None, angle_deg=None):
+    """
+    Generate n deterministic quaternions that cover SO(3) quasi-uniformly (super-Fibonacci spiral).
+    The tables are cached, so asking for the same set again is free.
+
+    Parameters:
+    - n: The number of quaternion vectors to generate.
+    - angle_deg: If n is None, the angular resolution in degrees to derive n from.
+
+    Returns:
+    - quaternions: An array of shape (n, 4) as [w, x, y, z], the same layout as generate_random_quaternions.
+    """
+    if n is None:
+        if angle_deg is None:
+            raise ValueError("Either n or angle_deg is needed")
+        n = num_quaternions_for_resolution(angle_deg)
+
+    return _super_fibonacci_table(int(n)).copy()
+
+
 def quaternion_angle_distance(q1, q2):
     # Function to calculate the angular distance in degrees between two quaternions
 
@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 """
-Script for ChimeraX to extract each chain from a structure,
-save them as separate PDB files, and generate MRC files for each chain.
+Script for ChimeraX to save the coordinates of each structure in a folder as a npy file
+and generate an MRC file for each structure.
+
+Pass --skip-up-to-date after the parameters to skip the structures whose npy and MRC files are newer than them.
+Pass --molmap-backend=chimerax to simulate the maps with the molmap command of ChimeraX instead of
+the batched molmap of the DiffFit bundle, which is the default.
 """
 
 # Import necessary modules
 import os, sys
+import json
 from chimerax.core.commands import run
+from chimerax.atomic import concatenate
 from datetime import datetime
 import numpy as np
 
@@ -20,43 +26,80 @@ out_mrc_dir = sys.argv[2]  # Directory to save output mrc files
 out_npy_dir = sys.argv[3]  # Directory to save output npy files
 resolution = float(sys.argv[4])  # Resolution for simulated MRC files
 gridSpacing = float(sys.argv[5])  # gridSpacing for simulated MRC files
+skip_up_to_date = "--skip-up-to-date" in sys.argv[6:]
+# --molmap-backend=batch simulates the maps of all structures together with the DiffFit bundle,
+# --molmap-backend=chimerax runs the molmap command of ChimeraX one structure at a time
+molmap_backend = next((option.split("=", 1)[1] for option in sys.argv[6:]
+                       if option.startswith("--molmap-backend=")), "batch")
+if molmap_backend == "batch":
+    try:
+        from chimerax.difffit.molmap import molmap_batch, molmap_label, save_molmap
+    except ImportError as e:
+        raise ImportError("The batch molmap backend needs the DiffFit bundle, "
+                          "install it or pass --molmap-backend=chimerax") from e
+elif molmap_backend != "chimerax":
+    raise ValueError(f"Unknown molmap backend: {molmap_backend}, should be 'batch' or 'chimerax'")
+print(f"Simulating the maps with the {molmap_backend} molmap backend")
+
+
+def is_up_to_date(input_path, output_paths):
+    return all(os.path.isfile(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+               for output_path in output_paths)
+
+
+# the maps of all structures are simulated together at the end
+mrc_filepath_list = []
+atoms_coords_list = []
+atoms_weights_list = []
 
 for file_name in os.listdir(structures_dir):
-    print(f"\n======= Processing {file_name} =======")
     full_path = os.path.join(structures_dir, file_name)
     # Check if the current path is a file and not a directory
     if os.path.isfile(full_path):
-        # Open the input structure
-        structure = run(session, f'open {full_path}')[0]
-
         # Get the base name of the input structure for naming output files
         structure_basename = os.path.basename(full_path).split('.')[0]
+        npy_filepath = os.path.join(out_npy_dir, f"{structure_basename}.npy")
+        mrc_filepath = os.path.join(out_mrc_dir, f"{structure_basename}.mrc")
+
+        if skip_up_to_date and is_up_to_date(full_path, (npy_filepath, mrc_filepath)):
+            print(f"\n======= Skipping {file_name}, up to date =======")
+            continue
 
-        # Save the structure's coordinates as a npy file
-        npy_filename = f"{structure_basename}.npy"
-        npy_filepath = os.path.join(out_npy_dir, npy_filename)
-        atom_coordinates = []
-        for chain in structure.chains:
-            # Iterate through each residue in the chain to access its atoms
-            for residue in chain.residues:
-                # Check if the residue is not None
-                if residue is not None:
-                    for atom in residue.atoms:
-                        # Append the atom's coordinates to our list
-                        atom_coordinates.append(atom.coord)
-        # Convert the list of coordinates to a NumPy array
-        coordinates_array = np.array(atom_coordinates)
+        print(f"\n======= Processing {file_name} =======")
+        # Open the input structure
+        structure = run(session, f'open {full_path}')[0]
+
+        # Save the coordinates of the atoms of the chains' residues as a npy file, in chain and residue order
+        if len(structure.chains) > 0:
+            coordinates_array = concatenate([chain.existing_residues for chain in structure.chains]).atoms.coords
+        else:
+            coordinates_array = np.zeros((0, 3))
         np.save(npy_filepath, coordinates_array)
+        # the record that DiffAtomComp.read_file_and_get_coordinates() checks, the chain residues are another
+        # selection than the atoms of its reader, so the coords are not taken for them
+        source_stat = os.stat(full_path)
+        with open(os.path.join(out_npy_dir, f"{structure_basename}.json"), "w") as f:
+            json.dump(dict(source_size=source_stat.st_size, source_mtime_ns=source_stat.st_mtime_ns,
+                           selection="chimerax_chain_residues"), f)
 
         # Generate and save the MRC file for the structure
-        mrc_filename = f"{structure_basename}.mrc"
-        mrc_filepath = os.path.join(out_mrc_dir, mrc_filename)
-
-        vol = run(session, f'molmap #{structure.id[0]} {resolution} gridSpacing {gridSpacing}')
-        run(session, f"save {mrc_filepath} #{vol.id[0]}")
+        if molmap_backend == "batch":
+            mrc_filepath_list.append(mrc_filepath)
+            atoms_coords_list.append(structure.atoms.coords)
+            atoms_weights_list.append(structure.atoms.element_numbers.astype(np.float32))
+        else:
+            vol = run(session, f'molmap #{structure.id[0]} {resolution} gridSpacing {gridSpacing}')
+            run(session, f"save {mrc_filepath} #{vol.id[0]}")
+            run(session, f"close #{vol.id[0]}")
 
         run(session, f"close #{structure.id[0]}")
-        run(session, f"close #{vol.id[0]}")
+
+if mrc_filepath_list:
+    print(f"\n======= Simulating {len(mrc_filepath_list)} maps with the batch molmap backend =======")
+    sim_map_list = molmap_batch(atoms_coords_list, resolution, gridSpacing, atoms_weights_list)
+    for mrc_filepath, sim_map, atom_coords, weights in zip(mrc_filepath_list, sim_map_list, atoms_coords_list,
+                                                          atoms_weights_list):
+        save_molmap(mrc_filepath, sim_map, molmap_label(atom_coords, weights, resolution, gridSpacing))
 
 
 print("Process completed.")
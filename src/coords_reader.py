@@ -0,0 +1,225 @@
+"""Coordinate-only readers for PDB and mmCIF files
+
+Only the atom records are parsed, into columns, without building a Bio.PDB structure.
+The atoms come out in the order and with the alternate locations that Bio.PDB iterates them in:
+model, then chain, residue and atom in the order they first appear, and of the alternate locations of
+an atom the one with the highest occupancy (the first one on ties).
+"""
+
+import re
+
+import numpy as np
+
+
+# a quoted value or any other token of an mmCIF data row
+_CIF_TOKEN = re.compile(r"'(?:[^']|'(?=\S))*'(?=\s|$)|\"(?:[^\"]|\"(?=\S))*\"(?=\s|$)|\S+")
+
+_UNASSIGNED = {".", "?"}
+
+# the atoms the readers keep, recorded with the coords that are cached so that coords of another selection,
+# e.g., of the chain residues that convert2mrc_npy.py saves, are not taken for them
+SELECTION = "all_models_highest_occupancy_altloc"
+
+# atomic numbers of the elements common in macromolecular models, others count as carbon
+ATOMIC_NUMBERS = {"H": 1, "D": 1, "C": 6, "N": 7, "O": 8, "F": 9, "NA": 11, "MG": 12, "P": 15, "S": 16, "CL": 17,
+                  "K": 19, "CA": 20, "MN": 25, "FE": 26, "CO": 27, "NI": 28, "CU": 29, "ZN": 30, "SE": 34, "BR": 35,
+                  "CD": 48, "I": 53, "PT": 78, "AU": 79, "HG": 80}
+
+
+def atomic_numbers(elements):
+    return np.array([ATOMIC_NUMBERS.get(element.upper(), 6) for element in elements], dtype=np.float32)
+
+
+def select_atoms(model_ids, chain_ids, residue_ids, atom_names, altlocs, occupancies):
+    """Order of the atoms to keep, following the Bio.PDB hierarchy
+
+    @param model_ids, chain_ids, residue_ids, atom_names, altlocs, occupancies: one entry per atom record
+    @return: int array of the record indices
+    """
+    # model -> chain -> residue -> atom name -> [record index, occupancy], dicts keep the order of insertion
+    models = {}
+    for idx, (model_id, chain_id, residue_id, atom_name) in enumerate(zip(model_ids, chain_ids, residue_ids,
+                                                                          atom_names)):
+        atoms = models.setdefault(model_id, {}).setdefault(chain_id, {}).setdefault(residue_id, {})
+        atom = atoms.get(atom_name)
+        if atom is None:
+            atoms[atom_name] = [idx, occupancies[idx]]
+        elif altlocs[idx] != " " and occupancies[idx] > atom[1]:
+            # the alternate location with the highest occupancy, at the place of the first one
+            atom[0], atom[1] = idx, occupancies[idx]
+
+    return np.array([atom[0]
+                     for chains in models.values()
+                     for residues in chains.values()
+                     for atoms in residues.values()
+                     for atom in atoms.values()], dtype=np.int64)
+
+
+def _float_or_zero(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def _pdb_element(line):
+    element = line[76:78].strip()
+    if element:
+        return element
+    # from the atom name, whose first two columns hold the element, right-justified for one letter elements
+    name = line[12:14]
+    return name[1] if name[0] == " " or name[0].isdigit() else name.strip()
+
+
+def read_pdb_coordinates(file_path):
+    """
+    @return: atom coords as [N_atoms, 3] float32 array in [x, y, z]
+    """
+    return read_pdb_atoms(file_path)[0]
+
+
+def read_pdb_atoms(file_path):
+    """
+    @return: atom coords as [N_atoms, 3] float32 array in [x, y, z] and list of their element symbols
+    """
+    records = []
+    model_ids = []
+    model_id = 0
+    with open(file_path) as f:
+        for line in f:
+            if line.startswith(("ATOM  ", "HETATM")):
+                records.append(line)
+                model_ids.append(model_id)
+            elif line.startswith("MODEL "):
+                model_id += 1
+
+    if len(records) == 0:
+        return np.zeros((0, 3), dtype=np.float32), []
+
+    residue_ids = []
+    for line in records:
+        resname = line[17:20]
+        if line.startswith("HETATM"):
+            hetfield = "W" if resname in ("HOH", "WAT") else "H_" + resname
+        else:
+            hetfield = " "
+        residue_ids.append((hetfield, int(line[22:26]), line[26]))
+
+    # like Bio.PDB, names with inner spaces are kept as they are
+    atom_names = [line[12:16].strip() if len(line[12:16].split()) == 1 else line[12:16] for line in records]
+    keep = select_atoms(model_ids, [line[21] for line in records], residue_ids, atom_names,
+                        [line[16] for line in records], [_float_or_zero(line[54:60]) for line in records])
+
+    coords = np.array([(line[30:38], line[38:46], line[46:54]) for line in records], dtype=np.float64)
+
+    return coords[keep].astype(np.float32), [_pdb_element(records[idx]) for idx in keep]
+
+
+def _cif_tokens(line):
+    if "'" in line or '"' in line:
+        return [token[1:-1] if token[0] in "'\"" else token for token in _CIF_TOKEN.findall(line)]
+    return line.split()
+
+
+def read_atom_site_columns(file_path):
+    """The columns of the _atom_site loop of an mmCIF file
+
+    @return: dict of column name (without the "_atom_site." prefix) to list of str values
+    """
+    column_names = []
+    with open(file_path) as f:
+        line = ""
+        for line in f:
+            if line.startswith("_atom_site."):
+                column_names.append(line.split()[0][len("_atom_site."):])
+            elif column_names:
+                break
+
+        if not column_names:
+            raise ValueError(f"No _atom_site loop in {file_path}")
+
+        # the values of all rows until the end of the loop, a row can go on over several lines
+        values = []
+        while line and not line.startswith(("#", "loop_", "_", "data_")):
+            values.extend(_cif_tokens(line))
+            line = next(f, "")
+
+    num_columns = len(column_names)
+    if len(values) % num_columns != 0:
+        raise ValueError(f"Malformed _atom_site loop in {file_path}")
+
+    return {name: values[column::num_columns] for column, name in enumerate(column_names)}
+
+
+def read_mmcif_coordinates(file_path):
+    """
+    @return: atom coords as [N_atoms, 3] float32 array in [x, y, z]
+    """
+    return read_mmcif_atoms(file_path)[0]
+
+
+def read_mmcif_atoms(file_path):
+    """
+    @return: atom coords as [N_atoms, 3] float32 array in [x, y, z] and list of their element symbols
+    """
+    columns = read_atom_site_columns(file_path)
+    num_records = len(columns["Cartn_x"])
+
+    def column(name, fallback=None, default="?"):
+        if name in columns:
+            return columns[name]
+        if fallback in columns:
+            return columns[fallback]
+        return [default] * num_records
+
+    # the same columns as Bio.PDB.MMCIFParser with its default auth chains and residues
+    chain_ids = column("auth_asym_id", "label_asym_id")
+    seq_ids = column("auth_seq_id", "label_seq_id")
+    resnames = columns["label_comp_id"]
+    atom_names = columns["label_atom_id"]
+    groups = column("group_PDB", default="ATOM")
+    icodes = column("pdbx_PDB_ins_code")
+    altlocs = column("label_alt_id")
+    occupancies = column("occupancy", default="1")
+
+    # a new model starts whenever the model number changes
+    model_numbers = column("pdbx_PDB_model_num", default="1")
+    model_ids = np.cumsum([idx == 0 or model_numbers[idx] != model_numbers[idx - 1] for idx in range(num_records)])
+
+    # records without a residue number are skipped, like in Bio.PDB
+    records = [idx for idx in range(num_records) if seq_ids[idx] != "."]
+
+    residue_ids = []
+    for idx in records:
+        if groups[idx] == "HETATM":
+            hetfield = "W" if resnames[idx] in ("HOH", "WAT") else "H"
+        else:
+            hetfield = " "
+        residue_ids.append((hetfield, int(seq_ids[idx]), " " if icodes[idx] in _UNASSIGNED else icodes[idx]))
+
+    keep = select_atoms([model_ids[idx] for idx in records], [chain_ids[idx] for idx in records], residue_ids,
+                        [atom_names[idx] for idx in records],
+                        [" " if altlocs[idx] in _UNASSIGNED else altlocs[idx] for idx in records],
+                        [_float_or_zero(occupancies[idx]) for idx in records])
+
+    coords = np.array([columns["Cartn_x"], columns["Cartn_y"], columns["Cartn_z"]], dtype=np.float64).T
+    keep = np.array(records, dtype=np.int64)[keep]
+    elements = column("type_symbol", default="C")
+
+    return coords[keep].astype(np.float32).reshape(-1, 3), [elements[idx] for idx in keep]
+
+
+def read_coordinates(file_path):
+    """Atom coords of a .pdb or .cif file as [N_atoms, 3] float32 array in [x, y, z]"""
+    return read_atoms(file_path)[0]
+
+
+def read_atoms(file_path):
+    """Atom coords of a .pdb or .cif file as [N_atoms, 3] float32 array in [x, y, z] and their element symbols"""
+    file_extension = file_path.rsplit(".", 1)[-1].lower()
+    if file_extension == "pdb":
+        return read_pdb_atoms(file_path)
+    elif file_extension == "cif":
+        return read_mmcif_atoms(file_path)
+
+    raise ValueError("Unsupported file format. Please provide a .mmcif or .pdb file.")
@@ -0,0 +1,201 @@
+"""Packed dataset bundle of the structures to fit and their simulated maps
+
+A bundle is a single file that holds, for each molecule, its name, the path, size and modification time of its
+structure file and of its simulated map file, its atom coords and their center, optionally the weight of each atom, e.g., its atomic number, and the voxels, steps and origin of its simulated map, so that the coords and the map of a molecule
+can not be mismatched like files in separate folders paired by order.
+
+Layout: the magic bytes, the byte length of the JSON header as little-endian uint64, the JSON header, and the arrays,
+each starting at a multiple of ALIGNMENT bytes so that they can be viewed in place in a memory map.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+DATASET_BUNDLE_EXTENSION = ".bundle"
+
+MAGIC = b"DIFFFIT\x00"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _bundle_relative_path(path, bundle_dir):
+    try:
+        return os.path.relpath(os.path.abspath(path), bundle_dir)
+    except ValueError:
+        # on Windows, a path on another drive has no relative path, it is kept absolute
+        return os.path.abspath(path)
+
+
+def _file_stat(path):
+    # size and modification time of a source file, None if it does not exist, e.g., coords computed in memory
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def write_dataset_bundle(bundle_path, names, structure_paths, atom_coords_list, sim_map_list, weights_list=None,
+                         sim_map_paths=None):
+    """Write a dataset bundle
+
+    @param names: molecule names
+    @param structure_paths: structure file of each molecule, kept relative to the bundle folder if they are on the
+                            same drive
+    @param atom_coords_list: atom coords of each molecule as [N_atoms, 3] in [x, y, z]
+    @param sim_map_list: simulated map of each molecule as (data [z, y, x], steps [z, y, x], origin [x, y, z])
+    @param weights_list: weight of each atom of each molecule as [N_atoms], None for a molecule without weights,
+                         no weights if None
+    @param sim_map_paths: simulated map file of each molecule, if the maps were read from files
+    """
+    num_molecules = len(names)
+    if weights_list is None:
+        weights_list = [None] * num_molecules
+    if sim_map_paths is None:
+        sim_map_paths = [None] * num_molecules
+    if not (len(structure_paths) == len(atom_coords_list) == len(sim_map_list) == len(weights_list)
+            == len(sim_map_paths) == num_molecules):
+        raise ValueError("names, structure_paths, atom_coords_list, sim_map_list, weights_list and sim_map_paths "
+                         "must have the same length")
+
+    bundle_dir = os.path.dirname(os.path.abspath(bundle_path))
+
+    arrays = []
+    molecules = []
+    for name, structure_path, atom_coords, (sim_map, steps, origin), weights, sim_map_path in zip(
+            names, structure_paths, atom_coords_list, sim_map_list, weights_list, sim_map_paths):
+        atom_coords = np.ascontiguousarray(atom_coords, dtype=np.float32)
+        sim_map = np.ascontiguousarray(sim_map, dtype=np.float32)
+        molecules.append(dict(name=name,
+                              structure_path=_bundle_relative_path(structure_path, bundle_dir),
+                              structure_stat=_file_stat(structure_path),
+                              center=np.mean(atom_coords, axis=0).tolist(),
+                              steps=[float(step) for step in steps],
+                              origin=[float(o) for o in origin],
+                              coords=dict(shape=list(atom_coords.shape)),
+                              sim_map=dict(shape=list(sim_map.shape))))
+        if sim_map_path is not None:
+            molecules[-1]["sim_map_path"] = _bundle_relative_path(sim_map_path, bundle_dir)
+            molecules[-1]["sim_map_stat"] = _file_stat(sim_map_path)
+        arrays.extend([(molecules[-1]["coords"], atom_coords), (molecules[-1]["sim_map"], sim_map)])
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.float32)
+            if weights.shape != atom_coords.shape[:1]:
+                raise ValueError(f"{len(weights)} weights for the {len(atom_coords)} atoms of {name}")
+            molecules[-1]["weights"] = dict(shape=list(weights.shape))
+            arrays.append((molecules[-1]["weights"], weights))
+
+    # the offsets are relative to the end of the header, whose length depends on them
+    offset = 0
+    for entry, array in arrays:
+        entry["offset"] = offset
+        entry["dtype"] = array.dtype.str
+        offset = _aligned(offset + array.nbytes)
+
+    header = json.dumps(dict(version=VERSION, molecules=molecules)).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f"{bundle_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for entry, array in arrays:
+            f.write(b"\0" * (data_start + entry["offset"] - f.tell()))
+            f.write(memoryview(array).cast("B"))
+    os.replace(tmp_path, bundle_path)
+
+
+class DatasetBundle:
+    """A dataset bundle opened with a single memory map, the arrays are read-only views of it"""
+
+    def __init__(self, bundle_path):
+        self.path = bundle_path
+
+        with open(bundle_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{bundle_path} is not a dataset bundle")
+            header_length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        if header["version"] != VERSION:
+            raise ValueError(f"Unsupported dataset bundle version {header['version']} in {bundle_path}")
+
+        self.molecules = header["molecules"]
+        self._data_start = _aligned(len(MAGIC) + 8 + header_length)
+        self._buffer = np.memmap(bundle_path, dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.molecules)
+
+    def _array(self, entry):
+        dtype = np.dtype(entry["dtype"])
+        start = self._data_start + entry["offset"]
+        count = int(np.prod(entry["shape"]))
+        return self._buffer[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+
+    @property
+    def names(self):
+        return [molecule["name"] for molecule in self.molecules]
+
+    def _source_path(self, relative_path):
+        return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(self.path)), relative_path))
+
+    def structure_path(self, mol_idx):
+        return self._source_path(self.molecules[mol_idx]["structure_path"])
+
+    def sim_map_path(self, mol_idx):
+        # None if the map was not read from a file or the bundle does not record it
+        relative_path = self.molecules[mol_idx].get("sim_map_path")
+        return None if relative_path is None else self._source_path(relative_path)
+
+    def stale_files(self):
+        """Source files whose size or modification time differ from when the bundle was written, or that are gone
+
+        Files whose size and time the bundle does not record, e.g., of an older bundle, are not checked.
+        """
+        stale = []
+        for mol_idx, molecule in enumerate(self.molecules):
+            for path, stat in ((self.structure_path(mol_idx), molecule.get("structure_stat")),
+                               (self.sim_map_path(mol_idx), molecule.get("sim_map_stat"))):
+                if path is not None and stat is not None and _file_stat(path) != stat:
+                    stale.append(path)
+        return stale
+
+    def atom_coords(self, mol_idx):
+        return self._array(self.molecules[mol_idx]["coords"])
+
+    def atom_weights(self, mol_idx):
+        # None if the bundle has no weights of the molecule, e.g., of a bundle written before they were kept
+        entry = self.molecules[mol_idx].get("weights")
+        return None if entry is None else self._array(entry)
+
+    def center(self, mol_idx):
+        return np.array(self.molecules[mol_idx]["center"], dtype=np.float32)
+
+    def sim_map(self, mol_idx):
+        """
+        @return: data [z, y, x], steps [z, y, x] and origin [x, y, z] like mrc_to_npy()
+        """
+        molecule = self.molecules[mol_idx]
+        return self._array(molecule["sim_map"]), molecule["steps"], molecule["origin"]
+
+    def atom_coords_list(self):
+        return [self.atom_coords(mol_idx) for mol_idx in range(len(self))]
+
+    def atom_weights_list(self):
+        return [self.atom_weights(mol_idx) for mol_idx in range(len(self))]
+
+    def sim_map_list(self):
+        return [self.sim_map(mol_idx) for mol_idx in range(len(self))]
+
+
+def is_dataset_bundle(path):
+    return os.path.isfile(path) and path.endswith(DATASET_BUNDLE_EXTENSION)
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def default_num_workers():
+    return min(8, os.cpu_count() or 1)
+
+
+def load_files(load_file, file_paths, num_workers=None, use_processes=False):
+    """Call load_file on each of the files on a thread or process pool
+
+    A file that cannot be loaded does not stop the others, it is reported in the returned errors.
+
+    @param load_file: function of a file path, must be picklable, i.e., defined at module level, with use_processes
+    @param num_workers: number of threads or processes, default_num_workers() if None, 1 loads in this thread
+    @param use_processes: load on a process pool, which pays off for files parsed in Python,
+                          threads are enough for files that are mostly I/O, e.g., maps
+    @return: list of the results in the order of file_paths, None for the files that failed,
+             and list of (file path, error message) of the files that failed
+    """
+    if num_workers is None:
+        num_workers = default_num_workers()
+    num_workers = min(num_workers, len(file_paths))
+
+    results = [None] * len(file_paths)
+    errors = []
+
+    if num_workers <= 1:
+        for idx, file_path in enumerate(file_paths):
+            try:
+                results[idx] = load_file(file_path)
+            except Exception as e:
+                errors.append((file_path, f"{type(e).__name__}: {e}"))
+        return results, errors
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=num_workers) as executor:
+        futures = [executor.submit(load_file, file_path) for file_path in file_paths]
+        # collected in submission order, so the order does not depend on which worker finishes first
+        for idx, (file_path, future) in enumerate(zip(file_paths, futures)):
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                errors.append((file_path, f"{type(e).__name__}: {e}"))
+
+    return results, errors
+
+
+def format_load_errors(errors):
+    return "\n".join(f"  {file_path}: {message}" for file_path, message in errors)
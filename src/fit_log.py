@@ -0,0 +1,39 @@
+"""The records of an e_sqd_log and the epochs they were logged at
+
+Record 0 holds the initial candidates, the others the candidates at the logged epochs, whose number depends on
+n_iters, log_every and snapshot_epochs of FitEngine.fit(). The engine saves the epoch of each record as log_epochs
+next to the log, e.g., in fit_res.npz, with -1 for record 0.
+
+The logs written before log_epochs was saved logged every 10 epochs of the default 201 iterations, their
+optimized records are 1 to 21, which is the range read from a log without log_epochs.
+"""
+
+import numpy as np
+
+
+INITIAL_EPOCH = -1
+
+# the optimized records of a log without log_epochs
+BASELINE_LOG_ROWS = slice(1, 22)
+
+
+def log_epochs_array(log_epochs):
+    # the epoch of each record, in the order the engine fills them
+    return np.array([INITIAL_EPOCH] + sorted(log_epochs), dtype=np.int64)
+
+
+def logged_rows(num_records, log_epochs=None):
+    """Records of the optimized candidates, the ones the best epoch of a candidate is searched in
+
+    @param num_records: number of records in the log, e_sqd_log.shape[-2]
+    @param log_epochs: the epoch of each record as saved by the engine, None for a log without them
+    @return: int array of the record indices
+    """
+    if log_epochs is None:
+        return np.arange(num_records)[BASELINE_LOG_ROWS]
+
+    log_epochs = np.asarray(log_epochs)
+    if len(log_epochs) != num_records:
+        raise ValueError(f"{len(log_epochs)} log epochs for a log of {num_records} records")
+
+    return np.flatnonzero(log_epochs != INITIAL_EPOCH)
@@ -0,0 +1,66 @@
+import numpy as np
+import mrcfile
+from mrcfile.bzip2mrcfile import Bzip2MrcFile
+from mrcfile.gzipmrcfile import GzipMrcFile
+from mrcfile.utils import data_dtype_from_header, data_shape_from_header
+
+
+class LazyVolume:
+    """A map in an MRC file, of which only the header is read up front
+
+    The voxel data are memory mapped on first use, so reading a subregion with volume[z0:z1, y0:y1, x0:x1]
+    only touches the pages it needs, and np.asarray(volume) reads the full data.
+    No file stays open, the mapping is released with release() or when the volume is garbage collected.
+    Compressed (gzip or bzip2) files can not be memory mapped, their data are decompressed in full on first use.
+    """
+
+    def __init__(self, mrc_filename):
+        self.path = mrc_filename
+
+        with mrcfile.open(mrc_filename, mode='r', header_only=True) as mrc:
+            header = mrc.header
+            # [z, y, x] like mrc.data
+            self.shape = tuple(int(dim) for dim in data_shape_from_header(header))
+            self.dtype = np.dtype(data_dtype_from_header(header))
+            self.steps = mrc.voxel_size.tolist()
+            self.origin = header.origin.tolist()
+            self._data_offset = header.nbytes + int(header.nsymbt)
+            self.compressed = isinstance(mrc, (GzipMrcFile, Bzip2MrcFile))
+
+        self._data = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def data(self):
+        """The voxel data as a read-only memory mapped [z, y, x] array, or an in-memory one if the file is compressed"""
+        if self._data is None:
+            if self.compressed:
+                with mrcfile.open(self.path, mode='r') as mrc:
+                    self._data = mrc.data.copy()
+                self._data.flags.writeable = False
+            else:
+                self._data = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self._data_offset,
+                                       shape=self.shape)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.data, dtype=dtype)
+        return np.asarray(self.data, dtype=dtype)
+
+    def release(self):
+        # the next access maps the file again
+        self._data = None
+
+    def __repr__(self):
+        return f"LazyVolume({self.path!r}, shape={self.shape}, dtype={self.dtype})"
@@ -0,0 +1,200 @@
+"""Simulated density maps of atomic models, like ChimeraX molmap, computed in PyTorch
+
+Each atom adds a Gaussian weighted by its atomic number, of standard deviation molmap_sigma(resolution),
+cut off at cutoff_range standard deviations along each axis, on a grid that pads the atoms' bounding box by
+edge_padding times the resolution, and the sum is normalized like molmap.
+All molecules of a batch are splatted together into one flat buffer with index_add_.
+"""
+
+import hashlib
+import math
+
+import mrcfile
+import numpy as np
+import torch
+
+
+SIGMA_FACTOR = 1 / (math.pi * math.sqrt(2))
+
+# the key of a simulated map in its MRC file, in the second header label
+MOLMAP_LABEL_PREFIX = "DiffFit molmap"
+
+
+def molmap_sigma(resolution, sigma_factor=SIGMA_FACTOR):
+    """Standard deviation of the Gaussian of each atom at a resolution, about 0.225 * resolution"""
+    return sigma_factor * resolution
+
+
+def molmap_grid(atom_coords, resolution, grid_spacing, edge_padding=3.0):
+    """
+    @return: origin in [x, y, z] and shape in [z, y, x] of the grid of the simulated map
+    """
+    pad = edge_padding * resolution
+    xyz_min = np.min(atom_coords, axis=0).astype(np.float64)
+    xyz_max = np.max(atom_coords, axis=0).astype(np.float64)
+    origin = xyz_min - pad
+    shape = [int(math.ceil((xyz_max[axis] - xyz_min[axis] + 2 * pad) / grid_spacing)) for axis in (2, 1, 0)]
+    return origin.tolist(), shape
+
+
+def molmap_batch(atom_coords_list, resolution, grid_spacing=None, weights_list=None, edge_padding=3.0,
+                 cutoff_range=5.0, sigma_factor=SIGMA_FACTOR, device="cpu", chunk_size=2 ** 22):
+    """Simulate the density maps of several molecules in one pass
+
+    @param atom_coords_list: atom coords of each molecule as [N_atoms, 3] in [x, y, z]
+    @param resolution: resolution in angstrom
+    @param grid_spacing: voxel size in angstrom, resolution / 3 if None
+    @param weights_list: weight of each atom of each molecule, e.g., from coords_reader.atomic_numbers(),
+                         every atom weighs as carbon if None
+    @param chunk_size: maximum number of voxel contributions computed at a time
+    @return: simulated map of each molecule as (data [z, y, x] float32, steps [z, y, x], origin [x, y, z])
+    """
+    if grid_spacing is None:
+        grid_spacing = resolution / 3
+
+    sdev = molmap_sigma(resolution, sigma_factor) / grid_spacing  # in voxels
+    radius = int(math.ceil(cutoff_range * sdev))
+    offsets = torch.arange(-radius, radius + 1, device=device)
+    num_offsets = len(offsets)
+
+    grids = [molmap_grid(atom_coords, resolution, grid_spacing, edge_padding) for atom_coords in atom_coords_list]
+    map_sizes = [int(np.prod(shape)) for _, shape in grids]
+    map_starts = np.concatenate([[0], np.cumsum(map_sizes)[:-1]]).astype(np.int64)
+    buffer = torch.zeros(int(sum(map_sizes)), dtype=torch.float32, device=device)
+
+    # all atoms of all molecules, with the grid of their molecule
+    ijk = torch.cat([torch.tensor((np.asarray(atom_coords, dtype=np.float64) - origin) / grid_spacing,
+                                  dtype=torch.float32) for atom_coords, (origin, _) in zip(atom_coords_list, grids)])
+    ijk = ijk.to(device)
+    if weights_list is None:
+        weights_list = [np.full(len(atom_coords), 6.0, dtype=np.float32) for atom_coords in atom_coords_list]
+    weights = torch.cat([torch.as_tensor(np.asarray(weights, dtype=np.float32))
+                         for weights in weights_list]).to(device)
+    mol_starts = torch.tensor(np.repeat(map_starts, [len(atom_coords) for atom_coords in atom_coords_list]),
+                              device=device)
+    # [x, y, z] size of the grid of each atom
+    dims = torch.tensor(np.repeat([shape[::-1] for _, shape in grids],
+                                  [len(atom_coords) for atom_coords in atom_coords_list], axis=0),
+                        device=device).reshape(-1, 3)
+
+    atoms_per_chunk = max(1, chunk_size // num_offsets ** 3)
+    for start in range(0, len(ijk), atoms_per_chunk):
+        chunk = slice(start, start + atoms_per_chunk)
+        chunk_ijk = ijk[chunk]
+        chunk_dims = dims[chunk]
+
+        # per axis Gaussians over the voxels around each atom, zero beyond the cutoff and outside the grid
+        voxel = torch.floor(chunk_ijk).long()[:, :, None] + offsets  # [N_atoms, 3, N_offsets]
+        delta = voxel - chunk_ijk[:, :, None]
+        inside = (delta.abs() <= cutoff_range * sdev) & (voxel >= 0) & (voxel < chunk_dims[:, :, None])
+        gaussian = torch.exp(-0.5 * (delta / sdev) ** 2) * inside
+        voxel = torch.where(inside, voxel, 0)
+
+        values = (weights[chunk, None, None, None] * gaussian[:, 2, :, None, None] * gaussian[:, 1, None, :, None]
+                  * gaussian[:, 0, None, None, :])
+        flat_index = (mol_starts[chunk, None, None, None]
+                      + (voxel[:, 2, :, None, None] * chunk_dims[:, 1, None, None, None]
+                         + voxel[:, 1, None, :, None]) * chunk_dims[:, 0, None, None, None]
+                      + voxel[:, 0, None, None, :])
+        buffer.index_add_(0, flat_index.reshape(-1), values.reshape(-1))
+
+    buffer *= (2 * math.pi) ** -1.5 * (sdev * grid_spacing) ** -3
+
+    buffer = buffer.cpu().numpy()
+    return [(buffer[map_start:map_start + map_size].reshape(shape), [grid_spacing] * 3, origin)
+            for map_start, map_size, (origin, shape) in zip(map_starts, map_sizes, grids)]
+
+
+def molmap_at_points(atom_coords, points, resolution, weights=None, cutoff_range=5.0, sigma_factor=SIGMA_FACTOR,
+                     chunk_size=2 ** 22):
+    """The density that molmap_batch() simulates, evaluated exactly at some points instead of on a grid
+
+    The atoms near each point are found with a spatial hash of cells of the cutoff size,
+    so only the atoms of the 27 cells around a point are summed.
+
+    @param atom_coords: atom coords as [N_atoms, 3] in [x, y, z]
+    @param points: [N_points, 3] in [x, y, z], e.g., the atoms themselves
+    @param weights: weight of each atom, every atom weighs as carbon if None
+    @param chunk_size: maximum number of atom point pairs computed at a time
+    @return: density at each point as [N_points] float32
+    """
+    atom_coords = np.asarray(atom_coords, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    if weights is None:
+        weights = np.full(len(atom_coords), 6.0)
+
+    sdev = molmap_sigma(resolution, sigma_factor)
+    cutoff = cutoff_range * sdev
+
+    # hash the atoms by cell, the cells are padded by one on each side so that every neighbour cell has a key
+    cell_min = np.floor(atom_coords.min(axis=0) / cutoff).astype(np.int64) - 1
+    atom_cells = np.floor(atom_coords / cutoff).astype(np.int64) - cell_min
+    cell_dims = atom_cells.max(axis=0) + 2
+
+    def cell_keys(cells):
+        return (cells[:, 2] * cell_dims[1] + cells[:, 1]) * cell_dims[0] + cells[:, 0]
+
+    order = np.argsort(cell_keys(atom_cells), kind="stable")
+    sorted_keys = cell_keys(atom_cells)[order]
+
+    neighbour_offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij"), axis=-1).reshape(-1, 3)
+
+    density = np.zeros(len(points))
+    point_cells = np.floor(points / cutoff).astype(np.int64) - cell_min
+    # a rough number of pairs per point to size the chunks
+    pairs_per_point = max(1, 27 * len(atom_coords) // max(1, len(np.unique(sorted_keys))))
+    points_per_chunk = max(1, chunk_size // pairs_per_point)
+
+    for chunk_start in range(0, len(points), points_per_chunk):
+        chunk_idx = np.arange(chunk_start, min(chunk_start + points_per_chunk, len(points)))
+        for offset in neighbour_offsets:
+            cells = point_cells[chunk_idx] + offset
+            # points away from the atoms have no neighbour cells
+            valid = np.all((cells >= 0) & (cells < cell_dims), axis=1)
+            keys = cell_keys(cells[valid])
+            starts = np.searchsorted(sorted_keys, keys, side="left")
+            counts = np.searchsorted(sorted_keys, keys, side="right") - starts
+
+            # all pairs of a point and an atom of the cell
+            pair_points = np.repeat(chunk_idx[valid], counts)
+            pair_atoms = order[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+            delta = points[pair_points] - atom_coords[pair_atoms]
+            # the cutoff applies along each axis like in molmap_batch()
+            inside = np.all(np.abs(delta) <= cutoff, axis=1)
+            contributions = weights[pair_atoms] * np.exp(-0.5 * (delta ** 2).sum(axis=1) / sdev ** 2) * inside
+            density += np.bincount(pair_points, weights=contributions, minlength=len(points))
+
+    return (density * (2 * math.pi) ** -1.5 * sdev ** -3).astype(np.float32)
+
+
+def molmap_label(atom_coords, weights, resolution, grid_spacing):
+    """Key of a simulated map: the parameters and a hash of the atoms, fits in an 80 character MRC label"""
+    digest = hashlib.sha1(np.ascontiguousarray(atom_coords, dtype=np.float32).tobytes())
+    if weights is not None:
+        digest.update(np.ascontiguousarray(weights, dtype=np.float32).tobytes())
+    return f"{MOLMAP_LABEL_PREFIX} {resolution:g} {grid_spacing:g} {digest.hexdigest()[:32]}"
+
+
+def read_molmap_label(mrc_filename):
+    """
+    @return: the key the simulated map in the MRC file was saved with, None if it is not one
+    """
+    try:
+        with mrcfile.open(mrc_filename, mode='r', header_only=True, permissive=True) as mrc:
+            if mrc.header is None:
+                return None
+            label = mrc.header.label[1].tobytes().decode("ascii", errors="replace").strip()
+    except (OSError, ValueError):
+        return None
+    return label if label.startswith(MOLMAP_LABEL_PREFIX) else None
+
+
+def save_molmap(mrc_filename, sim_map, label):
+    data, steps, origin = sim_map
+    with mrcfile.new(mrc_filename, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = tuple(steps[::-1])
+        mrc.header.origin = tuple(origin)
+        mrc.header.label[1] = label
+        mrc.header.nlabl = 2
@@ -9,6 +9,23 @@ from sklearn.cluster import Birch
 import math
 import asyncio
 
+from .dataset_bundle import DatasetBundle, is_dataset_bundle
+from .fit_log import logged_rows
+
+
+def molecule_path(mol_folder, mol_idx):
+    """Structure file of the molecule mol_idx of e_sqd_log
+
+    @param mol_folder: the structures folder, whose files pair with e_sqd_log by os.listdir() order,
+                       or the dataset bundle the fit was run on
+    """
+    if is_dataset_bundle(mol_folder):
+        return DatasetBundle(mol_folder).structure_path(mol_idx)
+
+    mol_files = os.listdir(mol_folder)
+    return os.path.join(mol_folder, mol_files[mol_idx])
+
+
 def shift_difference(shift1, shift2):
     """
     Calculate the Euclidean distance between two shifts.
@@ -50,8 +67,7 @@ def animate_MQS(e_sqd_log, mol_folder, MQS, session, clean_scene=True):
         for structure in structures:
             structure.delete()
 
-    mol_files = os.listdir(mol_folder)
-    mol_path = os.path.join(mol_folder, mol_files[MQS[0]])
+    mol_path = molecule_path(mol_folder, MQS[0])
     mol = run(session, f"open {mol_path}")[0]
 
     N_iter = len(e_sqd_log[0, 0, 0])
@@ -70,8 +86,7 @@ def animate_MQS_2(e_sqd_log, mol_folder, MQS, session, clean_scene=True):
         for structure in structures:
             structure.delete()
 
-    mol_files = os.listdir(mol_folder)
-    mol_path = os.path.join(mol_folder, mol_files[MQS[0]])
+    mol_path = molecule_path(mol_folder, MQS[0])
     mol = run(session, f"open {mol_path}")[0]
 
     N_iter = len(e_sqd_log[0, 0, 0])
@@ -111,11 +126,9 @@ def look_at_MQS_idx(e_sqd_log, mol_folder, MQS, session, clean_scene=True):
         for structure in structures:
             structure.delete()
 
-    mol_files = os.listdir(mol_folder)
-
     look_at_mol_idx, transformation = get_transformation_at_MQS(e_sqd_log, MQS)
 
-    mol_path = os.path.join(mol_folder, mol_files[look_at_mol_idx])
+    mol_path = molecule_path(mol_folder, look_at_mol_idx)
     mol = run(session, f"open {mol_path}")[0]
 
     mol.scene_position = transformation
@@ -132,12 +145,9 @@ def look_at_cluster(e_sqd_clusters_ordered, mol_folder, cluster_idx, session, cl
         for structure in structures:
             structure.delete()
 
-    mol_files = os.listdir(mol_folder)
-    # mol_files[idx] pairs with e_sqd_log[idx]
-
     look_at_mol_idx, transformation = get_transformation_at_idx(e_sqd_clusters_ordered, cluster_idx)
 
-    mol_path = os.path.join(mol_folder, mol_files[look_at_mol_idx])
+    mol_path = molecule_path(mol_folder, look_at_mol_idx)
     mol = run(session, f"open {mol_path}")[0]
 
     mol.scene_position = transformation
@@ -155,10 +165,7 @@ def look_at_record(mol_folder, mol_idx, transformation, session, clean_scene=Tru
         for structure in structures:
             structure.delete()
 
-    mol_files = os.listdir(mol_folder)
-    # mol_files[idx] pairs with e_sqd_log[idx]
-
-    mol_path = os.path.join(mol_folder, mol_files[mol_idx])
+    mol_path = molecule_path(mol_folder, mol_idx)
     mol = run(session, f"open {mol_path}")[0]
 
     mol.scene_position = transformation
@@ -168,10 +175,7 @@ def look_at_record(mol_folder, mol_idx, transformation, session, clean_scene=Tru
 
 def simulate_volume(session, vol, mol_folder, mol_idx, transformation, res=4.0):
 
-    mol_files = os.listdir(mol_folder)
-    # mol_files[idx] pairs with e_sqd_log[idx]
-
-    mol_path = os.path.join(mol_folder, mol_files[mol_idx])
+    mol_path = molecule_path(mol_folder, mol_idx)
     mol = run(session, f"open {mol_path}")[0]
 
     mol.atoms.transform(transformation)
@@ -339,7 +343,8 @@ def q2_unit_coord(Q):
     return np.concatenate((rotated_up, rotated_right), axis=-1)
 
 
-def cluster_and_sort_sqd_fast(e_sqd_log, shift_tolerance: float = 3.0, angle_tolerance: float = 6.0, sort_column_idx: int = 9):
+def cluster_and_sort_sqd_fast(e_sqd_log, shift_tolerance: float = 3.0, angle_tolerance: float = 6.0, sort_column_idx: int = 9,
+                              log_epochs=None):
     """
     Cluster the fitting results in sqd table by thresholding on shift and quaternion
     Return the sorted cluster representatives
@@ -359,6 +364,7 @@ def cluster_and_sort_sqd_fast(e_sqd_log, shift_tolerance: float = 3.0, angle_tol
     @param shift_tolerance: shift tolerance in Angstrom
     @param angle_tolerance: angle tolerance in degrees
     @param sort_column_idx: the column to sort, 9-th column is the correlation
+    @param log_epochs: the epoch of each record saved with the log, see fit_log.logged_rows()
     @return: cluster representative table sorted in descending order
     """
 
@@ -370,8 +376,10 @@ def cluster_and_sort_sqd_fast(e_sqd_log, shift_tolerance: float = 3.0, angle_tol
 
     e_sqd_log = e_sqd_log.reshape([N_mol, N_quat * N_shift, N_iter, N_record])
 
-    correlations = e_sqd_log[:, :, 1:22, sort_column_idx]  # remove the 0 iteration, which is before optimization
-    max_correlations_idx = np.argmax(correlations, axis=-1)
+    # the logged epochs, without the 0 iteration, which is before optimization
+    rows = logged_rows(N_iter, log_epochs)
+    correlations = e_sqd_log[:, :, rows, sort_column_idx]
+    max_correlations_idx = rows[np.argmax(correlations, axis=-1)] - 1
 
     # Generate meshgrid for the dimensions you're not indexing through
     dims_0, dims_1 = np.meshgrid(
@@ -4,6 +4,9 @@
 """
 Script for ChimeraX to extract each chain from a structure,
 save them as separate PDB files, and generate MRC files for each chain.
+
+Pass --molmap-backend=chimerax to simulate the maps with the molmap command of ChimeraX instead of
+the batched molmap of the DiffFit bundle, which is the default.
 """
 
 # Import necessary modules
@@ -19,6 +22,21 @@ input_model = sys.argv[1]  # Path to the input structure file
 output_dir = sys.argv[2]  # Directory to save output files
 resolution = float(sys.argv[3])  # Resolution for simulated MRC files
 gridSpacing = float(sys.argv[4])  # gridSpacing for simulated MRC files
+# skip the chains whose npy, cif and MRC files are newer than the input structure
+skip_up_to_date = "--skip-up-to-date" in sys.argv[5:]
+# --molmap-backend=batch simulates the maps of all chains together with the DiffFit bundle,
+# --molmap-backend=chimerax runs the molmap command of ChimeraX one chain at a time
+molmap_backend = next((option.split("=", 1)[1] for option in sys.argv[5:]
+                       if option.startswith("--molmap-backend=")), "batch")
+if molmap_backend == "batch":
+    try:
+        from chimerax.difffit.molmap import molmap_batch, molmap_label, save_molmap
+    except ImportError as e:
+        raise ImportError("The batch molmap backend needs the DiffFit bundle, "
+                          "install it or pass --molmap-backend=chimerax") from e
+elif molmap_backend != "chimerax":
+    raise ValueError(f"Unknown molmap backend: {molmap_backend}, should be 'batch' or 'chimerax'")
+print(f"Simulating the maps with the {molmap_backend} molmap backend")
 
 
 # Open the input structure
@@ -27,11 +45,19 @@ structure = run(session, f'open {input_model}')[0]
 # Get the base name of the input structure for naming output files
 structure_basename = os.path.basename(input_model).split('.')[0]
 
+atoms = structure.atoms
+atom_chain_ids = atoms.residues.chain_ids
+atoms.selected = False
+
+# the maps of all chains are simulated together at the end
+mrc_filepath_list = []
+atoms_coords_list = []
+atoms_weights_list = []
+
 # Iterate over each chain in the structure
 chain_id_name_list = []
 for chain in structure.chains:
     chain_id = chain.chain_id
-    print(f"\n======= Processing {chain_id} =======")
 
     chain_id_name = f"{chain_id}"
 
@@ -40,37 +66,44 @@ for chain in structure.chains:
 
     chain_id_name_list.append(chain_id_name.upper())
 
-    # Save the chain's coordinates as a npy file
-    npy_filename = f"{structure_basename}_chain_{chain_id_name}.npy"
-    npy_filepath = os.path.join(output_dir, npy_filename)
-
-    atom_coordinates = []
-    # Iterate through each residue in the chain to access its atoms
-    for residue in chain.residues:
-        # Check if the residue is not None
-        if residue is not None:
-            for atom in residue.atoms:
-                # Append the atom's coordinates to our list
-                atom_coordinates.append(atom.coord)
-    # Convert the list of coordinates to a NumPy array
-    coordinates_array = np.array(atom_coordinates)
-    np.save(npy_filepath, coordinates_array)
+    npy_filepath = os.path.join(output_dir, f"{structure_basename}_chain_{chain_id_name}.npy")
+    chain_filepath = os.path.join(output_dir, f"{structure_basename}_chain_{chain_id_name}.cif")
+    mrc_filepath = os.path.join(output_dir, f"{structure_basename}_chain_{chain_id_name}.mrc")
 
-    # Save the chain as a cif file
-    chain_filename = f"{structure_basename}_chain_{chain_id_name}.cif"
-    chain_filepath = os.path.join(output_dir, chain_filename)
+    if skip_up_to_date and all(os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(input_model)
+                               for path in (npy_filepath, chain_filepath, mrc_filepath)):
+        print(f"\n======= Skipping {chain_id}, up to date =======")
+        continue
 
-    run(session, f"select #{structure.id[0]}/{chain_id}")
-    run(session, f"save {chain_filepath} selectedOnly true")
-    run(session, "select clear")
+    print(f"\n======= Processing {chain_id} =======")
 
-    # Generate and save the MRC file for the chain
-    mrc_filename = f"{structure_basename}_chain_{chain_id_name}.mrc"
-    mrc_filepath = os.path.join(output_dir, mrc_filename)
+    # Save the coordinates of the chain's residues as a npy file
+    np.save(npy_filepath, chain.existing_residues.atoms.coords)
+
+    # all atoms with the chain ID, like the #model/chain spec
+    chain_atoms = atoms[atom_chain_ids == chain_id]
 
-    vol = run(session, f'molmap #{structure.id[0]}/{chain_id} {resolution} gridSpacing {gridSpacing}')
-    run(session, f"save {mrc_filepath} #{vol.id[0]}")
-    run(session, f"close #{vol.id[0]}")
+    # Save the chain as a cif file
+    chain_atoms.selected = True
+    run(session, f"save {chain_filepath} models #{structure.id[0]} selectedOnly true")
+    chain_atoms.selected = False
+
+    # Generate and save the MRC file for the chain
+    if molmap_backend == "batch":
+        mrc_filepath_list.append(mrc_filepath)
+        atoms_coords_list.append(chain_atoms.coords)
+        atoms_weights_list.append(chain_atoms.element_numbers.astype(np.float32))
+    else:
+        vol = run(session, f'molmap #{structure.id[0]}/{chain_id} {resolution} gridSpacing {gridSpacing}')
+        run(session, f"save {mrc_filepath} #{vol.id[0]}")
+        run(session, f"close #{vol.id[0]}")
+
+if mrc_filepath_list:
+    print(f"\n======= Simulating {len(mrc_filepath_list)} maps with the batch molmap backend =======")
+    sim_map_list = molmap_batch(atoms_coords_list, resolution, gridSpacing, atoms_weights_list)
+    for mrc_filepath, sim_map, atom_coords, weights in zip(mrc_filepath_list, sim_map_list, atoms_coords_list,
+                                                          atoms_weights_list):
+        save_molmap(mrc_filepath, sim_map, molmap_label(atom_coords, weights, resolution, gridSpacing))
 
 print("Process completed.")
 
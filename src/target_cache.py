@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+
+# bump when the layout or the preprocessing changes, old entries are then never hit
+CACHE_VERSION = 1
+
+
+def file_sha1(file_path, chunk_size=1 << 22):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def map_identity(file_path, strict=False):
+    # the map as its path, size and modification time, or as the hash of its content if strict
+    if strict:
+        return dict(sha1=file_sha1(file_path))
+
+    stat = os.stat(file_path)
+    return dict(path=os.path.abspath(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def target_cache_key(target_vol_path, target_surface_threshold, min_cluster_size, conv_loops, conv_kernel_sizes,
+                     negative_space_value, conv_pyramid="chained", target_resolution=None, crop=False, strict=False):
+    """
+    @param strict: key the map by the hash of its content instead of its path, size and modification time,
+                   which reads the whole map on every lookup, but also hits for a copy of the map
+                   and misses for an edit that keeps the size and the time
+    """
+    params = dict(version=CACHE_VERSION,
+                  map=map_identity(target_vol_path, strict),
+                  target_surface_threshold=float(target_surface_threshold),
+                  min_cluster_size=float(min_cluster_size),
+                  conv_kernel_sizes=[int(k) for k in conv_kernel_sizes[:conv_loops]],
+                  negative_space_value=float(negative_space_value),
+                  conv_pyramid=conv_pyramid,
+                  target_resolution=float(target_resolution or 0),
+                  crop=bool(crop))
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "DiffFit", "targets")
+
+
+def map_cache_dir(target_vol_path):
+    # a cache folder next to the map
+    return os.path.join(os.path.dirname(os.path.abspath(target_vol_path)), ".DiffFit_cache")
+
+
+class TargetCache:
+    """On-disk cache of preprocessed targets, i.e., the filtered and normalized target with its smoothed copies
+
+    Each entry is a folder with one .npy file per array, which are loaded with memory mapping.
+    The least recently used entries are removed when the cache grows over max_size_mb.
+    The maps are keyed by their path, size and modification time, or by their content if strict,
+    see target_cache_key().
+    """
+
+    def __init__(self, cache_dir=None, max_size_mb=4096, strict=False):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.max_size_mb = max_size_mb
+        self.strict = strict
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        @param key: from target_cache_key()
+        @return: dict of steps, origin, eligible_volume, cluster_center_indices, conv_list, crop_start and full_dim,
+                 or None on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+            entry = dict(steps=meta["steps"],
+                         origin=meta["origin"],
+                         eligible_volume=np.load(os.path.join(entry_dir, "eligible_volume.npy"), mmap_mode="r"),
+                         cluster_center_indices=[tuple(center) for center in
+                                                 np.load(os.path.join(entry_dir, "cluster_center_indices.npy"))],
+                         conv_list=[np.load(os.path.join(entry_dir, f"level_{level}.npy"), mmap_mode="r")
+                                    for level in range(meta["num_levels"])],
+                         crop_start=meta["crop_start"],
+                         full_dim=meta["full_dim"])
+        except (OSError, ValueError, KeyError):
+            # a broken entry is dropped and recomputed
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        # the modification time of meta.json records the last use
+        os.utime(meta_path)
+
+        return entry
+
+    def save(self, key, steps, origin, eligible_volume, cluster_center_indices, conv_list, crop_start=None,
+             full_dim=None):
+        """
+        @param conv_list: the filtered and normalized target followed by its smoothed copies as [z, y, x] arrays
+        @param crop_start, full_dim: see FitEngine, if the volumes are cropped from the full map
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write into a temporary folder first, so other sessions never see a half written entry
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        np.save(os.path.join(tmp_dir, "eligible_volume.npy"), np.asarray(eligible_volume, dtype=bool))
+        np.save(os.path.join(tmp_dir, "cluster_center_indices.npy"),
+                np.asarray(cluster_center_indices, dtype=np.float64).reshape(-1, 3))
+        for level, volume in enumerate(conv_list):
+            np.save(os.path.join(tmp_dir, f"level_{level}.npy"), np.asarray(volume, dtype=np.float32))
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(dict(steps=[float(s) for s in steps], origin=[float(o) for o in origin],
+                           num_levels=len(conv_list),
+                           crop_start=None if crop_start is None else [int(s) for s in crop_start],
+                           full_dim=None if full_dim is None else [int(d) for d in full_dim]), f)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # another session saved the same entry meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self._entry_dir(key), "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            entry_dir = self._entry_dir(key)
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_path), key, size))
+            total_size += size
+
+        # remove the least recently used entries first
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size_mb * 1024 * 1024:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
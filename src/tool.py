@@ -35,7 +35,9 @@ from .parse_log import look_at_record, look_at_cluster, look_at_MQS_idx, animate
 from .parse_log import simulate_volume, get_transformation_at_record, zero_cluster_density
 from .tablemodel import TableModel
 from .DiffAtomComp import diff_atom_comp, cluster_and_sort_sqd_fast, diff_fit, conv_volume, numpy2tensor, \
-    linear_norm_tensor
+    linear_norm_tensor, AtomCoordsCache, FitEngine
+from .target_cache import TargetCache
+from .dataset_bundle import DATASET_BUNDLE_EXTENSION
 
 import sys
 import numpy as np        
@@ -66,11 +68,18 @@ class DiffFitSettings:
         self.target_vol_path: str = "D:\\GIT\\DiffFit\\dev_data\\input\\domain_fit_demo_3domains\\density2.mrc"
         self.structures_directory: str = "D:\\GIT\\DiffFit\dev_data\input\domain_fit_demo_3domains\subunits_cif"
         self.structures_sim_map_dir: str = "D:\\GIT\\DiffFit\dev_data\input\domain_fit_demo_3domains\subunits_mrc"
+        # a folder to cache the parsed atom coords of the structures in, none if empty
+        self.structures_npy_dir: str = ""
+        # a packed dataset bundle used instead of the two folders above, if set
+        self.dataset_bundle: str = ""
         
         self.output_directory: str = "D:\\GIT\\DiffFit\\dev_data\\output"
 
         self.target_surface_threshold: float = 0.7
         self.min_cluster_size: float = 100
+        self.target_resolution: float = 0.0
+        self.sim_map_resolution: float = 0.0
+        self.reference_resolution: float = 0.0
         self.N_shifts: int = 10
         self.N_quaternions: int = 100
         self.negative_space_value: float = -0.5
@@ -135,8 +144,17 @@ class DiffFitTool(ToolInstance):
 
         self.fit_result_ready = False
         self.fit_result = None
+        self.fit_log_epochs = None
         self.mol_centers = None
 
+        # atom coords kept on the device across fits
+        self._coords_cache = AtomCoordsCache()
+        # preprocessed targets, one per fit map, and the one of the Compute tab
+        self._fit_engines = {}
+        self._compute_fit_engine = (None, None)
+        # preprocessed targets of the Compute tab kept on disk across sessions
+        self._target_cache = TargetCache()
+
         # Register the selection change callback
         self.session.triggers.add_handler(SELECTION_CHANGED, self.selection_callback)
         self.session.triggers.add_handler('graphics update', self.graphics_update_callback)
@@ -204,9 +222,14 @@ class DiffFitTool(ToolInstance):
         self.target_vol_path.setText(self.settings.target_vol_path)
         self.structures_dir.setText(self.settings.structures_directory)
         self.structures_sim_map_dir.setText(self.settings.structures_sim_map_dir)
+        self.structures_npy_dir.setText(self.settings.structures_npy_dir)
+        self.dataset_bundle.setText(self.settings.dataset_bundle)
         self.out_dir.setText(self.settings.output_directory)
         self.target_surface_threshold.setValue(self.settings.target_surface_threshold)
         self.min_cluster_size.setValue(self.settings.min_cluster_size)
+        self.target_resolution.setValue(self.settings.target_resolution)
+        self.sim_map_resolution.setValue(self.settings.sim_map_resolution)
+        self.reference_resolution.setValue(self.settings.reference_resolution)
         self.n_iters.setValue(self.settings.N_iters)
         self.n_shifts.setValue(self.settings.N_shifts)
         self.n_quaternions.setValue(self.settings.N_quaternions)        
@@ -237,9 +260,14 @@ class DiffFitTool(ToolInstance):
         self.settings.target_vol_path = self.target_vol_path.text()
         self.settings.structures_directory = self.structures_dir.text()
         self.settings.structures_sim_map_dir = self.structures_sim_map_dir.text()
+        self.settings.structures_npy_dir = self.structures_npy_dir.text()
+        self.settings.dataset_bundle = self.dataset_bundle.text()
         self.settings.output_directory = self.out_dir.text()        
         self.settings.target_surface_threshold = self.target_surface_threshold.value()
         self.settings.min_cluster_size = self.min_cluster_size.value()
+        self.settings.target_resolution = self.target_resolution.value()
+        self.settings.sim_map_resolution = self.sim_map_resolution.value()
+        self.settings.reference_resolution = self.reference_resolution.value()
         self.settings.N_iters = self.n_iters.value()
         self.settings.N_shifts = self.n_shifts.value()
         self.settings.N_quaternions = self.n_quaternions.value()        
@@ -343,6 +371,17 @@ class DiffFitTool(ToolInstance):
         row.addWidget(single_fit_res_label)
         row.addWidget(self._single_fit_res)
 
+        # target resampling row
+        row = create_row(f.layout())
+        single_fit_target_res_label = QLabel("Resample the map to resolution (0 = off)")
+        self._single_fit_target_res = QDoubleSpinBox()
+        self._single_fit_target_res.setValue(0.0)
+        self._single_fit_target_res.setMinimum(0.0)
+        self._single_fit_target_res.setMaximum(100.0)
+        self._single_fit_target_res.setSingleStep(0.1)
+        row.addWidget(single_fit_target_res_label)
+        row.addWidget(self._single_fit_target_res)
+
 
         # Preset row
         row = create_row(f.layout(), top=20)
@@ -480,6 +519,28 @@ class DiffFitTool(ToolInstance):
         layout.addWidget(self.structures_sim_map_dir, row, 1)
         layout.addWidget(structures_sim_map_dir_select, row, 2)
         row = row + 1
+
+        structures_npy_dir_label = QLabel()
+        structures_npy_dir_label.setText("Structures coords cache Folder (optional):")
+        self.structures_npy_dir = QLineEdit()
+        self.structures_npy_dir.textChanged.connect(lambda: self.store_settings())
+        structures_npy_dir_select = QPushButton("Select")
+        structures_npy_dir_select.clicked.connect(lambda: self.select_clicked("Structures coords cache Folder", self.structures_npy_dir))
+        layout.addWidget(structures_npy_dir_label, row, 0)
+        layout.addWidget(self.structures_npy_dir, row, 1)
+        layout.addWidget(structures_npy_dir_select, row, 2)
+        row = row + 1
+
+        dataset_bundle_label = QLabel()
+        dataset_bundle_label.setText("Dataset bundle (instead of the folders):")
+        self.dataset_bundle = QLineEdit()
+        self.dataset_bundle.textChanged.connect(lambda: self.store_settings())
+        dataset_bundle_select = QPushButton("Select")
+        dataset_bundle_select.clicked.connect(lambda: self.select_clicked("Dataset bundle", self.dataset_bundle, False, f"Dataset bundles(*{DATASET_BUNDLE_EXTENSION})"))
+        layout.addWidget(dataset_bundle_label, row, 0)
+        layout.addWidget(self.dataset_bundle, row, 1)
+        layout.addWidget(dataset_bundle_select, row, 2)
+        row = row + 1
         
         out_dir_label = QLabel()
         out_dir_label.setText("Output Folder:")
@@ -522,6 +583,39 @@ class DiffFitTool(ToolInstance):
         layout.addWidget(min_cluster_size_label, row, 0)
         layout.addWidget(self.min_cluster_size, row, 1, 1, 2)
         row = row + 1
+
+        target_resolution_label = QLabel()
+        target_resolution_label.setText("Target resolution (0 = no resampling):")
+        self.target_resolution = QDoubleSpinBox()
+        self.target_resolution.setMinimum(0.0)
+        self.target_resolution.setMaximum(100.0)
+        self.target_resolution.setSingleStep(0.1)
+        self.target_resolution.valueChanged.connect(lambda: self.store_settings())
+        layout.addWidget(target_resolution_label, row, 0)
+        layout.addWidget(self.target_resolution, row, 1, 1, 2)
+        row = row + 1
+
+        sim_map_resolution_label = QLabel()
+        sim_map_resolution_label.setText("Simulate maps at resolution (0 = use the sim-map folder):")
+        self.sim_map_resolution = QDoubleSpinBox()
+        self.sim_map_resolution.setMinimum(0.0)
+        self.sim_map_resolution.setMaximum(100.0)
+        self.sim_map_resolution.setSingleStep(0.1)
+        self.sim_map_resolution.valueChanged.connect(lambda: self.store_settings())
+        layout.addWidget(sim_map_resolution_label, row, 0)
+        layout.addWidget(self.sim_map_resolution, row, 1, 1, 2)
+        row = row + 1
+
+        reference_resolution_label = QLabel()
+        reference_resolution_label.setText("Reference density from the atoms at resolution (0 = from the maps):")
+        self.reference_resolution = QDoubleSpinBox()
+        self.reference_resolution.setMinimum(0.0)
+        self.reference_resolution.setMaximum(100.0)
+        self.reference_resolution.setSingleStep(0.1)
+        self.reference_resolution.valueChanged.connect(lambda: self.store_settings())
+        layout.addWidget(reference_resolution_label, row, 0)
+        layout.addWidget(self.reference_resolution, row, 1, 1, 2)
+        row = row + 1
         
 
         n_iters_label = QLabel()
@@ -654,7 +748,7 @@ class DiffFitTool(ToolInstance):
         layout.addWidget(self.target_vol_select, row, 2)
         row = row + 1
         
-        structures_folder_label = QLabel("Structures Folder:")
+        structures_folder_label = QLabel("Structures Folder or Bundle:")
         self.structures_folder = QLineEdit()
         self.structures_folder.textChanged.connect(lambda: self.store_settings()) 
         self.structures_folder_select = QPushButton("Select")
@@ -983,7 +1077,7 @@ class DiffFitTool(ToolInstance):
             
         return fileName, ext
     
-    def show_results(self, e_sqd_log, mol_centers):
+    def show_results(self, e_sqd_log, mol_centers, log_epochs=None):
         if e_sqd_log is None:
             return
 
@@ -1009,7 +1103,8 @@ class DiffFitTool(ToolInstance):
         self.e_sqd_log = e_sqd_log.reshape([N_mol, N_quat * N_shift, N_iter, N_metric])
         self.e_sqd_clusters_ordered = cluster_and_sort_sqd_fast(self.e_sqd_log, mol_centers,
                                                                 self.settings.clustering_shift_tolerance,
-                                                                self.settings.clustering_angle_tolerance)
+                                                                self.settings.clustering_angle_tolerance,
+                                                                log_epochs=log_epochs)
         
         self.model = TableModel(self.e_sqd_clusters_ordered, self.e_sqd_log)
         self.proxyModel = QSortFilterProxyModel()
@@ -1086,6 +1181,57 @@ class DiffFitTool(ToolInstance):
         return volume_conv_list
 
 
+    def _get_single_fit_engine(self, vol, smooth_by, smooth_loops):
+        # the preprocessed target is kept per map and only rebuilt when the map or the smooth options change
+        engine_key = (vol.maximum_surface_level, smooth_by, smooth_loops, self.smooth_kernel_sizes.text(),
+                      self._single_fit_target_res.value(), self._device.currentText())
+
+        # drop the engines of closed maps
+        self._fit_engines = {v: entry for v, entry in self._fit_engines.items() if not v.deleted}
+
+        if vol in self._fit_engines and self._fit_engines[vol][0] == engine_key:
+            return self._fit_engines[vol][1]
+
+        # Copy vol and make it clean after thresholding
+        vol_copy = vol.writable_copy()
+        vol_copy_matrix = vol_copy.data.matrix()
+        vol_copy_matrix[vol_copy_matrix < vol.maximum_surface_level] = 0
+        vol_copy.data.values_changed()
+
+        volume_conv_list = self._create_volume_conv_list(vol_copy, smooth_by, smooth_loops, self.session)
+        vol_copy.delete()
+
+        fit_engine = FitEngine.from_volume_list(volume_conv_list, vol.data.step, vol.data.origin, 10,
+                                                target_resolution=self._single_fit_target_res.value(),
+                                                device=self._device.currentText())
+        self._fit_engines[vol] = (engine_key, fit_engine)
+
+        return fit_engine
+
+    def _get_compute_fit_engine(self):
+        # the Compute tab reuses the preprocessed target as long as the map file and its options are unchanged
+        target_vol_path = self.settings.target_vol_path
+        engine_key = (target_vol_path, os.path.getmtime(target_vol_path),
+                      self.settings.target_surface_threshold, self.settings.min_cluster_size,
+                      self.settings.negative_space_value, self.settings.conv_loops,
+                      tuple(self.settings.conv_kernel_sizes), tuple(self.settings.conv_weights),
+                      self.settings.target_resolution, self._device.currentText())
+
+        if self._compute_fit_engine[0] != engine_key:
+            fit_engine = FitEngine.from_file(target_vol_path,
+                                             self.settings.target_surface_threshold,
+                                             self.settings.min_cluster_size,
+                                             negative_space_value=self.settings.negative_space_value,
+                                             conv_loops=self.settings.conv_loops,
+                                             conv_kernel_sizes=self.settings.conv_kernel_sizes,
+                                             conv_weights=self.settings.conv_weights,
+                                             target_cache=self._target_cache,
+                                             target_resolution=self.settings.target_resolution,
+                                             device=self._device.currentText())
+            self._compute_fit_engine = (engine_key, fit_engine)
+
+        return self._compute_fit_engine[1]
+
     def single_fit_button_clicked(self):
         self.disable_spheres_clicked()
 
@@ -1096,27 +1242,20 @@ class DiffFitTool(ToolInstance):
         self.fit_mol_list = [mol]
 
         self.fit_vol = self._map_menu.value
-        vol_matrix = self.fit_vol.full_matrix()
-
-        # Copy vol and make it clean after thresholding
-        vol_copy = self.fit_vol.writable_copy()
-        vol_copy_matrix = vol_copy.data.matrix()
-        vol_copy_matrix[vol_copy_matrix < self.fit_vol.maximum_surface_level] = 0
-        vol_copy.data.values_changed()
 
         # Smooth the volume
         smooth_loops = self._single_fit_gaussian_loops.value()
         smooth_by = self._smooth_by.currentText()
-        volume_conv_list = self._create_volume_conv_list(vol_copy, smooth_by, smooth_loops, self.session)
-        vol_copy.delete()
+        fit_engine = self._get_single_fit_engine(self.fit_vol, smooth_by, smooth_loops)
 
         # Simulate a map for the mol
         from chimerax.map.molmap import molecule_map
-        mol_vol = molecule_map(self.session, mol.atoms, self._single_fit_res.value(), grid_spacing=self.fit_vol.data.step[0])
+        # on the grid of the fit engine, which is coarser than the map if it was resampled
+        mol_vol = molecule_map(self.session, mol.atoms, self._single_fit_res.value(), grid_spacing=fit_engine.target_steps[0])
 
         # Fit
         timer_start = datetime.now()
-        self.mol_centers, self.fit_result = diff_fit(volume_conv_list,
+        self.mol_centers, self.fit_result = diff_fit(None,
                                    self.fit_vol.data.step,
                                    self.fit_vol.data.origin,
                                    10,
@@ -1127,6 +1266,8 @@ class DiffFitTool(ToolInstance):
                                    save_results=self._single_fit_result_save_checkbox.isChecked(),
                                    out_dir=self._single_fit_out_dir.text(),
                                    out_dir_exist_ok=True,
+                                   coords_cache=self._coords_cache,
+                                   fit_engine=fit_engine,
                                    device=self._device.currentText()
                                    )
         timer_stop = datetime.now()
@@ -1137,7 +1278,8 @@ class DiffFitTool(ToolInstance):
         self._view_input_mode.setCurrentText("interactive")
         self._view_input_mode_changed()
         self.fit_result_ready = True
-        self.show_results(self.fit_result, self.mol_centers)
+        self.fit_log_epochs = fit_engine.log_epochs
+        self.show_results(self.fit_result, self.mol_centers, self.fit_log_epochs)
 
         self.tab_widget.setCurrentWidget(self.tab_view_group)
 
@@ -1155,6 +1297,7 @@ class DiffFitTool(ToolInstance):
         #target_vol_path = "D:\\GIT\\DiffFit\dev_data\input\domain_fit_demo_3domains\density2.mrc"
         #output_folder = "D:\\GIT\\DiffFit\dev_data\output"
         
+        fit_engine = self._get_compute_fit_engine()
         mol_centers, e_sqd_log = diff_atom_comp(
             target_vol_path=self.settings.target_vol_path,
             target_surface_threshold=self.settings.target_surface_threshold,
@@ -1171,24 +1314,32 @@ class DiffFitTool(ToolInstance):
             conv_loops=self.settings.conv_loops,
             conv_kernel_sizes=self.settings.conv_kernel_sizes,
             conv_weights=self.settings.conv_weights,
+            coords_cache=self._coords_cache,
+            target_resolution=self.settings.target_resolution,
+            structures_npy_dir=self.settings.structures_npy_dir or None,
+            dataset_bundle=self.settings.dataset_bundle or None,
+            sim_map_resolution=self.settings.sim_map_resolution,
+            reference_resolution=self.settings.reference_resolution,
+            fit_engine=fit_engine,
             device=self._device.currentText()
         )
 
         # copy the directories
         self.target_vol.setText(self.settings.target_vol_path)     
-        self.structures_folder.setText(self.settings.structures_directory)
+        # the log pairs with the molecules of the bundle if one was used
+        self.structures_folder.setText(self.settings.dataset_bundle or self.settings.structures_directory)
         self.dataset_folder.setText("{0}".format(self.settings.output_directory))
         #print(self.settings)
         
         # output is tensor
-        self.show_results(e_sqd_log.detach().cpu().numpy(), mol_centers)
+        self.show_results(e_sqd_log.detach().cpu().numpy(), mol_centers, fit_engine.log_epochs)
         self.tab_widget.setCurrentWidget(self.tab_view_group)
         self.select_table_item(0)
 
     def load_button_clicked(self):
         if self.fit_input_mode == "interactive":
             if self.fit_result_ready:
-                self.show_results(self.fit_result, self.mol_centers)
+                self.show_results(self.fit_result, self.mol_centers, self.fit_log_epochs)
                 return
             else:
                 from chimerax.log.cmd import log
@@ -1208,8 +1359,10 @@ class DiffFitTool(ToolInstance):
         fit_res = np.load("{0}\\fit_res.npz".format(datasetoutput))
         mol_centers = fit_res['mol_centers']
         opt_res = fit_res['opt_res']
+        # the logs saved before the epochs of the records were saved with them have none
+        log_epochs = fit_res['log_epochs'] if 'log_epochs' in fit_res.files else None
 
-        self.show_results(opt_res, mol_centers)
+        self.show_results(opt_res, mol_centers, log_epochs)
         self.select_table_item(0)
 
     def save_working_vol_button_clicked(self):
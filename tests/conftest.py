@@ -0,0 +1,77 @@
+import importlib.util
+import os
+import sys
+import types
+from unittest import mock
+
+import mrcfile
+import numpy as np
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+DEMO_DIR = os.path.join(REPO_DIR, "dev_data", "input", "domain_fit_demo_3domains")
+
+# the standalone modules do not need ChimeraX, they are imported from src directly
+sys.path.insert(0, SRC_DIR)
+
+
+def _mock_chimerax():
+    """Stand-ins for the ChimeraX modules that the engine and parse_log import, so that their tests run without
+    ChimeraX, and src as the chimerax.difffit package if the bundle is not installed
+    """
+    if importlib.util.find_spec("chimerax") is None:
+        chimerax = types.ModuleType("chimerax")
+        chimerax.__path__ = []
+        sys.modules["chimerax"] = chimerax
+        for name in ("chimerax.geometry", "chimerax.core", "chimerax.core.commands", "chimerax.core.toolshed",
+                     "chimerax.atomic"):
+            sys.modules[name] = mock.MagicMock(name=name)
+
+    if importlib.util.find_spec("chimerax.difffit") is None:
+        # without running its __init__, which registers the bundle with ChimeraX
+        difffit = types.ModuleType("chimerax.difffit")
+        difffit.__path__ = [SRC_DIR]
+        sys.modules["chimerax.difffit"] = difffit
+
+
+_mock_chimerax()
+
+
+@pytest.fixture
+def demo_dir():
+    return DEMO_DIR
+
+
+@pytest.fixture
+def write_mrc(tmp_path):
+    """Write a [z, y, x] array as an MRC file with voxel size [x, y, z] and origin [x, y, z]"""
+    def write(name, data, voxel_size=(1.0, 2.0, 3.0), origin=(4.0, 5.0, 6.0)):
+        path = str(tmp_path / name)
+        with mrcfile.new(path, overwrite=True) as mrc:
+            mrc.set_data(np.asarray(data, dtype=np.float32))
+            mrc.voxel_size = voxel_size
+            mrc.header.origin = origin
+        return path
+
+    return write
+
+
+@pytest.fixture(scope="session")
+def demo_engine():
+    """A FitEngine of the demo target with two smoothed levels"""
+    from chimerax.difffit.DiffAtomComp import FitEngine
+    return FitEngine.from_file(os.path.join(DEMO_DIR, "density2.mrc"), 0.7, 100, conv_loops=2,
+                               conv_kernel_sizes=[5, 5], conv_weights=[1.0, 1.0])
+
+
+@pytest.fixture(scope="session")
+def demo_molecules():
+    """Atom coords and simulated maps of the demo structures that have one"""
+    from chimerax.difffit.DiffAtomComp import mrc_to_npy, read_file_and_get_coordinates
+    names = ["I7M317_D1", "I7MLV6_D3"]
+    mol_coords = [read_file_and_get_coordinates(os.path.join(DEMO_DIR, "subunits_cif", f"{name}.pdb"))
+                  for name in names]
+    mol_sim_maps = [mrc_to_npy(os.path.join(DEMO_DIR, "subunits_mrc", f"{name}.mrc")) for name in names]
+    return mol_coords, mol_sim_maps
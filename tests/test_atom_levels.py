@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+from chimerax.difffit.DiffAtomComp import atoms_to_beads, decimate_atoms, load_or_compute_beads
+
+
+def run_fit(engine, mol_coords, mol_sim_maps, **kwargs):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    kwargs = dict(dict(N_shifts=3, N_quaternions=4, n_iters=11, log_every=5), **kwargs)
+    _, e_sqd_log = engine.fit(mol_coords, mol_sim_maps, **kwargs)
+    return e_sqd_log.detach().cpu().numpy()
+
+
+def occupied_cells(atom_coords, cell_size):
+    return len(np.unique(np.floor(np.asarray(atom_coords, dtype=np.float64) / cell_size).astype(np.int64), axis=0))
+
+
+def test_decimate_keeps_one_atom_per_cell(demo_molecules):
+    atom_coords = np.asarray(demo_molecules[0][0])
+    keep = decimate_atoms(atom_coords, 4.0)
+
+    assert np.all(np.diff(keep) > 0)
+    assert len(keep) == occupied_cells(atom_coords, 4.0) < len(atom_coords)
+    assert occupied_cells(atom_coords[keep], 4.0) == len(keep)
+
+
+def test_schedule_of_all_atoms_matches_no_schedule(demo_engine, demo_molecules):
+    np.testing.assert_allclose(run_fit(demo_engine, *demo_molecules, atom_schedule=((0, 0),)),
+                               run_fit(demo_engine, *demo_molecules), rtol=1e-6, atol=1e-6)
+
+
+def test_metric_epochs_use_all_atoms(demo_engine, demo_molecules):
+    all_atoms = run_fit(demo_engine, *demo_molecules)
+    scheduled = run_fit(demo_engine, *demo_molecules, atom_schedule=((0, 8.0),))
+
+    # epoch 0 computes the metrics, so it takes the same step on all atoms, the decimated epochs then differ
+    np.testing.assert_allclose(scheduled[:, :, :, :2], all_atoms[:, :, :, :2], rtol=1e-5, atol=1e-5)
+    assert not np.allclose(scheduled[:, :, :, 2, :7], all_atoms[:, :, :, 2, :7])
+
+
+def test_beads_keep_the_atom_mean(demo_molecules):
+    atom_coords = np.asarray(demo_molecules[0][0])
+    bead_coords, bead_weights = atoms_to_beads(atom_coords, 4.0)
+
+    assert len(bead_coords) == occupied_cells(atom_coords, 4.0)
+    assert bead_weights.sum() == len(atom_coords)
+    np.testing.assert_allclose(np.average(bead_coords, axis=0, weights=bead_weights), atom_coords.mean(axis=0),
+                               atol=1e-3)
+
+
+def test_bead_cache_follows_the_atoms(demo_molecules, tmp_path):
+    atom_coords = np.asarray(demo_molecules[0][0])
+    cache_path = str(tmp_path / "beads.npz")
+    bead_coords, _ = load_or_compute_beads(atom_coords, 4.0, cache_path)
+
+    np.testing.assert_array_equal(load_or_compute_beads(atom_coords, 4.0, cache_path)[0], bead_coords)
+    moved_coords, _ = load_or_compute_beads(atom_coords + 10.0, 4.0, cache_path)
+    np.testing.assert_allclose(moved_coords, atoms_to_beads(atom_coords + 10.0, 4.0)[0])
+
+
+def test_beads_batched_match_per_molecule(demo_engine, demo_molecules):
+    # the bead weights ride in the padding mask of the batch and scale the density in the per-molecule loop
+    np.testing.assert_allclose(run_fit(demo_engine, *demo_molecules, bead_size=4.0, batch_molecules=True),
+                               run_fit(demo_engine, *demo_molecules, bead_size=4.0, batch_molecules=False),
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_bead_metric_epochs_use_all_atoms(demo_engine, demo_molecules):
+    all_atoms = run_fit(demo_engine, *demo_molecules)
+    beads = run_fit(demo_engine, *demo_molecules, bead_size=4.0)
+
+    np.testing.assert_allclose(beads[:, :, :, :2], all_atoms[:, :, :, :2], rtol=1e-5, atol=1e-5)
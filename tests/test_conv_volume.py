@@ -0,0 +1,32 @@
+import os
+
+import mrcfile
+import numpy as np
+import pytest
+
+from chimerax.difffit.DiffAtomComp import conv_volume, linear_norm_tensor, numpy2tensor
+from conftest import DEMO_DIR
+
+
+@pytest.fixture(scope="module")
+def target():
+    # the demo target with the voxels under the surface threshold set to 0, like the filtered target of FitEngine
+    data = mrcfile.read(os.path.join(DEMO_DIR, "density2.mrc")).copy()
+    data[data < 0.7] = 0.0
+    return linear_norm_tensor(numpy2tensor(data, "cpu")[0])
+
+
+@pytest.mark.parametrize("kernel_sizes", [[5, 5, 5], [31]])
+@pytest.mark.parametrize("backend", ["separable", "fft"])
+def test_backends_match_dense(target, kernel_sizes, backend):
+    dense = conv_volume(target, "cpu", len(kernel_sizes), kernel_sizes, -0.5, backend="dense")
+    other = conv_volume(target, "cpu", len(kernel_sizes), kernel_sizes, -0.5, backend=backend)
+
+    for dense_level, other_level in zip(dense[1:], other[1:]):
+        dense_level, other_level = dense_level.numpy(), other_level.numpy()
+        # the round-off where the exact convolution is 0 is not clamped differently, only voxels that are right at
+        # the clamp tolerance may go either way
+        flipped = (dense_level > -0.5) != (other_level > -0.5)
+        assert flipped.sum() <= 1e-4 * flipped.size
+        assert np.all(np.maximum(dense_level, other_level)[flipped] < 1e-5)
+        np.testing.assert_allclose(other_level[~flipped], dense_level[~flipped], atol=1e-5)
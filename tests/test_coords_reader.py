@@ -0,0 +1,109 @@
+import json
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from coords_reader import atomic_numbers, read_atoms, read_coordinates
+
+PDB = pytest.importorskip("Bio.PDB")
+from Bio.PDB.PDBExceptions import PDBConstructionWarning
+
+
+def biopython_atoms(structure):
+    # the iteration of DiffAtomComp.read_file_and_get_coordinates_biopython()
+    atoms = [atom for model in structure for chain in model for residue in chain for atom in residue]
+    return np.array([atom.get_coord() for atom in atoms]), [atom.element for atom in atoms]
+
+
+def parse(parser, file_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", PDBConstructionWarning)
+        return parser.get_structure(os.path.basename(file_path).split('.')[0], file_path)
+
+
+def demo_structures(demo_dir):
+    structures_dir = os.path.join(demo_dir, "subunits_cif")
+    return [os.path.join(structures_dir, file_name) for file_name in sorted(os.listdir(structures_dir))]
+
+
+def test_pdb_matches_biopython(demo_dir):
+    for file_path in demo_structures(demo_dir):
+        expected_coords, expected_elements = biopython_atoms(parse(PDB.PDBParser(), file_path))
+        coords, elements = read_atoms(file_path)
+
+        assert coords.dtype == np.float32
+        np.testing.assert_allclose(coords, expected_coords, atol=1e-3)
+        assert elements == expected_elements
+
+
+def test_mmcif_matches_biopython(demo_dir, tmp_path):
+    file_path = demo_structures(demo_dir)[0]
+    cif_path = str(tmp_path / "structure.cif")
+    io = PDB.MMCIFIO()
+    io.set_structure(parse(PDB.PDBParser(), file_path))
+    io.save(cif_path)
+
+    expected_coords, expected_elements = biopython_atoms(parse(PDB.MMCIFParser(), cif_path))
+    coords, elements = read_atoms(cif_path)
+
+    np.testing.assert_allclose(coords, expected_coords, atol=1e-3)
+    assert elements == expected_elements
+    np.testing.assert_array_equal(read_coordinates(cif_path), coords)
+
+
+def test_pdb_altloc_keeps_highest_occupancy(tmp_path):
+    pdb_path = tmp_path / "altloc.pdb"
+    pdb_path.write_text(
+        "ATOM      1  N   ALA A   1       1.000   1.000   1.000  1.00  0.00           N\n"
+        "ATOM      2  CA AALA A   1       2.000   2.000   2.000  0.40  0.00           C\n"
+        "ATOM      3  CA BALA A   1       3.000   3.000   3.000  0.60  0.00           C\n"
+        "ATOM      4  C   ALA A   1       4.000   4.000   4.000  1.00  0.00           C\n"
+        "END\n")
+
+    expected_coords, _ = biopython_atoms(parse(PDB.PDBParser(), str(pdb_path)))
+    coords = read_coordinates(str(pdb_path))
+
+    np.testing.assert_allclose(coords, expected_coords)
+    np.testing.assert_allclose(coords[1], [3.0, 3.0, 3.0])
+
+
+def test_unsupported_format(tmp_path):
+    with pytest.raises(ValueError):
+        read_atoms(str(tmp_path / "structure.xyz"))
+
+
+def test_atomic_numbers():
+    np.testing.assert_array_equal(atomic_numbers(["C", "n", "O", "S", "Fe", "X"]), [6, 7, 8, 16, 26, 6])
+
+
+def test_sidecar_follows_the_source_and_the_selection(demo_dir, tmp_path):
+    from chimerax.difffit.DiffAtomComp import read_file_and_get_coordinates, structure_npy_meta_path
+
+    pdb_path = tmp_path / "structure.pdb"
+    pdb_path.write_text(open(demo_structures(demo_dir)[0]).read())
+    npy_dir = str(tmp_path / "npy")
+    npy_path = os.path.join(npy_dir, "structure.npy")
+    coords = read_file_and_get_coordinates(str(pdb_path), npy_dir)
+    np.testing.assert_array_equal(np.load(npy_path), coords)
+
+    # a sidecar with the record of the file is loaded instead of it
+    np.save(npy_path, coords + 1.0)
+    np.testing.assert_array_equal(read_file_and_get_coordinates(str(pdb_path), npy_dir), coords + 1.0)
+
+    # a change of the file that keeps the modification time still changes its size
+    pdb_path.write_text(pdb_path.read_text() + "END\n")
+    os.utime(pdb_path, ns=(os.stat(npy_path).st_atime_ns, os.stat(npy_path).st_mtime_ns))
+    np.testing.assert_array_equal(read_file_and_get_coordinates(str(pdb_path), npy_dir), coords)
+    np.testing.assert_array_equal(np.load(npy_path), coords)
+
+    # the chain residues of convert2mrc_npy.py are neither loaded nor overwritten, nor a sidecar without a record
+    for selection in ("chimerax_chain_residues", None):
+        np.save(npy_path, coords[:10])
+        meta = dict(source_size=os.stat(pdb_path).st_size, source_mtime_ns=os.stat(pdb_path).st_mtime_ns,
+                    selection=selection)
+        with open(structure_npy_meta_path(npy_path), "w") as f:
+            f.write("" if selection is None else json.dumps(meta))
+        np.testing.assert_array_equal(read_file_and_get_coordinates(str(pdb_path), npy_dir), coords)
+        assert len(np.load(npy_path)) == 10
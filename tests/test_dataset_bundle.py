@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pytest
+
+from dataset_bundle import DatasetBundle, is_dataset_bundle, write_dataset_bundle
+
+
+@pytest.fixture
+def molecules():
+    rng = np.random.default_rng(0)
+    atom_coords_list = [rng.random((5, 3), dtype=np.float32), rng.random((7, 3), dtype=np.float32)]
+    sim_map_list = [(rng.random((3, 4, 5), dtype=np.float32), [1.0, 1.5, 2.0], [0.0, 1.0, 2.0]),
+                    (rng.random((6, 2, 3), dtype=np.float32), [2.0, 2.0, 2.0], [-1.0, -2.0, -3.0])]
+    return ["a", "b"], atom_coords_list, sim_map_list
+
+
+def test_round_trip(tmp_path, molecules):
+    names, atom_coords_list, sim_map_list = molecules
+    bundle_path = str(tmp_path / "dataset.bundle")
+    structure_paths = [str(tmp_path / "structures" / f"{name}.cif") for name in names]
+    write_dataset_bundle(bundle_path, names, structure_paths, atom_coords_list, sim_map_list)
+
+    bundle = DatasetBundle(bundle_path)
+
+    assert is_dataset_bundle(bundle_path)
+    assert len(bundle) == 2
+    assert bundle.names == names
+    for mol_idx in range(len(bundle)):
+        assert bundle.molecules[mol_idx]["structure_path"] == os.path.join("structures", f"{names[mol_idx]}.cif")
+        assert bundle.structure_path(mol_idx) == structure_paths[mol_idx]
+        np.testing.assert_array_equal(bundle.atom_coords(mol_idx), atom_coords_list[mol_idx])
+        np.testing.assert_allclose(bundle.center(mol_idx), atom_coords_list[mol_idx].mean(axis=0), rtol=1e-6)
+
+        data, steps, origin = bundle.sim_map(mol_idx)
+        np.testing.assert_array_equal(data, sim_map_list[mol_idx][0])
+        assert steps == sim_map_list[mol_idx][1]
+        assert origin == sim_map_list[mol_idx][2]
+
+
+def test_structure_on_another_drive(tmp_path, molecules, monkeypatch):
+    names, atom_coords_list, sim_map_list = molecules
+    structure_paths = [os.path.abspath(f"/elsewhere/{name}.cif") for name in names]
+
+    def relpath(path, start=None):
+        raise ValueError("path is on mount 'D:', start on mount 'C:'")
+
+    monkeypatch.setattr(os.path, "relpath", relpath)
+    write_dataset_bundle(str(tmp_path / "dataset.bundle"), names, structure_paths, atom_coords_list, sim_map_list)
+    monkeypatch.undo()
+
+    bundle = DatasetBundle(str(tmp_path / "dataset.bundle"))
+    assert [bundle.structure_path(mol_idx) for mol_idx in range(len(bundle))] == structure_paths
+
+
+def test_mismatched_lengths(tmp_path, molecules):
+    names, atom_coords_list, sim_map_list = molecules
+    with pytest.raises(ValueError):
+        write_dataset_bundle(str(tmp_path / "dataset.bundle"), names, ["a.cif"], atom_coords_list, sim_map_list)
+
+
+def test_not_a_bundle(tmp_path):
+    path = tmp_path / "other.bundle"
+    path.write_bytes(b"not a bundle at all")
+
+    with pytest.raises(ValueError):
+        DatasetBundle(str(path))
+
+
+def test_weights(tmp_path, molecules):
+    names, atom_coords_list, sim_map_list = molecules
+    bundle_path = str(tmp_path / "dataset.bundle")
+    weights_list = [np.arange(5, dtype=np.float32), None]
+    write_dataset_bundle(bundle_path, names, ["a.cif", "b.cif"], atom_coords_list, sim_map_list, weights_list)
+
+    bundle = DatasetBundle(bundle_path)
+    np.testing.assert_array_equal(bundle.atom_weights(0), weights_list[0])
+    assert bundle.atom_weights(1) is None
+    np.testing.assert_array_equal(bundle.atom_coords(1), atom_coords_list[1])
+
+    with pytest.raises(ValueError):
+        write_dataset_bundle(bundle_path, names, ["a.cif", "b.cif"], atom_coords_list, sim_map_list,
+                             [np.ones(4), None])
+
+
+def test_built_bundle_keeps_the_atomic_numbers(tmp_path, demo_dir):
+    from chimerax.difffit.DiffAtomComp import build_dataset_bundle, read_atom_weights_list
+    from coords_reader import read_atoms, atomic_numbers
+
+    structures_dir = tmp_path / "structures"
+    structures_dir.mkdir()
+    for name in ("I7M317_D1", "I7MLV6_D3"):
+        (structures_dir / f"{name}.pdb").write_text(open(os.path.join(demo_dir, "subunits_cif", f"{name}.pdb")).read())
+    bundle_path = str(tmp_path / "dataset.bundle")
+    build_dataset_bundle(bundle_path, str(structures_dir), os.path.join(demo_dir, "subunits_mrc"))
+
+    bundle = DatasetBundle(bundle_path)
+    for mol_idx in range(len(bundle)):
+        np.testing.assert_array_equal(bundle.atom_weights(mol_idx),
+                                      atomic_numbers(read_atoms(bundle.structure_path(mol_idx))[1]))
+
+    # atoms that are not the ones of the file weigh the same, which is not done quietly
+    with pytest.warns(UserWarning, match="weigh the same"):
+        weights_list = read_atom_weights_list([bundle.structure_path(0)], [bundle.atom_coords(0)[:-1]])
+    assert weights_list == [None]
+
+
+def test_stale_files(tmp_path, molecules):
+    names, atom_coords_list, sim_map_list = molecules
+    bundle_path = str(tmp_path / "dataset.bundle")
+    structure_paths = [tmp_path / f"{name}.cif" for name in names]
+    sim_map_paths = [tmp_path / f"{name}.mrc" for name in names]
+    for path in structure_paths + sim_map_paths:
+        path.write_text("source")
+    write_dataset_bundle(bundle_path, names, [str(path) for path in structure_paths], atom_coords_list,
+                         sim_map_list, sim_map_paths=[str(path) for path in sim_map_paths])
+
+    bundle = DatasetBundle(bundle_path)
+    assert bundle.sim_map_path(1) == str(sim_map_paths[1])
+    assert bundle.stale_files() == []
+
+    structure_paths[0].write_text("edited source")
+    os.utime(sim_map_paths[1], ns=(1, 1))
+    assert bundle.stale_files() == [str(structure_paths[0]), str(sim_map_paths[1])]
+    os.remove(structure_paths[1])
+    assert bundle.stale_files() == [str(structure_paths[0]), str(structure_paths[1]), str(sim_map_paths[1])]
+
+    from chimerax.difffit.DiffAtomComp import read_dataset_bundle
+    with pytest.warns(UserWarning, match="3 file"):
+        read_dataset_bundle(bundle_path)
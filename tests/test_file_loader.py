@@ -0,0 +1,66 @@
+import os
+import time
+
+import pytest
+
+from file_loader import format_load_errors, load_files
+
+
+def load_number(file_path):
+    if file_path.startswith("bad"):
+        raise ValueError("cannot parse")
+    # the later files finish first
+    time.sleep(0.01 / (1 + int(file_path.rsplit("_", 1)[-1])))
+    return int(file_path.rsplit("_", 1)[-1])
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_results_in_file_order(num_workers):
+    file_paths = [f"file_{idx}" for idx in range(10)]
+    results, errors = load_files(load_number, file_paths, num_workers)
+
+    assert results == list(range(10))
+    assert errors == []
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_failed_files_are_reported(num_workers):
+    results, errors = load_files(load_number, ["file_0", "bad_1", "file_2"], num_workers)
+
+    assert results == [0, None, 2]
+    assert errors == [("bad_1", "ValueError: cannot parse")]
+    assert format_load_errors(errors) == "  bad_1: ValueError: cannot parse"
+
+
+def test_process_pool():
+    results, errors = load_files(load_number, ["file_0", "file_1"], num_workers=2, use_processes=True)
+
+    assert results == [0, 1]
+    assert errors == []
+
+
+def test_no_files():
+    assert load_files(load_number, []) == ([], [])
+
+
+def test_folder_results_keep_the_file_indices(tmp_path):
+    from chimerax.difffit.DiffAtomComp import folder_file_paths, load_folder_files
+
+    for name in ("file_0", "bad_1", "file_2"):
+        (tmp_path / name).write_text("")
+
+    def load_name(file_path):
+        return load_number(os.path.basename(file_path))
+
+    errors = []
+    results = load_folder_files(load_name, str(tmp_path), num_workers=1, errors=errors)
+
+    # the failed file keeps its place, the results pair with folder_file_paths() by index
+    file_paths = folder_file_paths(str(tmp_path))
+    assert len(results) == len(file_paths) == 3
+    for file_path, result in zip(file_paths, results):
+        assert result == (None if os.path.basename(file_path) == "bad_1" else int(file_path[-1]))
+    assert errors == [(str(tmp_path / "bad_1"), "ValueError: cannot parse")]
+
+    with pytest.raises(ValueError):
+        load_folder_files(load_name, str(tmp_path), num_workers=1)
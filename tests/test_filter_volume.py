@@ -0,0 +1,57 @@
+import numpy as np
+
+from chimerax.difffit.DiffAtomComp import filter_volume, sample_island_voxels
+
+
+def islands():
+    volume = np.zeros((6, 6, 6), dtype=np.float32)
+    # an L of 28 voxels, with another island of 8 voxels in its bounding box
+    volume[0:4, 0, 0:4] = 1.0
+    volume[0:4, 0:4, 0] = 1.0
+    volume[2:4, 2:4, 2:4] = 2.0
+    volume[5, 5, 5] = 3.0  # a single voxel
+    return volume
+
+
+def test_in_place():
+    volume = islands()
+    copy_filtered, eligible_volume, _ = filter_volume(volume, 0.5, 3)
+    assert copy_filtered is not volume
+    np.testing.assert_array_equal(volume, islands())
+
+    filtered, _, _ = filter_volume(volume, 0.5, 3, in_place=True)
+    assert filtered is volume
+    np.testing.assert_array_equal(filtered, copy_filtered)
+    assert filtered[5, 5, 5] == 0 and eligible_volume.sum() == 36
+
+
+def test_island_voxels():
+    volume = islands()
+    _, eligible_volume, _, island_stats = filter_volume(volume, 0.5, 3, return_stats=True)
+
+    assert "labeled_volume" not in island_stats
+    np.testing.assert_array_equal(island_stats["sizes"], [28, 8])
+    for island_idx, size in enumerate(island_stats["sizes"]):
+        assert len(island_stats["voxels"][island_idx]) == size
+        sampled = sample_island_voxels(island_stats, island_idx, 50)
+        # the voxels of one island, of a single value, in its bounding box
+        assert len(np.unique(volume[tuple(sampled.T)])) == 1
+        assert np.all(eligible_volume[tuple(sampled.T)])
+
+
+def test_stratified_seeds_with_many_tiny_islands():
+    from chimerax.difffit.DiffAtomComp import random_sample_indices
+
+    volume = np.zeros((20, 40, 40), dtype=np.float32)
+    volume[0:10, 0:10, 0:10] = 1.0
+    # 200 islands of a single voxel, which take a seed each but not their share of the rest
+    volume[12::2, 0::2, 0::2][:4, :10, :5] = 1.0
+    _, eligible_volume, _, island_stats = filter_volume(volume, 0.5, 0, return_stats=True)
+    assert len(island_stats["sizes"]) == 201
+
+    np.random.seed(0)
+    for sample_size in (150, 300, 1100):
+        sampled = random_sample_indices(eligible_volume, sample_size, "stratified", island_stats=island_stats)
+        assert len(sampled) == sample_size
+        assert np.all(eligible_volume[tuple(sampled.T)])
+        assert len(np.unique(sampled, axis=0)) == sample_size
@@ -0,0 +1,163 @@
+import gzip
+import inspect
+import os
+import shutil
+
+import numpy as np
+import pytest
+import torch
+
+from chimerax.difffit import DiffAtomComp
+from chimerax.difffit.DiffAtomComp import FitEngine
+
+
+class EngineBuilt(Exception):
+    pass
+
+
+def record_constructor(monkeypatch, name):
+    """Replace a FitEngine constructor by one that records the arguments it is called with, bound to its signature"""
+    constructor = getattr(FitEngine, name).__func__
+    calls = []
+
+    def record(cls, *args, **kwargs):
+        bound = inspect.signature(constructor).bind(cls, *args, **kwargs)
+        bound.apply_defaults()
+        calls.append(bound.arguments)
+        raise EngineBuilt
+
+    monkeypatch.setattr(FitEngine, name, classmethod(record))
+    return calls
+
+
+def test_diff_atom_comp_forwards_keywords(monkeypatch, demo_dir, tmp_path):
+    calls = record_constructor(monkeypatch, "from_file")
+
+    with pytest.raises(EngineBuilt):
+        DiffAtomComp.diff_atom_comp(os.path.join(demo_dir, "density2.mrc"), 0.7, 100,
+                                    os.path.join(demo_dir, "subunits_cif"), os.path.join(demo_dir, "subunits_mrc"),
+                                    out_dir=str(tmp_path), target_resolution=6.0, device="cuda:1")
+
+    assert calls[0]["device"] == "cuda:1"
+    assert calls[0]["target_resolution"] == 6.0
+    assert calls[0]["crop"] is True
+
+
+def test_diff_fit_forwards_keywords(monkeypatch):
+    calls = record_constructor(monkeypatch, "from_volume_list")
+
+    with pytest.raises(EngineBuilt):
+        DiffAtomComp.diff_fit([np.zeros((4, 4, 4))], [1.0, 1.0, 1.0], [0.0, 0.0, 0.0], 10,
+                              [np.zeros((3, 3))], None, target_resolution=6.0, device="cuda:1")
+
+    assert calls[0]["device"] == "cuda:1"
+    assert calls[0]["target_resolution"] == 6.0
+    assert calls[0]["crop"] is True
+
+
+def test_mrc_to_npy_compressed(write_mrc):
+    data = np.random.default_rng(0).random((4, 5, 6), dtype=np.float32)
+    path = write_mrc("volume.mrc", data)
+    with open(path, "rb") as f, gzip.open(path + ".gz", "wb") as f_out:
+        shutil.copyfileobj(f, f_out)
+
+    for lazy in (True, False):
+        volume, steps, origin = DiffAtomComp.mrc_to_npy(path + ".gz", lazy=lazy)
+        assert isinstance(volume, np.ndarray)
+        np.testing.assert_array_equal(volume, data)
+        assert tuple(steps) == (1.0, 2.0, 3.0)
+        assert tuple(origin) == (4.0, 5.0, 6.0)
+
+    volume, _, _ = DiffAtomComp.mrc_to_npy(path, lazy=True)
+    assert isinstance(volume, DiffAtomComp.LazyVolume)
+
+
+def test_prescan_more_candidates_than_voxels(demo_engine, demo_molecules):
+    mol_coords, mol_sim_maps = demo_molecules
+
+    # the target binned by 20 only has a handful of voxels
+    e_quaternions, e_shifts = demo_engine.prescan(mol_coords[:1], mol_sim_maps[:1], 64, angle_deg=60.0, bin_factor=20)
+
+    assert e_quaternions.shape == (1, 64, 4)
+    assert e_shifts.shape == (1, 64, 3)
+    assert np.all(np.isfinite(e_shifts))
+    np.testing.assert_allclose(np.linalg.norm(e_quaternions, axis=-1), 1.0, rtol=1e-5)
+
+
+def run_fit(engine, mol_coords, mol_sim_maps, **kwargs):
+    # the same seeds for every run
+    np.random.seed(0)
+    torch.manual_seed(0)
+    kwargs = dict(dict(N_shifts=3, N_quaternions=4, n_iters=11, log_every=5), **kwargs)
+    _, e_sqd_log = engine.fit(mol_coords, mol_sim_maps, **kwargs)
+    return e_sqd_log.detach().cpu().numpy()
+
+
+def test_batched_matches_per_molecule(demo_engine, demo_molecules):
+    batched = run_fit(demo_engine, *demo_molecules, batch_molecules=True)
+    per_molecule = run_fit(demo_engine, *demo_molecules, batch_molecules=False)
+
+    assert batched.shape == (2, 4, 3, 4, 12)
+    np.testing.assert_allclose(batched, per_molecule, rtol=1e-4, atol=1e-4)
+
+
+def test_pruned_survivors_match_the_unpruned_run(demo_engine, demo_molecules):
+    unpruned = run_fit(demo_engine, *demo_molecules).reshape(2, 12, 4, 12)
+    pruned = run_fit(demo_engine, *demo_molecules, prune_epochs=[5], prune_by="correlation",
+                     prune_fraction=0.5).reshape(2, 12, 4, 12)
+
+    # the logs are at epochs 0, 5 and 10, the candidates are pruned after the log of epoch 5
+    np.testing.assert_allclose(pruned[:, :, :3], unpruned[:, :, :3], rtol=1e-5, atol=1e-5)
+
+    survivors = np.zeros((2, 12), dtype=bool)
+    for mol_idx in range(2):
+        survivors[mol_idx, np.argsort(-unpruned[mol_idx, :, 2, 9])[:6]] = True
+
+    # the candidates are independent, the survivors go on as without pruning, the others keep their last record
+    np.testing.assert_allclose(pruned[survivors][:, 3], unpruned[survivors][:, 3], rtol=1e-4, atol=1e-4)
+    np.testing.assert_array_equal(pruned[~survivors][:, 3], pruned[~survivors][:, 2])
+
+
+def test_prune_nothing_matches_the_unpruned_run(demo_engine, demo_molecules):
+    unpruned = run_fit(demo_engine, *demo_molecules)
+    pruned = run_fit(demo_engine, *demo_molecules, prune_epochs=[5], prune_fraction=0.0)
+
+    np.testing.assert_allclose(pruned, unpruned, rtol=1e-5, atol=1e-6)
+
+
+def test_chunked_matches_a_single_pass(demo_engine, demo_molecules):
+    mol_coords, _ = demo_molecules
+    max_num_atoms = max(len(coords) for coords in mol_coords)
+    num_channels = demo_engine.target_channels.shape[1]
+    assert DiffAtomComp.plan_candidate_chunks(2, 12, max_num_atoms, num_channels, 100000) == (2, 12)
+    molecule_chunk_size, candidate_chunk_size = DiffAtomComp.plan_candidate_chunks(2, 12, max_num_atoms,
+                                                                                  num_channels, 1)
+    assert molecule_chunk_size == 1 and candidate_chunk_size < 12
+
+    # the gradients accumulated over the chunks drive the same trajectories
+    single_pass = run_fit(demo_engine, *demo_molecules, max_memory_mb=100000)
+    chunked = run_fit(demo_engine, *demo_molecules, max_memory_mb=1)
+
+    np.testing.assert_allclose(chunked, single_pass, rtol=1e-4, atol=1e-4)
+
+
+def test_coords_cache_is_bounded_by_bytes():
+    cache = DiffAtomComp.AtomCoordsCache(max_bytes=1000 * 3 * 4 * 100)
+    coords_list = [np.full((1000, 3), mol_idx, dtype=np.float32) for mol_idx in range(100)]
+
+    # more molecules than the old limit of 64 entries stay resident
+    tensors = [cache.get(coords, "cpu") for coords in coords_list]
+    assert all(cache.get(coords, "cpu") is tensor for coords, tensor in zip(coords_list, tensors))
+    assert cache.num_bytes == 100 * 1000 * 3 * 4
+
+    # beyond the bytes, the least recently used go first
+    cache.get(np.zeros((10, 3)), "cpu")
+    assert cache.get(coords_list[0], "cpu") is not tensors[0]
+    assert cache.get(coords_list[-1], "cpu") is tensors[-1]
+    assert cache.num_bytes <= cache.max_bytes
+
+    cache.clear()
+    assert cache.num_bytes == 0
+    # a tensor larger than the bound is still kept until the next one
+    big = np.zeros((200000, 3), dtype=np.float32)
+    assert cache.get(big, "cpu") is cache.get(big, "cpu")
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from chimerax.difffit.fit_log import log_epochs_array, logged_rows
+from chimerax.difffit.parse_log import cluster_and_sort_sqd_fast
+
+
+def baseline_log(n_iters, best_record):
+    """An e_sqd_log like the baseline engine wrote it, int(n_iters / 10) + 2 records logged every 10 epochs"""
+    rng = np.random.default_rng(0)
+    num_records = int(n_iters / 10) + 2
+    e_sqd_log = np.zeros((1, 2, 3, num_records, 12))
+    e_sqd_log[..., 0:3] = rng.normal(size=(1, 2, 3, 1, 3)) * 10.0
+    quaternions = rng.normal(size=(1, 2, 3, 1, 4))
+    e_sqd_log[..., 3:7] = quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    e_sqd_log[..., 9] = np.linspace(0.1, 0.5, num_records)
+    e_sqd_log[..., best_record, 9] = 0.9
+    return e_sqd_log
+
+
+def test_logged_rows():
+    np.testing.assert_array_equal(logged_rows(22), np.arange(1, 22))
+    # the baseline range of a log without its epochs, whatever its length
+    np.testing.assert_array_equal(logged_rows(42), np.arange(1, 22))
+    np.testing.assert_array_equal(logged_rows(4, log_epochs_array({0, 5, 10})), [1, 2, 3])
+
+    with pytest.raises(ValueError):
+        logged_rows(5, log_epochs_array({0, 5, 10}))
+
+
+def test_parse_baseline_log():
+    # the default 201 iterations, the best epoch in the middle
+    e_sqd_log = baseline_log(201, 12)
+    clusters = cluster_and_sort_sqd_fast(e_sqd_log)
+
+    assert len(clusters) == 6
+    np.testing.assert_array_equal(clusters[:, 2], 11)  # relative to record 1
+    np.testing.assert_allclose(clusters[:, 4], 0.9)
+
+
+def test_parse_long_baseline_log():
+    # 401 iterations, the baseline only searched records 1 to 21, the epochs up to 200
+    e_sqd_log = baseline_log(401, 30)
+    clusters = cluster_and_sort_sqd_fast(e_sqd_log)
+    np.testing.assert_array_equal(clusters[:, 2], 20)
+    assert np.all(clusters[:, 4] < 0.9)
+
+    # with the epochs of the records, all of them are searched
+    log_epochs = log_epochs_array(range(0, 401, 10))
+    clusters = cluster_and_sort_sqd_fast(e_sqd_log, log_epochs=log_epochs)
+    np.testing.assert_array_equal(clusters[:, 2], 29)
+    np.testing.assert_allclose(clusters[:, 4], 0.9)
+
+
+def test_engine_records_the_log_epochs(demo_engine, demo_molecules):
+    _, e_sqd_log = demo_engine.fit(*demo_molecules, N_shifts=2, N_quaternions=2, n_iters=11, log_every=5,
+                                   snapshot_epochs=[7])
+
+    np.testing.assert_array_equal(demo_engine.log_epochs, [-1, 0, 5, 7, 10])
+    assert e_sqd_log.shape[-2] == len(demo_engine.log_epochs)
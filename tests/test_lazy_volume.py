@@ -0,0 +1,49 @@
+import bz2
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+
+from lazy_volume import LazyVolume
+
+
+@pytest.fixture
+def volume_data():
+    return np.random.default_rng(0).random((4, 5, 6), dtype=np.float32)
+
+
+def compress(path, open_compressed, suffix):
+    compressed_path = path + suffix
+    with open(path, "rb") as f, open_compressed(compressed_path, "wb") as f_out:
+        shutil.copyfileobj(f, f_out)
+    return compressed_path
+
+
+def test_round_trip(write_mrc, volume_data):
+    volume = LazyVolume(write_mrc("volume.mrc", volume_data))
+
+    assert not volume.compressed
+    assert volume.shape == volume_data.shape
+    assert volume.dtype == np.float32
+    assert tuple(volume.steps) == (1.0, 2.0, 3.0)
+    assert tuple(volume.origin) == (4.0, 5.0, 6.0)
+    assert isinstance(volume.data, np.memmap)
+    np.testing.assert_array_equal(np.asarray(volume), volume_data)
+    np.testing.assert_array_equal(volume[1:3, :, 2:4], volume_data[1:3, :, 2:4])
+
+    volume.release()
+    np.testing.assert_array_equal(np.array(volume, copy=True), volume_data)
+
+
+@pytest.mark.parametrize("open_compressed, suffix", [(gzip.open, ".gz"), (bz2.open, ".bz2")])
+def test_compressed_round_trip(write_mrc, volume_data, open_compressed, suffix):
+    volume = LazyVolume(compress(write_mrc("volume.mrc", volume_data), open_compressed, suffix))
+
+    assert volume.compressed
+    assert volume.shape == volume_data.shape
+    assert tuple(volume.steps) == (1.0, 2.0, 3.0)
+    assert tuple(volume.origin) == (4.0, 5.0, 6.0)
+    np.testing.assert_array_equal(np.asarray(volume), volume_data)
+    np.testing.assert_array_equal(volume[2], volume_data[2])
+    assert not volume.data.flags.writeable
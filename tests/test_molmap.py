@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from molmap import molmap_at_points, molmap_batch, molmap_label, read_molmap_label, save_molmap
+
+
+@pytest.fixture
+def atoms():
+    rng = np.random.default_rng(0)
+    atom_coords_list = [rng.random((20, 3)) * 10.0, rng.random((7, 3)) * 6.0 + 30.0]
+    weights_list = [rng.choice([6.0, 7.0, 8.0, 16.0], len(atom_coords)) for atom_coords in atom_coords_list]
+    return atom_coords_list, weights_list
+
+
+def test_batch_conserves_mass(atoms):
+    atom_coords_list, weights_list = atoms
+    sim_map_list = molmap_batch(atom_coords_list, 4.0, 1.0, weights_list)
+
+    for (data, steps, origin), weights in zip(sim_map_list, weights_list):
+        assert steps == [1.0, 1.0, 1.0]
+        np.testing.assert_allclose(data.sum() * np.prod(steps), weights.sum(), rtol=1e-3)
+
+
+def test_batch_molecules_are_independent(atoms):
+    atom_coords_list, weights_list = atoms
+    batch = molmap_batch(atom_coords_list, 4.0, 1.0, weights_list)
+    single = molmap_batch(atom_coords_list[1:], 4.0, 1.0, weights_list[1:])
+
+    np.testing.assert_allclose(batch[1][0], single[0][0], rtol=1e-5, atol=1e-7)
+    assert batch[1][2] == single[0][2]
+
+
+def test_at_points_matches_the_grid(atoms):
+    atom_coords, weights = atoms[0][0], atoms[1][0]
+    (data, steps, origin), = molmap_batch([atom_coords], 4.0, 1.0, [weights])
+
+    # the voxel centers of the grid, as [x, y, z]
+    indices = np.stack(np.meshgrid(*[np.arange(dim) for dim in data.shape], indexing="ij"), axis=-1).reshape(-1, 3)
+    points = indices[:, ::-1] * np.array(steps[::-1]) + origin
+    density = molmap_at_points(atom_coords, points, 4.0, weights, chunk_size=1000)
+
+    np.testing.assert_allclose(density, data.ravel(), rtol=1e-4, atol=1e-6)
+
+
+def test_label_round_trip(atoms, tmp_path):
+    atom_coords, weights = atoms[0][0], atoms[1][0]
+    sim_map, = molmap_batch([atom_coords], 4.0, 1.0, [weights])
+    label = molmap_label(atom_coords, weights, 4.0, 1.0)
+    path = str(tmp_path / "sim_map.mrc")
+    save_molmap(path, sim_map, label)
+
+    assert read_molmap_label(path) == label
+    assert label != molmap_label(atom_coords, None, 4.0, 1.0)
+    assert label != molmap_label(atom_coords, weights, 5.0, 1.0)
+
+
+def test_no_label(write_mrc, tmp_path):
+    assert read_molmap_label(write_mrc("plain.mrc", np.zeros((2, 2, 2)))) is None
+    assert read_molmap_label(str(tmp_path / "missing.mrc")) is None
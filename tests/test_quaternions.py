@@ -0,0 +1,41 @@
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from common import generate_super_fibonacci_quaternions, num_quaternions_for_resolution
+
+
+def test_unit_quaternions():
+    quaternions = generate_super_fibonacci_quaternions(500)
+
+    assert quaternions.shape == (500, 4)
+    np.testing.assert_allclose(np.linalg.norm(quaternions, axis=-1), 1.0, rtol=1e-6)
+
+
+def test_deterministic_and_not_shared():
+    quaternions = generate_super_fibonacci_quaternions(100)
+    quaternions[0] = 0.0
+
+    np.testing.assert_array_equal(generate_super_fibonacci_quaternions(100)[1:], quaternions[1:])
+    assert np.linalg.norm(generate_super_fibonacci_quaternions(100)[0]) == pytest.approx(1.0)
+
+
+def test_count_from_resolution():
+    assert num_quaternions_for_resolution(30.0) == math.ceil(8 * math.pi ** 2 / math.radians(30.0) ** 3)
+    assert len(generate_super_fibonacci_quaternions(angle_deg=30.0)) == num_quaternions_for_resolution(30.0)
+
+    with pytest.raises(ValueError):
+        generate_super_fibonacci_quaternions()
+
+
+def test_covers_rotations():
+    # every rotation is close to one of the set, q and -q are the same rotation
+    quaternions = generate_super_fibonacci_quaternions(angle_deg=20.0)
+    rng = np.random.default_rng(0)
+    rotations = rng.normal(size=(1000, 4))
+    rotations /= np.linalg.norm(rotations, axis=-1, keepdims=True)
+
+    nearest_angle = np.degrees(2 * np.arccos(np.clip(np.abs(rotations @ quaternions.T).max(axis=-1), 0.0, 1.0)))
+    assert nearest_angle.max() < 40.0
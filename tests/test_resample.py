@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from chimerax.difffit.DiffAtomComp import downsample_volume, resample_factor
+
+
+def test_factor_of_an_over_sampled_map():
+    # 0.8 angstrom voxels for a 4 angstrom map, 3 voxels per resolution want 1.33 angstrom voxels
+    factor = resample_factor([0.8, 0.8, 0.8], 4.0)
+    assert factor == pytest.approx(4.0 / 3.0 / 0.8)
+    assert factor > 1
+
+    assert resample_factor([0.8, 0.8, 0.8], 2.0) == 1
+    assert resample_factor([0.8, 0.8, 0.8], None) == 1
+    assert resample_factor([1.0, 1.0, 1.0], 6.0) == 2
+
+
+def test_non_integer_downsampling_keeps_the_mean_and_the_center():
+    rng = np.random.default_rng(0)
+    volume = rng.random((30, 25, 20), dtype=np.float32)
+    steps = [0.8, 0.8, 0.8]
+    origin = [1.0, 2.0, 3.0]
+    factor = resample_factor(steps, 4.0)
+
+    downsampled, new_steps, new_origin = downsample_volume(volume, steps, origin, factor)
+
+    assert downsampled.shape == tuple(int(size // factor) for size in volume.shape) == (18, 15, 12)
+    np.testing.assert_allclose(new_steps, 4.0 / 3.0)
+    # the windows of 20 voxels along x cover the same space as 12 new voxels, which keep its mean
+    np.testing.assert_allclose(downsampled.mean(), volume.mean(), atol=1e-2)
+
+    # a linear ramp stays a ramp, sampled at the centers of the new voxels, up to the voxels being constant boxes
+    ramp = np.broadcast_to(np.arange(20, dtype=np.float32), (30, 25, 20)) * 0.8 + origin[0]
+    downsampled_ramp, _, new_origin = downsample_volume(ramp, steps, origin, factor)
+    np.testing.assert_allclose(downsampled_ramp[0, 0], new_origin[0] + np.arange(12) * new_steps[2], atol=0.1)
+
+
+def test_integer_factor_pools_blocks():
+    volume = np.arange(4 * 4 * 4, dtype=np.float32).reshape(4, 4, 4)
+    downsampled, steps, origin = downsample_volume(volume, [1.0, 1.0, 1.0], [0.0, 0.0, 0.0], 2)
+
+    np.testing.assert_allclose(downsampled, volume.reshape(2, 2, 2, 2, 2, 2).mean(axis=(1, 3, 5)))
+    np.testing.assert_allclose(origin, 0.5)
+    np.testing.assert_allclose(steps, 2.0)
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+
+from target_cache import TargetCache, target_cache_key
+
+
+def save_entry(cache, key, size=8):
+    conv_list = [np.full((size, size, size), level, dtype=np.float32) for level in range(3)]
+    cache.save(key, [1.0, 1.0, 1.0], [0.0, 0.0, 0.0], np.ones((size, size, size), dtype=bool), [(1, 2, 3)],
+               conv_list, crop_start=[0, 1, 2], full_dim=[size, size + 1, size + 2])
+    return conv_list
+
+
+def test_miss_then_hit(tmp_path):
+    cache = TargetCache(str(tmp_path))
+    assert cache.load("key") is None
+
+    conv_list = save_entry(cache, "key")
+    entry = cache.load("key")
+
+    assert entry is not None
+    assert entry["cluster_center_indices"] == [(1, 2, 3)]
+    assert entry["crop_start"] == [0, 1, 2]
+    assert entry["full_dim"] == [8, 9, 10]
+    assert len(entry["conv_list"]) == len(conv_list)
+    for cached, volume in zip(entry["conv_list"], conv_list):
+        np.testing.assert_array_equal(cached, volume)
+
+
+def test_broken_entry_is_a_miss(tmp_path):
+    cache = TargetCache(str(tmp_path))
+    save_entry(cache, "key")
+    os.remove(tmp_path / "key" / "level_1.npy")
+
+    assert cache.load("key") is None
+    assert not os.path.exists(tmp_path / "key")
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # each entry is about 7.5 KB, the budget holds two of them
+    cache = TargetCache(str(tmp_path), max_size_mb=20 / 1024)
+    save_entry(cache, "first")
+    save_entry(cache, "second")
+    os.utime(tmp_path / "first" / "meta.json", (1, 1))
+    os.utime(tmp_path / "second" / "meta.json", (2, 2))
+    cache.load("first")
+
+    save_entry(cache, "third")
+
+    assert cache.load("first") is not None
+    assert cache.load("second") is None
+    assert cache.load("third") is not None
+
+
+def test_key_depends_on_the_parameters(write_mrc):
+    path = write_mrc("target.mrc", np.zeros((4, 4, 4)))
+    key = target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5)
+
+    assert key == target_cache_key(path, 0.5, 10, 2, [5, 5, 9], -0.5)
+    assert key != target_cache_key(path, 0.6, 10, 2, [5, 5], -0.5)
+    assert key != target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5, target_resolution=6.0)
+    assert key != target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5, crop=True)
+    assert key != target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5, conv_pyramid="direct")
+
+
+def test_clear(tmp_path):
+    cache = TargetCache(str(tmp_path / "cache"))
+    save_entry(cache, "key")
+    cache.clear()
+
+    assert cache.load("key") is None
+
+
+def test_key_follows_the_map_file(write_mrc, monkeypatch):
+    import target_cache
+
+    path = write_mrc("target.mrc", np.zeros((4, 4, 4)))
+    copy_path = write_mrc("copy.mrc", np.zeros((4, 4, 4)))
+    os.utime(copy_path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns))
+
+    def no_hashing(file_path, chunk_size=None):
+        raise AssertionError("the map is hashed")
+
+    monkeypatch.setattr(target_cache, "file_sha1", no_hashing)
+    key = target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5)
+    assert key != target_cache_key(copy_path, 0.5, 10, 2, [5, 5], -0.5)
+    os.utime(path, ns=(1, 1))
+    assert key != target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5)
+    monkeypatch.undo()
+
+    # the strict key hashes the content, a copy of the map hits, an edit of the same size and time misses
+    strict_key = target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5, strict=True)
+    assert strict_key == target_cache_key(copy_path, 0.5, 10, 2, [5, 5], -0.5, strict=True)
+    write_mrc("target.mrc", np.ones((4, 4, 4)))
+    os.utime(path, ns=(1, 1))
+    assert strict_key != target_cache_key(path, 0.5, 10, 2, [5, 5], -0.5, strict=True)